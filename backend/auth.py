@@ -1,20 +1,37 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from database import engine, get_db
+from sqlalchemy import event, inspect
+from cache import TTLCache
+from database import get_db
+from metrics import watch_cache
 from models import User
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 # Secret keys and constants (In production, use environment variables)
 SECRET_KEY = "super-secret-key-for-social-app"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 300
 
+# Users resolved from tokens are kept this long (seconds), changes made by
+# other processes show up after at most this delay
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1024"))
+# Threads hashing and checking passwords, so logins don't block the event loop
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password")
+# Detached users by username (the token subject)
+user_cache = TTLCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -22,6 +39,12 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def verify_password_async(plain_password, hashed_password):
+    return await asyncio.get_running_loop().run_in_executor(password_executor, verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await asyncio.get_running_loop().run_in_executor(password_executor, get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -34,7 +57,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 # get_db moved to database.py
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -48,8 +71,22 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     except JWTError:
         raise credentials_exception
     
-    statement = select(User).where(User.username == username)
-    user = db.exec(statement).first()
-    if user is None:
-        raise credentials_exception
-    return user
+    cached = user_cache.get(username)
+    if cached is None:
+        cached = (await db.exec(select(User).where(User.username == username))).first()
+        if cached is None:
+            raise credentials_exception
+        db.expunge(cached)
+        user_cache.set(username, cached)
+    # A copy attached to this request's session, without querying again
+    return await db.merge(cached, load=False)
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _forget_user(mapper, connection, user):
+    user_cache.pop(user.username)
+    # After a rename the entry sits under the old name, which tokens still carry
+    for previous in inspect(user).attrs.username.history.deleted:
+        user_cache.pop(previous)
+
+watch_cache("user", user_cache)
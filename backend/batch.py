@@ -0,0 +1,147 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from downloader import downloader
+
+logger = logging.getLogger(__name__)
+
+# Entries of one batch downloaded at the same time
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+# Largest number of entries (after playlist expansion) accepted in one batch
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+# Chunks buffered between the archive writer and the client
+ZIP_QUEUE_CHUNKS = 16
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class BatchCancelled(Exception):
+    pass
+
+
+class _QueueWriter(io.RawIOBase):
+    """Non-seekable file object handing written bytes to an asyncio queue.
+
+    Writes block while the queue is full, so the archive is produced at the
+    speed the client reads it.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, cancelled: threading.Event):
+        self.loop = loop
+        self.queue = queue
+        self.cancelled = cancelled
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.put(bytes(data))
+        return len(data)
+
+    def put(self, item: Optional[bytes]):
+        """Queue ``item``, waiting for room; raises BatchCancelled once the client is gone."""
+        future = asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop)
+        while True:
+            if self.cancelled.is_set():
+                future.cancel()
+                raise BatchCancelled()
+            try:
+                future.result(timeout=1)
+                return
+            except TimeoutError:
+                continue
+
+
+def _entries(url: str) -> List[str]:
+    try:
+        return downloader.list_entries(url)
+    except Exception:
+        # Kept as-is, the download fails again and is reported in status.json
+        return [url]
+
+
+def expand_urls(urls: List[str]) -> Tuple[List[str], List[str]]:
+    """Replace playlist URLs by the URLs of their entries.
+
+    Returns the entries to download and those past ``BATCH_MAX_ITEMS``.
+    Playlists are expanded in parallel, so the response starts after the
+    slowest one rather than after all of them.
+    """
+    # Each URL gives at least one entry, the ones past the limit aren't fetched
+    fetched, dropped = urls[:BATCH_MAX_ITEMS], urls[BATCH_MAX_ITEMS:]
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch-expand") as pool:
+        expanded = [entry for entries in pool.map(_entries, fetched) for entry in entries]
+    return expanded[:BATCH_MAX_ITEMS], expanded[BATCH_MAX_ITEMS:] + dropped
+
+
+def _write_archive(writer: _QueueWriter, urls: List[str], format_type: str, audio_codec: str, cancelled: threading.Event,
+                   skipped: List[str]):
+    statuses: List[Dict] = [
+        {"index": len(urls) + i + 1, "url": url, "status": "skipped",
+         "error": f"over the limit of {BATCH_MAX_ITEMS} entries per batch"}
+        for i, url in enumerate(skipped)
+    ]
+    # ZipFile detects the stream isn't seekable and uses data descriptors
+    with zipfile.ZipFile(writer, "w", zipfile.ZIP_STORED) as archive:
+        pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch")
+        try:
+            futures = {pool.submit(downloader.download_cached, url, format_type, audio_codec=audio_codec): (i, url) for i, url in enumerate(urls)}
+            # Entries are added in the order they finish, one failure doesn't stop the rest
+            for future in as_completed(futures):
+                index, url = futures[future]
+                status = {"index": index + 1, "url": url}
+                try:
+                    result = future.result()
+                    name = f"{index + 1:03d} - {result['title']}{os.path.splitext(result['path'])[1]}"
+                    with open(result["path"], "rb") as src, archive.open(name, "w", force_zip64=True) as dest:
+                        while chunk := src.read(COPY_CHUNK_SIZE):
+                            dest.write(chunk)
+                    status.update({"status": "ok", "file": name})
+                except BatchCancelled:
+                    raise
+                except Exception as e:
+                    status.update({"status": "failed", "error": str(e)})
+                statuses.append(status)
+        finally:
+            pool.shutdown(wait=not cancelled.is_set(), cancel_futures=True)
+        statuses.sort(key=lambda s: s["index"])
+        archive.writestr("status.json", json.dumps(statuses, indent=2))
+
+
+async def stream_zip(urls: List[str], format_type: str = "video", audio_codec: str = "mp3",
+                     skipped: Optional[List[str]] = None) -> AsyncIterator[bytes]:
+    """Download ``urls`` in parallel and yield a ZIP archive of the results as it is built.
+
+    ``skipped`` URLs are only listed in status.json.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=ZIP_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    writer = _QueueWriter(loop, queue, cancelled)
+
+    def produce():
+        try:
+            try:
+                _write_archive(writer, urls, format_type, audio_codec, cancelled, skipped or [])
+            except BatchCancelled:
+                raise
+            except Exception as e:
+                logger.exception("Batch error: %s", e)
+            # End of the archive, the queue may be full and the client gone by now
+            writer.put(None)
+        except BatchCancelled:
+            return
+
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while (chunk := await queue.get()) is not None:
+            yield chunk
+    finally:
+        # Client went away (or we are done): stop the writer and running downloads
+        cancelled.set()
+        await asyncio.shield(producer)
@@ -0,0 +1,171 @@
+"""Concurrent read/write throughput of the social API.
+
+Starts the API in a subprocess on an empty SQLite database (or DATABASE_URL
+when set), registers users who are all friends with each other, then runs a
+mix of home-feed reads and post/reaction writes at each concurrency level.
+Run from backend/:
+
+    python -m benchmarks.db --output db-before.json
+    python -m benchmarks.db --output db-after.json --baseline db-before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+from benchmarks.report import BACKEND_DIR, compare, git_commit, summarize
+
+# Settings that change the results, recorded next to them
+SETTINGS_ENV = ("DATABASE_URL", "SQLITE_BUSY_TIMEOUT", "PASSWORD_HASH_WORKERS", "USER_CACHE_TTL")
+
+
+def start_api(work_dir: str) -> tuple:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = {**os.environ, "PYTHONPATH": BACKEND_DIR}
+    # The default sqlite file is created in the working directory
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                               cwd=work_dir, env=env)
+    api_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"{api_url}/metrics").raise_for_status()
+            return process, api_url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("API did not start")
+
+
+async def setup(client: httpx.AsyncClient, users: int) -> List[Dict[str, str]]:
+    """Register ``users`` users who are all friends, return their auth headers."""
+    prefix = os.urandom(4).hex()
+    headers, ids = [], []
+    for i in range(users):
+        name = f"bench-{prefix}-{i}"
+        (await client.post("/register", json={"username": name, "email": f"{name}@example.com",
+                                               "full_name": name, "password": "benchmark"})).raise_for_status()
+        token = (await client.post("/token", data={"username": name, "password": "benchmark"})).json()["access_token"]
+        headers.append({"Authorization": f"Bearer {token}"})
+        ids.append((await client.get("/users/me", headers=headers[-1])).json()["id"])
+    for i in range(users):
+        for j in range(i + 1, users):
+            await client.post(f"/friends/request/{ids[j]}", headers=headers[i])
+            await client.post(f"/friends/accept/{ids[i]}", headers=headers[j])
+    return headers
+
+
+async def run_level(client: httpx.AsyncClient, headers: List[Dict[str, str]], post_ids: List[int],
+                    concurrency: int, seconds: float, write_ratio: float) -> Dict[str, Any]:
+    latencies: Dict[str, List[float]] = {"read": [], "post": [], "reaction": []}
+    errors = 0
+    deadline = time.monotonic() + seconds
+
+    async def worker(n: int):
+        nonlocal errors
+        rng = random.Random(n)
+        while time.monotonic() < deadline:
+            auth = rng.choice(headers)
+            if rng.random() >= write_ratio:
+                kind, request = "read", client.get("/posts", params={"limit": 20}, headers=auth)
+            elif rng.random() < 0.5 or not post_ids:
+                kind, request = "post", client.post("/posts", json={"content": "benchmark"}, headers=auth)
+            else:
+                kind, request = "reaction", client.post("/reactions", json={"post_id": rng.choice(post_ids[-200:]),
+                                                                            "type": rng.choice(("like", "love"))},
+                                                        headers=auth)
+            start = time.perf_counter()
+            try:
+                response = await request
+                response.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies[kind].append(time.perf_counter() - start)
+            if kind == "post":
+                post_ids.append(response.json()["id"])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    reads = len(latencies["read"])
+    writes = len(latencies["post"]) + len(latencies["reaction"])
+    result: Dict[str, Any] = {
+        "reads_per_s": round(reads / elapsed, 1),
+        "writes_per_s": round(writes / elapsed, 1),
+        "errors": errors,
+    }
+    for kind, values in latencies.items():
+        if values:
+            result[kind] = summarize(values)
+    return result
+
+
+async def bench(api_url: str, args) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=max(args.levels) + 4)
+    async with httpx.AsyncClient(base_url=api_url, timeout=args.timeout, limits=limits) as client:
+        headers = await setup(client, args.users)
+        post_ids: List[int] = []
+        results = {}
+        for level in args.levels:
+            print(f"c{level}...")
+            results[f"c{level}"] = await run_level(client, headers, post_ids, level, args.seconds, args.write_ratio)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="users taking part, all friends with each other")
+    parser.add_argument("--seconds", type=float, default=10, help="duration of each concurrency level")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated numbers of concurrent clients")
+    parser.add_argument("--write-ratio", type=float, default=0.2, help="share of requests that write")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds before a request counts as an error")
+    parser.add_argument("--output", default=f"db-benchmark-{git_commit()}.json")
+    parser.add_argument("--baseline", help="earlier results file to compare with")
+    args = parser.parse_args()
+    args.levels = [int(c) for c in args.concurrency.split(",") if c]
+
+    work_dir = tempfile.mkdtemp(prefix="alexdownloader-dbbench-")
+    process, api_url = start_api(work_dir)
+    try:
+        results: Dict[str, Any] = {
+            "meta": {
+                "commit": git_commit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "users": args.users,
+                "seconds": args.seconds,
+                "write_ratio": args.write_ratio,
+                "settings": {name: os.getenv(name) for name in SETTINGS_ENV if os.getenv(name)},
+            },
+            "levels": asyncio.run(bench(api_url, args)),
+        }
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+from yt_dlp.extractor.common import InfoExtractor
+from yt_dlp.networking import HEADRequest
+from yt_dlp.utils import int_or_none
+
+
+class BenchIE(InfoExtractor):
+    """Resolves ``MediaServer`` page URLs, like a site extractor would.
+
+    Metadata comes from the server's meta.json and the HLS/DASH manifests are
+    parsed by yt-dlp, so extraction does real (local) requests.
+    """
+
+    IE_NAME = "bench"
+    _VALID_URL = r"(?P<base>https?://127\.0\.0\.1:\d+)/bench/(?P<kind>mp4|hls|dash)/(?P<id>[\w-]+)"
+
+    def _real_extract(self, url):
+        base, kind, video_id = self._match_valid_url(url).group("base", "kind", "id")
+        meta = self._download_json(f"{base}/meta.json", video_id)
+
+        if kind == "mp4":
+            media_url = f"{base}/mp4/media.mp4"
+            head = self._request_webpage(HEADRequest(media_url), video_id, note="Checking media size")
+            formats = [{
+                "format_id": "mp4",
+                "url": media_url,
+                "ext": "mp4",
+                "vcodec": "avc1",
+                "acodec": "mp4a.40.2",
+                "width": meta["width"],
+                "height": meta["height"],
+                "filesize": int_or_none(head.headers.get("Content-Length")),
+            }]
+        elif kind == "hls":
+            formats = self._extract_m3u8_formats(f"{base}/hls/index.m3u8", video_id, "mp4", m3u8_id="hls")
+        else:
+            formats = self._extract_mpd_formats(f"{base}/dash/manifest.mpd", video_id, mpd_id="dash")
+
+        return {
+            "id": f"{kind}-{video_id}",
+            "title": f"Benchmark {kind} {video_id}",
+            "duration": meta["duration"],
+            "thumbnail": f"{base}/thumb.jpg",
+            "formats": formats,
+        }
+
+
+class StaticIE(InfoExtractor):
+    """Returns a fixed info dict without any request, so only yt-dlp's own overhead is timed."""
+
+    IE_NAME = "bench:static"
+    _VALID_URL = r"https?://bench\.invalid/static/(?P<id>[\w-]+)"
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        formats = [{
+            "format_id": f"{height}p",
+            "url": f"https://bench.invalid/media/{video_id}/{height}.mp4",
+            "ext": "mp4",
+            "vcodec": "avc1",
+            "acodec": "mp4a.40.2",
+            "width": height * 16 // 9,
+            "height": height,
+            "filesize": height * 20_000,
+        } for height in (240, 360, 480, 720, 1080)]
+        formats.append({
+            "format_id": "audio",
+            "url": f"https://bench.invalid/media/{video_id}/audio.m4a",
+            "ext": "m4a",
+            "vcodec": "none",
+            "acodec": "mp4a.40.2",
+            "filesize": 1_000_000,
+        })
+        return {
+            "id": video_id,
+            "title": f"Benchmark static {video_id}",
+            "duration": 60,
+            "formats": formats,
+        }
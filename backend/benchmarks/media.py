@@ -0,0 +1,74 @@
+import functools
+import json
+import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from ffmpeg_tools import run_ffmpeg
+
+WIDTH, HEIGHT = 1280, 720
+SEGMENT_SECONDS = 2
+
+
+def generate_media(root: str, duration: int = 30) -> str:
+    """Write synthetic test media served by ``MediaServer`` into ``root``.
+
+    One encode (720p noise so the bitrate stays realistic, 440Hz tone) is
+    repackaged as progressive mp4, HLS and DASH. Reused when already there.
+    """
+    meta_path = os.path.join(root, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f).get("duration") == duration:
+                return root
+    for sub in ("mp4", "hls", "dash"):
+        os.makedirs(os.path.join(root, sub), exist_ok=True)
+
+    master = os.path.join(root, "mp4", "media.mp4")
+    run_ffmpeg([
+        "-f", "lavfi", "-i", f"testsrc2=size={WIDTH}x{HEIGHT}:rate=30:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        "-vf", "noise=alls=20:allf=t",
+        "-c:v", "libx264", "-preset", "veryfast", "-b:v", "3M", "-g", str(30 * SEGMENT_SECONDS),
+        "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart", master,
+    ])
+    run_ffmpeg([
+        "-i", master, "-c", "copy", "-f", "hls", "-hls_time", str(SEGMENT_SECONDS), "-hls_playlist_type", "vod",
+        "-hls_segment_filename", os.path.join(root, "hls", "seg_%03d.ts"), os.path.join(root, "hls", "index.m3u8"),
+    ])
+    run_ffmpeg([
+        "-i", master, "-map", "0:v", "-map", "0:a", "-c", "copy", "-f", "dash", "-seg_duration", str(SEGMENT_SECONDS),
+        "-use_template", "1", "-use_timeline", "1", "-adaptation_sets", "id=0,streams=v id=1,streams=a",
+        os.path.join(root, "dash", "manifest.mpd"),
+    ])
+    run_ffmpeg(["-i", master, "-frames:v", "1", os.path.join(root, "thumb.jpg")])
+
+    with open(meta_path, "w") as f:
+        json.dump({"duration": duration, "width": WIDTH, "height": HEIGHT}, f)
+    return root
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaServer:
+    """Static HTTP server for the generated media, on a free local port."""
+
+    def __init__(self, root: str):
+        handler = functools.partial(_QuietHandler, directory=root)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self) -> "MediaServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def url(self, kind: str, media_id: str) -> str:
+        """Page URL the benchmark extractor resolves, ``kind`` is mp4, hls or dash."""
+        return f"{self.base_url}/bench/{kind}/{media_id}"
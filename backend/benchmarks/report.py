@@ -0,0 +1,46 @@
+import os
+import statistics
+import subprocess
+from typing import Any, Dict, List
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    return {
+        "n": len(values),
+        "mean_s": round(statistics.fmean(values), 4),
+        "p50_s": round(statistics.median(values), 4),
+        "p95_s": round(values[round(0.95 * (len(values) - 1))], 4),
+        "max_s": round(values[-1], 4),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and key != "n":
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]):
+    """Print each metric next to its baseline value."""
+    current = flatten({k: v for k, v in results.items() if k != "meta"})
+    previous = flatten({k: v for k, v in baseline.items() if k != "meta"})
+    print(f"\nCompared with {baseline.get('meta', {}).get('commit', 'baseline')}:")
+    for key in sorted(current):
+        if previous.get(key):
+            change = (current[key] - previous[key]) / previous[key] * 100
+            print(f"  {key:45} {previous[key]:>10} -> {current[key]:>10}  ({change:+.1f}%)")
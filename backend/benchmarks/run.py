@@ -0,0 +1,197 @@
+"""Offline end-to-end benchmark of the download pipeline.
+
+Serves synthetic mp4/HLS/DASH media from a local HTTP server (generated with
+ffmpeg on first run) and resolves it with a stub extractor, so no network
+access is needed. Run from backend/:
+
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --output after.json --baseline before.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix="alexdownloader-bench-")
+# Every run starts from empty caches, kept apart from the real ones
+os.environ["MEDIA_CACHE_DIR"] = os.path.join(WORK_DIR, "cache")
+os.environ["THUMBNAIL_CACHE_DIR"] = os.path.join(WORK_DIR, "thumbnails")
+os.environ["SCRATCH_DIR"] = os.path.join(WORK_DIR, "scratch")
+sys.path.insert(0, BACKEND_DIR)
+
+import httpx
+import uvicorn
+import yt_dlp
+from benchmarks.extractor import BenchIE
+from benchmarks.media import MediaServer, generate_media
+from benchmarks.report import compare, git_commit, summarize
+from downloader import downloader
+
+KINDS = ("mp4", "hls", "dash")
+# Settings that change the results, recorded next to them
+SETTINGS_ENV = ("DOWNLOAD_BANDWIDTH_MBPS", "CONCURRENT_FRAGMENTS", "MAX_CONNECTIONS_PER_HOST", "FIT_WORKERS", "FFMPEG_DIR")
+
+
+def fresh_id() -> str:
+    # A new media id per measurement, so nothing is answered from a cache
+    return uuid.uuid4().hex[:12]
+
+
+def bench_extraction(server: MediaServer, kinds, reps: int) -> Dict[str, Any]:
+    results = {}
+    for kind in kinds:
+        times = []
+        for _ in range(reps):
+            start = time.perf_counter()
+            downloader.extract_info(server.url(kind, fresh_id()))
+            times.append(time.perf_counter() - start)
+        results[kind] = summarize(times)
+    return results
+
+
+def bench_download(server: MediaServer, kinds, reps: int) -> Dict[str, Any]:
+    """Transfer and post-processing time of ``download_media``, split at the last finished format."""
+    results = {}
+    for kind in kinds:
+        download_times, postprocess_times, throughputs = [], [], []
+        for _ in range(reps):
+            url = server.url(kind, fresh_id())
+            info = downloader.extract_info(url)
+            finished = []
+
+            def hook(d):
+                if d["status"] == "finished":
+                    finished.append((time.perf_counter(), d.get("total_bytes") or d.get("downloaded_bytes") or 0))
+
+            output_dir = tempfile.mkdtemp(dir=WORK_DIR)
+            start = time.perf_counter()
+            downloader.download_media(url, "video", info=info, progress_hook=hook, output_dir=output_dir)
+            end = time.perf_counter()
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+            downloaded_at = finished[-1][0]
+            size = sum(b for _, b in finished)
+            download_times.append(downloaded_at - start)
+            postprocess_times.append(end - downloaded_at)
+            throughputs.append(size * 8 / 1_000_000 / (downloaded_at - start))
+        results[kind] = {
+            "download": summarize(download_times),
+            "postprocess": summarize(postprocess_times),
+            "throughput_mbps": round(statistics.fmean(throughputs), 2),
+        }
+    return results
+
+
+def timed_requests(api_url: str, urls: List[str]) -> Dict[str, Any]:
+    """POST /downloader/download for all ``urls`` at once, including reading the file."""
+    def request(url: str) -> float:
+        start = time.perf_counter()
+        with httpx.Client(timeout=600) as client:
+            client.post(f"{api_url}/downloader/download", params={"url": url}).raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        latencies = list(pool.map(request, urls))
+    return {**summarize(latencies), "wall_s": round(time.perf_counter() - start, 4)}
+
+
+def bench_endpoint(api_url: str, server: MediaServer, kinds, levels: List[int]) -> Dict[str, Any]:
+    results = {}
+    for kind in kinds:
+        results[kind] = {}
+        for level in levels:
+            urls = [server.url(kind, fresh_id()) for _ in range(level)]
+            results[kind][f"c{level}"] = {
+                "cold": timed_requests(api_url, urls),
+                # Same URLs again, answered from the info and media caches
+                "warm": timed_requests(api_url, urls),
+            }
+    return results
+
+
+def start_api() -> tuple:
+    # Imported here so the app's sqlite file is created in the work dir
+    from main import app
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=int, default=30, help="length of the synthetic media in seconds")
+    parser.add_argument("--reps", type=int, default=3, help="repetitions of the extraction and download measurements")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="comma separated request counts for the endpoint")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="comma separated subset of mp4,hls,dash")
+    parser.add_argument("--media-dir", default=os.path.join(tempfile.gettempdir(), "alexdownloader-bench-media"),
+                        help="where the synthetic media is generated and reused from")
+    parser.add_argument("--output", default=f"benchmark-{git_commit()}.json")
+    parser.add_argument("--baseline", help="earlier results file to compare with")
+    args = parser.parse_args()
+
+    kinds = [k for k in args.kinds.split(",") if k]
+    levels = [int(c) for c in args.concurrency.split(",") if c]
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print("Generating media...")
+    media_root = generate_media(args.media_dir, args.duration)
+    downloader.extractors.append(BenchIE)
+    os.chdir(WORK_DIR)
+
+    results: Dict[str, Any] = {
+        "meta": {
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "yt_dlp": yt_dlp.version.__version__,
+            "cpus": os.cpu_count(),
+            "duration": args.duration,
+            "reps": args.reps,
+            "settings": {name: os.getenv(name) for name in SETTINGS_ENV if os.getenv(name)},
+        },
+    }
+    try:
+        with MediaServer(media_root) as server:
+            print("Extraction...")
+            results["extraction"] = bench_extraction(server, kinds, args.reps)
+            print("Download and post-processing...")
+            results["download"] = bench_download(server, kinds, args.reps)
+            print("/downloader/download...")
+            api, api_url = start_api()
+            try:
+                results["endpoint"] = bench_endpoint(api_url, server, kinds, levels)
+            finally:
+                api.should_exit = True
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Worker start-up time and per-call yt-dlp overhead.
+
+Imports the API in fresh interpreters (is yt-dlp loaded, how long does it
+take), then times info extraction and format selection with a YoutubeDL
+built for every call against one checked out of the pool. The extractor
+returns a fixed result without any request, so only the overhead is
+measured. Run from backend/:
+
+    python -m benchmarks.startup --output startup-before.json
+    python -m benchmarks.startup --output startup-after.json --baseline startup-before.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+from benchmarks.report import BACKEND_DIR, compare, git_commit, summarize
+
+WORK_DIR = tempfile.mkdtemp(prefix="alexdownloader-startup-")
+# Caches, database and downloads of the benchmark stay in the work directory
+os.environ["MEDIA_CACHE_DIR"] = os.path.join(WORK_DIR, "cache")
+os.environ["THUMBNAIL_CACHE_DIR"] = os.path.join(WORK_DIR, "thumbnails")
+os.environ["SCRATCH_DIR"] = os.path.join(WORK_DIR, "scratch")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(WORK_DIR, 'database.db')}")
+
+# Runs in a fresh interpreter, prints the import time and whether yt-dlp was loaded
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start, "yt_dlp": "yt_dlp" in sys.modules}}))
+"""
+# Import of the downloader up to its first extracted info, as the first request of a worker sees it
+FIRST_CALL_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from downloader import downloader
+from benchmarks.extractor import StaticIE
+downloader.extractors.append(StaticIE)
+downloader.extract_info("https://bench.invalid/static/first")
+print(json.dumps({"seconds": time.perf_counter() - start, "yt_dlp": True}))
+"""
+
+
+def run_script(script: str, runs: int) -> Dict[str, Any]:
+    env = {**os.environ, "PYTHONPATH": BACKEND_DIR}
+    seconds, loaded = [], False
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", script], cwd=WORK_DIR, env=env, capture_output=True,
+                                text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        seconds.append(result["seconds"])
+        loaded = loaded or result["yt_dlp"]
+    return {**summarize(seconds), "yt_dlp_loaded": int(loaded)}
+
+
+def time_calls(call: Callable[[int], Any], calls: int) -> Dict[str, float]:
+    # The first call imports yt-dlp and loads the extractors, it's not counted
+    call(-1)
+    seconds: List[float] = []
+    for i in range(calls):
+        start = time.perf_counter()
+        call(i)
+        seconds.append(time.perf_counter() - start)
+    return summarize(seconds)
+
+
+def bench_calls(calls: int) -> Dict[str, Any]:
+    sys.path.insert(0, BACKEND_DIR)
+    from benchmarks.extractor import StaticIE
+    from downloader import YDL_PROFILES, downloader
+    from streaming import STREAM_FORMATS, plan_stream
+
+    downloader.extractors.append(StaticIE)
+
+    def url(i: int) -> str:
+        return f"https://bench.invalid/static/{i}"
+
+    def fresh_info(i: int):
+        with downloader._ydl(dict(YDL_PROFILES["info"])) as ydl:
+            return ydl.extract_info(url(i), download=False)
+
+    def pooled_info(i: int):
+        with downloader.ydl_pool.checkout("info") as ydl:
+            return ydl.extract_info(url(i), download=False)
+
+    info = pooled_info(0)
+
+    def fresh_select(i: int):
+        with downloader._ydl({**YDL_PROFILES["info"], "format": STREAM_FORMATS["video"]}) as ydl:
+            return ydl.process_ie_result(dict(info), download=False)
+
+    def pooled_select(i: int):
+        return plan_stream(dict(info), "video")
+
+    return {
+        "info": {"fresh": time_calls(fresh_info, calls), "pooled": time_calls(pooled_info, calls)},
+        "select": {"fresh": time_calls(fresh_select, calls), "pooled": time_calls(pooled_select, calls)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per import measurement")
+    parser.add_argument("--calls", type=int, default=50, help="timed calls per mode")
+    parser.add_argument("--output", default=f"startup-benchmark-{git_commit()}.json")
+    parser.add_argument("--baseline", help="earlier results file to compare with")
+    args = parser.parse_args()
+
+    try:
+        results: Dict[str, Any] = {
+            "meta": {
+                "commit": git_commit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "runs": args.runs,
+                "calls": args.calls,
+            },
+            "import": {
+                "main": run_script(IMPORT_SCRIPT.format(module="main"), args.runs),
+                "downloader": run_script(IMPORT_SCRIPT.format(module="downloader"), args.runs),
+                "first_info": run_script(FIRST_CALL_SCRIPT, args.runs),
+            },
+            "calls": bench_calls(args.calls),
+        }
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results["import"], indent=2))
+    print(json.dumps(results["calls"], indent=2))
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import asyncio
+import contextvars
+import functools
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from metrics import Gauge
+
+# Downloads processed at the same time across all chats
+BOT_MAX_CONCURRENT = int(os.getenv("BOT_MAX_CONCURRENT", "4"))
+# Downloads of a single chat processed at the same time
+BOT_MAX_PER_CHAT = int(os.getenv("BOT_MAX_PER_CHAT", "1"))
+# Requests of a single chat that may wait or run before new ones are refused
+BOT_MAX_QUEUED_PER_CHAT = int(os.getenv("BOT_MAX_QUEUED_PER_CHAT", "3"))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ShuttingDown(Exception):
+    pass
+
+
+class DownloadScheduler:
+    """Admission control for bot downloads.
+
+    Blocking work runs in a thread pool so the bot's event loop keeps serving
+    other updates. Slots are handed out in arrival order, skipping requests of
+    chats that already use their per-chat share, so one chat sending many
+    links cannot hold up everybody else.
+    """
+
+    def __init__(self, max_concurrent: int = BOT_MAX_CONCURRENT, max_per_chat: int = BOT_MAX_PER_CHAT,
+                 max_queued_per_chat: int = BOT_MAX_QUEUED_PER_CHAT):
+        self.max_concurrent = max_concurrent
+        self.max_per_chat = max_per_chat
+        self.max_queued_per_chat = max_queued_per_chat
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent * 2, thread_name_prefix="bot-download")
+        self._waiting: List[Any] = []
+        self._running: Dict[Any, int] = defaultdict(int)
+        self._pending: Dict[Any, int] = defaultdict(int)
+        self._active = 0
+        self._closing = False
+        self._cond: Optional[asyncio.Condition] = None
+
+    @property
+    def cond(self) -> asyncio.Condition:
+        # Created lazily so it binds to the loop the bot runs on
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def _next_eligible(self):
+        for ticket in self._waiting:
+            if self._running[ticket[1]] < self.max_per_chat:
+                return ticket
+        return None
+
+    @asynccontextmanager
+    async def slot(self, chat_id: Any, on_position: Optional[Callable[[int], Awaitable[None]]] = None):
+        """Wait for a download slot; ``on_position`` is awaited when the queue position changes."""
+        if self._closing:
+            raise ShuttingDown()
+        if self._pending[chat_id] >= self.max_queued_per_chat:
+            raise QueueFull()
+
+        ticket = (object(), chat_id)
+        self._pending[chat_id] += 1
+        self._waiting.append(ticket)
+        started = False
+        try:
+            reported = None
+            while True:
+                async with self.cond:
+                    if self._active < self.max_concurrent and self._next_eligible() is ticket:
+                        self._waiting.remove(ticket)
+                        self._running[chat_id] += 1
+                        self._active += 1
+                        started = True
+                        break
+                    position = self._waiting.index(ticket) + 1
+                    if position == reported or on_position is None:
+                        await self.cond.wait()
+                        continue
+                reported = position
+                await on_position(position)
+            yield
+        finally:
+            async with self.cond:
+                if started:
+                    self._running[chat_id] -= 1
+                    self._active -= 1
+                else:
+                    self._waiting.remove(ticket)
+                self._pending[chat_id] -= 1
+                if not self._pending[chat_id]:
+                    del self._pending[chat_id]
+                    self._running.pop(chat_id, None)
+                self.cond.notify_all()
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Run a blocking call in the download pool."""
+        loop = asyncio.get_running_loop()
+        # Run in a copy of the caller's context so its trace collects the spans
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, func, *args, **kwargs))
+
+    async def shutdown(self, timeout: Optional[float] = None):
+        """Refuse new requests and wait for queued and running ones to finish."""
+        self._closing = True
+        try:
+            async with self.cond:
+                await asyncio.wait_for(self.cond.wait_for(lambda: not self._pending), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.executor.shutdown(wait=False)
+
+
+scheduler = DownloadScheduler()
+
+Gauge("bot_downloads", "Bot downloads running and waiting for a slot", ("state",),
+      collect=lambda: {("active",): scheduler.active, ("queued",): scheduler.queued})
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import delete, func, union
+from sqlmodel import Session, select
+from database import async_session
+from metrics import Counter, Gauge
+from models import Comment, PostCounter, Reaction
+from schemas import PostCounts
+
+# Seconds between two writes of the buffered counts
+COUNTER_FLUSH_INTERVAL = float(os.getenv("COUNTER_FLUSH_INTERVAL", "2"))
+# Seconds between two recounts from the comment and reaction tables, 0 disables them
+COUNTER_RECONCILE_INTERVAL = float(os.getenv("COUNTER_RECONCILE_INTERVAL", "3600"))
+# Posts recounted per transaction
+COUNTER_RECONCILE_BATCH = int(os.getenv("COUNTER_RECONCILE_BATCH", "500"))
+
+logger = logging.getLogger(__name__)
+
+COUNTER_FLUSHED = Counter("post_counter_rows_flushed_total", "Counter rows written by flushes")
+COUNTER_REPAIRED = Counter("post_counter_rows_repaired_total", "Counter rows corrected by reconciliation")
+
+Key = Tuple[int, str]
+
+
+def reaction_kind(reaction_type: str) -> str:
+    return f"reaction:{reaction_type}"
+
+
+def _upsert(dialect: str):
+    """Adds the ``total`` of each row to the stored one, inserting missing rows."""
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(PostCounter)
+        return statement.on_duplicate_key_update(total=PostCounter.total + statement.inserted.total)
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    statement = insert(PostCounter)
+    return statement.on_conflict_do_update(index_elements=["post_id", "kind"],
+                                           set_={"total": PostCounter.total + statement.excluded.total})
+
+
+class CounterStore:
+    """Comment and reaction counts per post, written behind.
+
+    Changes add up in memory and are written as one upsert per flush however
+    many taps they come from. Reads add the changes not flushed yet to the
+    stored counts.
+    """
+
+    def __init__(self):
+        self.pending: Dict[Key, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._tasks: List[asyncio.Task] = []
+
+    def add(self, post_id: int, kind: str, delta: int = 1):
+        with self._lock:
+            self.pending[(post_id, kind)] += delta
+
+    def comment_added(self, post_id: int):
+        self.add(post_id, "comment")
+
+    def reaction_changed(self, post_id: int, previous: Optional[str], current: Optional[str]):
+        if previous == current:
+            return
+        with self._lock:
+            if previous:
+                self.pending[(post_id, reaction_kind(previous))] -= 1
+            if current:
+                self.pending[(post_id, reaction_kind(current))] += 1
+
+    def _take(self, post_ids: Optional[Iterable[int]] = None) -> Dict[Key, int]:
+        """Remove and return the pending changes (of ``post_ids`` only if given)."""
+        with self._lock:
+            if post_ids is None:
+                pending, self.pending = self.pending, defaultdict(int)
+            else:
+                post_ids = set(post_ids)
+                pending = {key: self.pending.pop(key) for key in list(self.pending) if key[0] in post_ids}
+        return {key: delta for key, delta in pending.items() if delta}
+
+    async def flush(self):
+        pending = self._take()
+        if not pending:
+            return
+        rows = [{"post_id": post_id, "kind": kind, "total": delta} for (post_id, kind), delta in pending.items()]
+        try:
+            async with async_session() as db:
+                await db.exec(_upsert(db.bind.dialect.name), params=rows)
+                await db.commit()
+        except Exception:
+            # Kept for the next flush
+            with self._lock:
+                for key, delta in pending.items():
+                    self.pending[key] += delta
+            raise
+        COUNTER_FLUSHED.inc(len(rows))
+
+    def load(self, db: Session, post_ids: Iterable[int]) -> Dict[int, PostCounts]:
+        """Counts of many posts with one query, posts without any count included."""
+        post_ids = list(dict.fromkeys(post_ids))
+        totals: Dict[Key, int] = defaultdict(int)
+        if post_ids:
+            for post_id, kind, total in db.exec(select(PostCounter.post_id, PostCounter.kind, PostCounter.total)
+                                                .where(PostCounter.post_id.in_(post_ids))).all():
+                totals[(post_id, kind)] += total
+        wanted = set(post_ids)
+        with self._lock:
+            for (post_id, kind), delta in self.pending.items():
+                if post_id in wanted:
+                    totals[(post_id, kind)] += delta
+
+        counts = {post_id: PostCounts(post_id=post_id, reactions={}) for post_id in post_ids}
+        for (post_id, kind), total in totals.items():
+            if total <= 0 or post_id not in counts:
+                continue
+            if kind == "comment":
+                counts[post_id].comment_count = total
+            else:
+                counts[post_id].reactions[kind.split(":", 1)[1]] = total
+                counts[post_id].reaction_count += total
+        return counts
+
+    async def reconcile(self):
+        """Recount from the comment and reaction tables and repair the rows that drifted.
+
+        Changes made while a batch is recounted, or still buffered by other
+        workers, can be counted twice until the next reconciliation.
+        """
+        await self.flush()
+        after = 0
+        while True:
+            async with async_session() as db:
+                rows = (await db.exec(union(
+                    select(PostCounter.post_id).where(PostCounter.post_id > after),
+                    select(Comment.post_id).where(Comment.post_id > after),
+                    select(Reaction.post_id).where(Reaction.post_id > after),
+                ).order_by("post_id").limit(COUNTER_RECONCILE_BATCH))).all()
+                if not rows:
+                    return
+                post_ids = [row.post_id for row in rows]
+                # The recount includes the changes still buffered here
+                self._take(post_ids)
+                actual: Dict[Key, int] = {}
+                for post_id, total in (await db.exec(select(Comment.post_id, func.count()).where(
+                        Comment.post_id.in_(post_ids)).group_by(Comment.post_id))).all():
+                    actual[(post_id, "comment")] = total
+                for post_id, reaction_type, total in (await db.exec(select(Reaction.post_id, Reaction.type, func.count()).where(
+                        Reaction.post_id.in_(post_ids)).group_by(Reaction.post_id, Reaction.type))).all():
+                    actual[(post_id, reaction_kind(reaction_type))] = total
+                stored = {(row.post_id, row.kind): row for row in (await db.exec(
+                    select(PostCounter).where(PostCounter.post_id.in_(post_ids)))).all()}
+
+                repaired = 0
+                for key, row in stored.items():
+                    if key not in actual:
+                        await db.exec(delete(PostCounter).where(PostCounter.post_id == key[0], PostCounter.kind == key[1]))
+                        repaired += 1
+                    elif row.total != actual[key]:
+                        row.total = actual[key]
+                        db.add(row)
+                        repaired += 1
+                for key, total in actual.items():
+                    if key not in stored:
+                        db.add(PostCounter(post_id=key[0], kind=key[1], total=total))
+                        repaired += 1
+                await db.commit()
+            if repaired:
+                COUNTER_REPAIRED.inc(repaired)
+                logger.info(f"Repaired {repaired} post counters")
+            after = post_ids[-1]
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._every(COUNTER_FLUSH_INTERVAL, self.flush))]
+        if COUNTER_RECONCILE_INTERVAL > 0:
+            # First run right away, it also fills the table for posts from before counters existed
+            self._tasks.append(asyncio.create_task(self._every(COUNTER_RECONCILE_INTERVAL, self.reconcile, now=True)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await self.flush()
+
+    @staticmethod
+    async def _every(interval: float, job, now: bool = False):
+        if not now:
+            await asyncio.sleep(interval)
+        while True:
+            try:
+                await job()
+            except Exception as e:
+                logger.error(f"{job.__name__} of post counters failed: {e}")
+            await asyncio.sleep(interval)
+
+
+counter_store = CounterStore()
+
+Gauge("post_counter_pending", "Counter changes waiting for the next flush",
+      collect=lambda: {(): len(counter_store.pending)})
@@ -0,0 +1,206 @@
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from urllib.parse import urlsplit
+from metrics import DOWNLOADED_BYTES, Gauge
+
+# Cap on the combined download speed of all jobs in megabits per second, 0 disables it
+DOWNLOAD_BANDWIDTH_MBPS = float(os.getenv("DOWNLOAD_BANDWIDTH_MBPS", "0"))
+# Connections opened to one media host at the same time, across all jobs
+MAX_CONNECTIONS_PER_HOST = int(os.getenv("MAX_CONNECTIONS_PER_HOST", "8"))
+# HLS/DASH fragments a single job fetches in parallel (when the host has room)
+CONCURRENT_FRAGMENTS = int(os.getenv("CONCURRENT_FRAGMENTS", "4"))
+# Share of the bandwidth each priority class gets when both are waiting
+PRIORITY_WEIGHTS = {
+    "bot": float(os.getenv("BANDWIDTH_WEIGHT_BOT", "2")),
+    "api": float(os.getenv("BANDWIDTH_WEIGHT_API", "1")),
+}
+
+# Bytes that can be spent at once after an idle period, in seconds of the rate
+BURST_SECONDS = 1.0
+FRAGMENTED_PROTOCOLS = ("m3u8", "m3u8_native", "http_dash_segments", "dash_frag_urls", "ism", "f4m")
+
+
+class TokenBucket:
+    """Bandwidth shared by all downloads, in bytes per second.
+
+    Waiters of the class that received the least (relative to its weight) are
+    served first, and each class serves its waiters in order, so one large
+    job can't take the whole link while others wait.
+    """
+
+    def __init__(self, rate: float, weights: Dict[str, float] = PRIORITY_WEIGHTS):
+        self.rate = rate
+        self.capacity = rate * BURST_SECONDS
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.weights = weights
+        self.served = {name: 0.0 for name in weights}
+        self.last_seen = {name: 0.0 for name in weights}
+        self.waiting: Dict[str, deque] = {name: deque() for name in weights}
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _next(self) -> Optional[object]:
+        active = [name for name, queue in self.waiting.items() if queue]
+        if not active:
+            return None
+        return self.waiting[min(active, key=lambda name: self.served[name])][0]
+
+    def consume(self, amount: int, priority: str = "api"):
+        """Block until ``amount`` bytes may be transferred."""
+        if self.rate <= 0 or amount <= 0:
+            return
+        # A block larger than the burst still gets through, it just empties the bucket
+        amount = min(amount, self.capacity)
+        ticket = object()
+        with self._cond:
+            queue = self.waiting[priority]
+            if not queue and time.monotonic() - self.last_seen[priority] > BURST_SECONDS:
+                # A class coming back from idle doesn't get credit for the time it was away
+                others = [self.served[name] for name, q in self.waiting.items() if q]
+                if others:
+                    self.served[priority] = max(self.served[priority], min(others))
+            queue.append(ticket)
+            try:
+                while True:
+                    self._refill()
+                    if self._next() is ticket:
+                        if self.tokens >= amount:
+                            self.tokens -= amount
+                            self.served[priority] += amount / self.weights[priority]
+                            return
+                        self._cond.wait((amount - self.tokens) / self.rate)
+                    else:
+                        self._cond.wait(0.5)
+            finally:
+                queue.remove(ticket)
+                self.last_seen[priority] = time.monotonic()
+                self._cond.notify_all()
+
+
+class HostLimiter:
+    """Number of open connections per media host."""
+
+    def __init__(self, limit: int = MAX_CONNECTIONS_PER_HOST):
+        self.limit = limit
+        self.active: Dict[str, int] = defaultdict(int)
+        self._cond = threading.Condition()
+
+    def acquire(self, host: str, wanted: int) -> int:
+        """Wait for at least one free connection, returns how many were granted (up to ``wanted``)."""
+        with self._cond:
+            while self.active[host] >= self.limit:
+                self._cond.wait()
+            granted = min(wanted, self.limit - self.active[host])
+            self.active[host] += granted
+            return granted
+
+    def release(self, host: str, count: int):
+        with self._cond:
+            self.active[host] -= count
+            if self.active[host] <= 0:
+                del self.active[host]
+            self._cond.notify_all()
+
+
+def selected_formats(info: Dict[str, Any], format_spec: str) -> List[Dict[str, Any]]:
+    """Formats ``format_spec`` will most likely download.
+
+    Exact when the spec lists format ids (as planned downloads do), otherwise
+    the best listed format stands in for the selector's choice.
+    """
+    formats = info.get("formats") or []
+    by_id = {f.get("format_id"): f for f in formats}
+    ids = format_spec.split("/")[0].split("+")
+    if all(i in by_id for i in ids):
+        return [by_id[i] for i in ids]
+    return formats[-1:] or [info]
+
+
+class Transfer:
+    """Bandwidth and connection accounting of one yt-dlp download."""
+
+    def __init__(self, engine: "DownloadEngine", hosts: Dict[str, int], priority: str):
+        self.engine = engine
+        self.hosts = hosts
+        self.priority = priority
+        self.fragments = min(hosts.values()) if hosts else 1
+        self._seen: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def progress_hook(self, d: Dict[str, Any]):
+        # Called from the download threads after each block, sleeping here
+        # slows down that transfer
+        if d.get("status") != "downloading":
+            return
+        name = d.get("tmpfilename") or d.get("filename") or ""
+        downloaded = d.get("downloaded_bytes") or 0
+        with self._lock:
+            delta = downloaded - self._seen.get(name, 0)
+            self._seen[name] = max(downloaded, self._seen.get(name, 0))
+        if delta > 0:
+            DOWNLOADED_BYTES.inc(delta, priority=self.priority)
+            self.engine.bucket.consume(delta, self.priority)
+
+    def release(self):
+        with self._lock:
+            hosts, self.hosts = self.hosts, {}
+        for host, count in hosts.items():
+            self.engine.hosts.release(host, count)
+
+    def ydl_opts(self, progress_hook: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """Options to merge into the ``YoutubeDL`` params of this download."""
+        hooks = [progress_hook] if progress_hook else []
+        return {
+            'concurrent_fragment_downloads': self.fragments,
+            'progress_hooks': hooks + [self.progress_hook],
+        }
+
+
+class DownloadEngine:
+    def __init__(self, bandwidth_mbps: float = DOWNLOAD_BANDWIDTH_MBPS, per_host: int = MAX_CONNECTIONS_PER_HOST,
+                 fragments: int = CONCURRENT_FRAGMENTS):
+        self.bucket = TokenBucket(bandwidth_mbps * 1_000_000 / 8)
+        self.hosts = HostLimiter(per_host)
+        self.fragments = fragments
+
+    @contextmanager
+    def transfer(self, info: Dict[str, Any], format_spec: str, priority: str = "api") -> Iterator[Transfer]:
+        """Reserve connections to the hosts a download will use, for the duration of the block."""
+        if priority not in PRIORITY_WEIGHTS:
+            raise ValueError(f"priority must be one of {', '.join(PRIORITY_WEIGHTS)}")
+        formats = selected_formats(info, format_spec)
+        wanted = self.fragments if any(f.get("protocol") in FRAGMENTED_PROTOCOLS for f in formats) else 1
+        hosts: Dict[str, int] = {}
+        transfer = Transfer(self, hosts, priority)
+        try:
+            # Sorted so two jobs never wait on each other's hosts
+            for host in sorted({urlsplit(f.get("url") or "").hostname or "" for f in formats}):
+                hosts[host] = self.hosts.acquire(host, wanted)
+            transfer.fragments = min(hosts.values()) if hosts else 1
+            yield transfer
+        finally:
+            transfer.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "bandwidth_limit_bytes": self.bucket.rate or None,
+            "connections": dict(self.hosts.active),
+            "fragments_per_job": self.fragments,
+        }
+
+
+download_engine = DownloadEngine()
+
+Gauge("host_connections", "Connections reserved on each media host", ("host",),
+      collect=lambda: {(host,): count for host, count in dict(download_engine.hosts.active).items()})
+Gauge("bandwidth_waiters", "Transfers waiting for bandwidth", ("priority",),
+      collect=lambda: {(name,): len(queue) for name, queue in download_engine.bucket.waiting.items()})
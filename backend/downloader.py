@@ -1,140 +1,335 @@
-import yt_dlp
+import json
+import logging
 import os
+import shutil
 import tempfile
 import uuid
-from typing import Dict, Any, Optional
-# FFmpeg configuration
-# On server (Linux), ffmpeg is usually in the PATH. On Windows, we use the local path.
-ENV_FFMPEG_DIR = os.getenv("FFMPEG_DIR")
-if ENV_FFMPEG_DIR:
-    FFMPEG_DIR = ENV_FFMPEG_DIR
-else:
-    # Local Windows path (Fallback)
-    FFMPEG_DIR = r"C:\Users\AZZEDINE\Downloads\ffmpeg-2026-02-04-git-627da11111c-essentials_build\ffmpeg\bin"
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Dict, Any, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from cache import TTLCache
+from media_cache import MediaCache, media_cache
+from format_planner import AUDIO_CODECS, FormatPlan, NoFittingFormat, compact_formats, plan_formats
+from ffmpeg_tools import FFMPEG_DIR
+from fitting import submit_fit
+from thumbnails import cover_jpeg
+from download_engine import DownloadEngine, download_engine
+from failures import (FAILURE_CACHE_SIZE, FAILURE_TTLS, CircuitBreaker, ExtractionFailed, breaker, classify,
+                      extractor_domain)
+from metrics import StageTimer, span, watch_cache
+from postprocess import extract_audio, merge_video, postprocess_scheduler
+from scratch import ScratchStorage, scratch_storage
+from ydl_pool import YdlPool, resolve_formats, unselected
 
-# Add FFmpeg to system PATH to ensure yt-dlp finds it for merging
-if os.path.exists(FFMPEG_DIR) and FFMPEG_DIR not in os.environ["PATH"]:
-    os.environ["PATH"] = FFMPEG_DIR + os.pathsep + os.environ["PATH"]
-elif not ENV_FFMPEG_DIR:
-    # If not on Windows and no ENV set, assume 'ffmpeg' is in system path (like in Docker)
-    FFMPEG_DIR = "" 
+if TYPE_CHECKING:
+    import yt_dlp
 
+logger = logging.getLogger(__name__)
 
+# Extracted metadata cache. Media URLs returned by extractors are signed and
+# expire, so entries should not outlive a few minutes.
+INFO_CACHE_SIZE = int(os.getenv("INFO_CACHE_SIZE", "256"))
+INFO_CACHE_TTL = int(os.getenv("INFO_CACHE_TTL", "300"))
+
+# Query parameters that only track where a link was shared from
+TRACKING_PARAMS = {"si", "feature", "igshid", "igsh", "fbclid", "gclid", "utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content"}
+
+# YoutubeDL options of each pooled profile; output template, format and hooks
+# are set per download
+YDL_PROFILES: Dict[str, Dict[str, Any]] = {
+    "info": {'quiet': True, 'no_warnings': True, 'ffmpeg_location': FFMPEG_DIR},
+    "flat": {'quiet': True, 'no_warnings': True, 'extract_flat': 'in_playlist'},
+    # Downloads the formats only, merging and conversion run in the post-processing stage
+    "fetch": {
+        'quiet': True,
+        'no_warnings': True,
+        'ffmpeg_location': FFMPEG_DIR,
+        'fixup': 'never',
+    },
+}
+
+
+def normalize_url(url: str) -> str:
+    """Canonical form of a URL used as a cache key."""
+    parts = urlsplit(url.strip())
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in TRACKING_PARAMS)
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, urlencode(query), ""))
+
+
+def media_id(info: Dict[str, Any]) -> str:
+    """Extractor-independent identity of a video, e.g. ``Youtube:dQw4w9WgXcQ``."""
+    return f"{info.get('extractor_key') or info.get('extractor')}:{info.get('id')}"
+
+
+def clean_title(info: Dict[str, Any]) -> str:
+    """Title of the media made safe for use as a filename."""
+    title = info.get('title') or 'media'
+    cleaned = "".join([c for c in title if c.isalnum() or c in (' ', '.', '_', '-')]).strip()
+    return cleaned or "download"
 
 
 class MediaDownloader:
-    def __init__(self):
+    def __init__(self, info_cache_size: int = INFO_CACHE_SIZE, info_cache_ttl: int = INFO_CACHE_TTL,
+                 cache: MediaCache = media_cache, engine: DownloadEngine = download_engine,
+                 scratch: ScratchStorage = scratch_storage, circuit_breaker: CircuitBreaker = breaker,
+                 extractors: Optional[List[type]] = None):
         self.temp_dir = tempfile.gettempdir()
+        self.info_cache = TTLCache(max_size=info_cache_size, ttl=info_cache_ttl)
+        # Failed extractions that won't succeed on retry, the TTL depends on the cause
+        self.failure_cache = TTLCache(max_size=FAILURE_CACHE_SIZE, ttl=max(FAILURE_TTLS.values()))
+        self.breaker = circuit_breaker
+        self.media_cache = cache
+        self.engine = engine
+        self.scratch = scratch
+        # Results are written there and moved into the cache, a crash leaves them behind
+        self.scratch.watch(cache.tmp_dir)
+        # Extra yt-dlp extractor classes, tried before the built-in ones
+        self.extractors = list(extractors or [])
+        self.ydl_pool = YdlPool("downloader", YDL_PROFILES, self._ydl)
 
-    def get_info(self, url: str) -> Dict[str, Any]:
-        """Fetch media metadata without downloading."""
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'format': 'best',
-            'ffmpeg_location': FFMPEG_DIR,
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    def _ydl(self, opts: Dict[str, Any]) -> "yt_dlp.YoutubeDL":
+        # Imported on first use so API-only workers start without it
+        import yt_dlp
+        if not self.extractors:
+            return yt_dlp.YoutubeDL(opts)
+        ydl = yt_dlp.YoutubeDL(opts, auto_init=False)
+        for ie in self.extractors:
+            ydl.add_info_extractor(ie())
+        ydl.add_default_info_extractors()
+        return ydl
+
+    @contextmanager
+    def _guard(self, url: str) -> Iterator[None]:
+        """Fail fast when ``url`` failed for good recently or its site keeps failing, remember why it fails."""
+        key = normalize_url(url)
+        failure = self.failure_cache.get(key)
+        if failure is not None:
+            raise ExtractionFailed(*failure)
+        try:
+            with self.breaker.guard(extractor_domain(url)):
+                yield
+        except Exception as e:
+            cause = classify(e)
+            if cause in FAILURE_TTLS:
+                self.failure_cache.set(key, (cause, str(e)), ttl=FAILURE_TTLS[cause])
+            raise
+
+    def extract_info(self, url: str) -> Dict[str, Any]:
+        """Run the extractor for a URL, reusing a cached result when available.
+
+        Raises ``ExtractionFailed`` when the URL recently failed for a reason
+        retrying doesn't fix, and ``CircuitOpen`` while its site keeps failing.
+        """
+        key = normalize_url(url)
+        info = self.info_cache.get(key)
+        if info is not None:
+            return info
+
+        with self._guard(url), span("extract"), self.ydl_pool.checkout("info") as ydl:
             info = ydl.extract_info(url, download=False)
-            return {
-                "title": info.get("title"),
-                "thumbnail": info.get("thumbnail"),
-                "duration": info.get("duration"),
-                "uploader": info.get("uploader"),
-                "ext": info.get("ext"),
-                "formats": [
-                    {"format_id": f["format_id"], "ext": f["ext"], "resolution": f.get("resolution"), "filesize": f.get("filesize")}
-                    for f in info.get("formats", []) if f.get("vcodec") != "none"
-                ]
-            }
-
-    def download_media(self, url: str, format_type: str = "video", max_filesize_mb: Optional[int] = None) -> Dict[str, str]:
-        """Download media and return the local file path and title."""
-        task_id = str(uuid.uuid4())
-        
-        # Get FFmpeg path
-        ffmpeg_bin = FFMPEG_DIR
-
-        # We fetch info first to get the sanitized title
-        ydl_opts_info = {
-            'quiet': True,
-            'no_warnings': True,
-            'ffmpeg_location': FFMPEG_DIR,
-        }
-        with yt_dlp.YoutubeDL(ydl_opts_info) as ydl:
+        self.info_cache.set(key, info)
+        return info
+
+    def list_entries(self, url: str) -> List[str]:
+        """URLs of the entries of a playlist, or ``[url]`` for a single media page.
+
+        Only the playlist page is fetched, entries are resolved when downloaded.
+        """
+        with self._guard(url), self.ydl_pool.checkout("flat") as ydl:
             info = ydl.extract_info(url, download=False)
-            title = info.get('title', 'media')
-            # Sanitize title for filename
-            clean_title = "".join([c for c in title if c.isalnum() or c in (' ', '.', '_', '-')]).strip()
-            if not clean_title:
-                clean_title = "download"
-
-        output_template = os.path.join(self.temp_dir, f"{task_id}.%(ext)s")
-        
-        ydl_opts = {
-            'outtmpl': output_template,
-            'quiet': False, # Enabled for debugging
-            'no_warnings': False,
-            'ffmpeg_location': ffmpeg_bin,
-        }
+        if info.get('_type') not in ('playlist', 'multi_video'):
+            # Single media pages are fully extracted anyway, keep the result
+            self.info_cache.set(normalize_url(url), info)
+            return [url]
+        urls = []
+        for entry in info.get('entries') or []:
+            entry_url = entry and (entry.get('webpage_url') or entry.get('url'))
+            if entry_url:
+                urls.append(entry_url)
+        return urls
+
+    def get_info(self, url: str, info: Optional[Dict[str, Any]] = None, compact: bool = False) -> Dict[str, Any]:
+        """Fetch media metadata without downloading.
 
-        if format_type == "audio":
-            format_str = 'bestaudio/best'
-            if max_filesize_mb:
-                # Prioritize audio files that fit within the limit
-                format_str = f'bestaudio[filesize<{max_filesize_mb}M]/bestaudio/best'
-            
-            ydl_opts.update({
-                'format': format_str,
-                'postprocessors': [
-                    {
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    },
-                    {'key': 'EmbedThumbnail'},
-                    {'key': 'FFmpegMetadata'},
-                ],
-                'writethumbnail': True,
-            })
+        With ``compact`` formats are grouped by resolution and codec, with
+        estimated sizes, and audio-only formats are listed apart.
+        """
+        if info is None:
+            info = self.extract_info(url)
+        result = {
+            "title": info.get("title"),
+            "thumbnail": info.get("thumbnail"),
+            "duration": info.get("duration"),
+            "uploader": info.get("uploader"),
+            "ext": info.get("ext"),
+        }
+        if compact:
+            result.update(compact_formats(info))
         else:
-            format_str = 'bestvideo+bestaudio'
-            if max_filesize_mb:
-                # Attempt to find best combination under the limit, fallback to best overall
-                # We use 40M as a safer limit for video to account for audio and merging overhead
-                format_str = f'bestvideo[filesize<{max_filesize_mb-5}M]+bestaudio/best[filesize<{max_filesize_mb}M]/best'
-            
-            ydl_opts.update({
-                'format': format_str,
-                'merge_output_format': 'mp4',
-                'postprocessors': [
-                    {'key': 'EmbedThumbnail'},
-                    {'key': 'FFmpegMetadata'},
-                ],
-                'writethumbnail': True,
-            })
+            result["formats"] = [
+                {"format_id": f["format_id"], "ext": f["ext"], "resolution": f.get("resolution"), "filesize": f.get("filesize")}
+                for f in info.get("formats", []) if f.get("vcodec") != "none"
+            ]
+        return result
 
+    def plan(self, info: Dict[str, Any], format_type: str = "video", max_filesize_mb: Optional[int] = None,
+             audio_codec: str = "mp3") -> FormatPlan:
+        """Formats that would be downloaded for ``info`` under the size limit."""
+        return plan_formats(info, format_type, max_filesize_mb * 1024 * 1024 if max_filesize_mb else None, audio_codec)
 
+    def download_media(self, url: str, format_type: str = "video", max_filesize_mb: Optional[int] = None, info: Optional[Dict[str, Any]] = None,
+                       progress_hook: Optional[Callable[[Dict[str, Any]], None]] = None,
+                       output_dir: Optional[str] = None, allow_oversize: bool = False,
+                       audio_codec: str = "mp3", priority: str = "api") -> Dict[str, str]:
+        """Download media and return the local file path and title.
+
+        If ``info`` is given (as returned by ``extract_info``) the download
+        starts from it instead of running the extractor again. ``progress_hook``
+        is passed to yt-dlp's ``progress_hooks``. With ``allow_oversize`` the
+        smallest formats are downloaded when none fit ``max_filesize_mb``.
+        ``audio_codec`` is one of ``AUDIO_CODECS``; the audio is only re-encoded
+        when the source uses another codec ("best" never re-encodes).
+        ``priority`` ("bot" or "api") is the bandwidth class of the download.
+        Raises ``StorageFull`` when the scratch space stays taken by other jobs.
+        """
+        if audio_codec not in AUDIO_CODECS:
+            raise ValueError(f"audio_codec must be one of {', '.join(AUDIO_CODECS)}")
+        task_id = str(uuid.uuid4())
+
+        if info is None:
+            info = self.extract_info(url)
+        title = clean_title(info)
+
+        # Choose formats from the info dict so oversized downloads are refused
+        # before they start, even when extractors don't report file sizes
+        plan = self.plan(info, format_type, max_filesize_mb, audio_codec)
+        # An unknown size (fits is None) is checked once the file is made
+        if plan.fits is False and not allow_oversize:
+            raise NoFittingFormat(plan.reason)
+        format_str = plan.format_spec
+        # The downloaded formats and the post-processed file exist at the same time
+        scratch_size = plan.estimated_size * 2 if plan.estimated_size else None
+
+        # The transfer stage is timed from yt-dlp's hooks
+        stages = StageTimer()
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
-                
-                # Check for post-processed filename
+            # Everything the job writes stays in its own directory, removed
+            # with whatever a failure left there once the job ends
+            with self.scratch.workspace(task_id, scratch_size) as work:
+                output_base = os.path.join(work.path, task_id)
+                # Bandwidth, per-host connections and fragment concurrency are
+                # shared with the other downloads through the engine
+                with self.engine.transfer(info, format_str, priority) as transfer:
+                    params = transfer.ydl_opts(progress_hook)
+                    stages.attach(params)
+                    # Failing media hosts open the circuit of the site, like failing extractions
+                    with self.breaker.guard(extractor_domain(url)):
+                        downloads = self._fetch(info, format_str, output_base, params)
+                stages.finish()
+
+                with span("cover"):
+                    cover = cover_jpeg(media_id(info), info.get('thumbnail'))
+                # ffmpeg runs in the post-processing workers, the connections
+                # of this download are already free for others
                 if format_type == "audio":
-                    filename = os.path.splitext(filename)[0] + ".mp3"
-                elif format_type == "video":
-                    if not filename.endswith('.mp4'):
-                        potential_mp4 = os.path.splitext(filename)[0] + ".mp4"
-                        if os.path.exists(potential_mp4):
-                            filename = potential_mp4
-                
-                if not os.path.exists(filename):
-                    raise Exception(f"File not found after download: {filename}")
-                    
-                return {"path": filename, "title": clean_title}
+                    path, fmt = downloads[0]
+                    job = postprocess_scheduler.submit("audio_convert", extract_audio, path, fmt, output_base,
+                                                       audio_codec, info, cover, priority=priority)
+                else:
+                    job = postprocess_scheduler.submit("merge", merge_video, downloads, f"{output_base}.mp4", info,
+                                                       cover, priority=priority)
+                result = job.result()
+                logger.info("Post-processing of %s used %.2fs of CPU", url, job.cpu_seconds)
+                if plan.fits is None and max_filesize_mb and not allow_oversize:
+                    size = os.path.getsize(result)
+                    if size > max_filesize_mb * 1024 * 1024:
+                        raise NoFittingFormat(f"{plan.reason}, the result is {size / (1024 * 1024):.1f}MB, "
+                                              f"over the {max_filesize_mb}MB limit")
+                # A copy when the scratch directory is on another filesystem (tmpfs)
+                filename = shutil.move(result, os.path.join(output_dir or self.temp_dir, os.path.basename(result)))
+            return {"path": filename, "title": title}
         except Exception as e:
-            print(f"yt-dlp error: {str(e)}")
+            stages.finish(e)
+            logger.error("Download of %s failed: %s", url, e)
             raise e
 
+    def _fetch(self, info: Dict[str, Any], format_spec: str, output_base: str,
+               params: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+        """Download each format selected by ``format_spec`` to its own file, as (path, format) pairs."""
+        with self.ydl_pool.checkout("fetch", format=format_spec) as ydl:
+            formats = resolve_formats(ydl, info)
+
+        downloads = []
+        for fmt in formats:
+            format_id = fmt['format_id']
+
+            def select(ctx, format_id=format_id):
+                return (f for f in ctx['formats'] if f['format_id'] == format_id)
+
+            with self.ydl_pool.checkout("fetch", format=select, outtmpl=f"{output_base}.f{format_id}.%(ext)s",
+                                        **params) as ydl:
+                result = ydl.process_ie_result(unselected(info), download=True)
+            downloads.append((result['requested_downloads'][-1]['filepath'], fmt))
+        return downloads
+
+    def download_cached(self, url: str, format_type: str = "video", max_filesize_mb: Optional[int] = None,
+                        info: Optional[Dict[str, Any]] = None,
+                        progress_hook: Optional[Callable[[Dict[str, Any]], None]] = None,
+                        oversize: Optional[str] = None, audio_codec: str = "mp3", priority: str = "api") -> Dict[str, Any]:
+        """Like ``download_media`` but served from the media cache when possible.
+
+        With ``oversize`` ("transcode" or "split") a file over ``max_filesize_mb``
+        goes through the fitting stage; ``parts`` lists the files to send, each
+        with its cache key. Files returned here belong to the cache and must not
+        be deleted by the caller.
+        """
+        if info is None:
+            info = self.extract_info(url)
+        variant = format_type
+        if format_type == "audio" and audio_codec != "mp3":
+            variant = f"audio-{audio_codec}"
+        if oversize and max_filesize_mb:
+            # May be over the limit, a request without a strategy must not be served it
+            variant = f"{variant}-oversize"
+        key = self.media_cache.make_key(media_id(info), variant, max_filesize_mb)
+        path = self.media_cache.get_or_create(
+            key,
+            lambda output_dir: self.download_media(url, format_type, max_filesize_mb, info, progress_hook, output_dir,
+                                                   allow_oversize=bool(oversize), audio_codec=audio_codec,
+                                                   priority=priority)["path"],
+        )
+        parts = [{"key": key, "path": path}]
+        if oversize and max_filesize_mb and os.path.getsize(path) > max_filesize_mb * 1024 * 1024:
+            parts = self.fit_cached(key, path, max_filesize_mb * 1024 * 1024, oversize)
+        return {"path": parts[0]["path"], "title": clean_title(info), "key": parts[0]["key"], "parts": parts}
+
+    def fit_cached(self, key: str, path: str, max_bytes: int, strategy: str) -> List[Dict[str, str]]:
+        """Fit a cached file to ``max_bytes`` in the fitting process pool, caching the result."""
+        fit_key = f"{key}-{strategy}"
+
+        def produce(output_dir: str) -> str:
+            with span(strategy):
+                outputs = submit_fit(path, max_bytes, strategy, output_dir).result()
+            part_keys = [f"{fit_key}-{i}" for i in range(len(outputs))]
+            for part_key, output in zip(part_keys, outputs):
+                self.media_cache.put(part_key, output)
+            # The list of parts is cached as a small manifest file
+            manifest = os.path.join(output_dir, f"{fit_key}.json")
+            with open(manifest, "w") as f:
+                json.dump(part_keys, f)
+            return manifest
+
+        for _ in range(2):
+            with open(self.media_cache.get_or_create(fit_key, produce)) as f:
+                part_keys = json.load(f)
+            parts = [{"key": k, "path": self.media_cache.get(k)} for k in part_keys]
+            if all(p["path"] for p in parts):
+                return parts
+            # A part was evicted since, fit again
+            self.media_cache.discard(fit_key)
+        raise Exception("Fitted parts were evicted from the media cache")
+
 downloader = MediaDownloader()
+watch_cache("info", downloader.info_cache)
+watch_cache("failures", downloader.failure_cache)
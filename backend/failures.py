@@ -0,0 +1,204 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+from urllib.parse import urlsplit
+from metrics import Counter, Gauge
+
+# How long a failed extraction is answered from the negative cache, by cause.
+# Other failures (network, rate limits, broken extractors) are retried every
+# time and count towards the site's circuit breaker instead
+FAILURE_TTLS = {
+    "unsupported": int(os.getenv("FAILURE_TTL_UNSUPPORTED", "3600")),
+    "unavailable": int(os.getenv("FAILURE_TTL_UNAVAILABLE", "600")),
+    "login": int(os.getenv("FAILURE_TTL_LOGIN", "600")),
+    "geo": int(os.getenv("FAILURE_TTL_GEO", "600")),
+}
+FAILURE_CACHE_SIZE = int(os.getenv("FAILURE_CACHE_SIZE", "1024"))
+
+# Consecutive failures that open the circuit of a site, requests to it then
+# fail right away until a probe gets through
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+# Seconds before the first probe, doubled each time the probe fails
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+BREAKER_MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN", "600"))
+
+# Checked in order against the lowercased error message
+FAILURE_MESSAGES = {
+    # The site refuses us rather than the media, counts as a site failure
+    "error": ("not a bot", "http error 429", "too many requests", "rate limit", "rate-limit"),
+    "unsupported": ("unsupported url",),
+    "geo": ("not available in your country", "geo restriction", "geo-restrict"),
+    "login": ("sign in to confirm your age", "age-restricted", "members-only", "join this channel",
+              "login required", "requires authentication", "log in to"),
+    "unavailable": ("private video", "video is private", "video unavailable", "has been removed",
+                    "no longer available", "account has been terminated", "does not exist", "http error 404",
+                    "http error 410"),
+}
+
+logger = logging.getLogger(__name__)
+
+EXTRACTION_FAILURES = Counter("extraction_failures_total", "Failed extractions and downloads by cause", ("cause",))
+CIRCUIT_REJECTED = Counter("circuit_rejected_total", "Requests failed fast by an open circuit", ("domain",))
+
+
+class ExtractionFailed(Exception):
+    """A recent extraction of the same URL failed for a reason that won't go away on retry."""
+
+    def __init__(self, cause: str, message: str):
+        super().__init__(message)
+        self.cause = cause
+
+
+class CircuitOpen(Exception):
+    def __init__(self, domain: str, retry_after: float):
+        super().__init__(f"Downloads from {domain} are failing, try again in {int(retry_after) + 1}s")
+        self.domain = domain
+        self.retry_after = retry_after
+
+
+def classify(error: BaseException) -> Optional[str]:
+    """Cause of a yt-dlp failure: a key of ``FAILURE_TTLS``, "error" for site failures, None for our own errors."""
+    from yt_dlp.networking.exceptions import HTTPError, TransportError
+    from yt_dlp.utils import DownloadError, ExtractorError, GeoRestrictedError, UnsupportedError
+
+    if isinstance(error, ExtractionFailed):
+        return error.cause
+    if not isinstance(error, (DownloadError, ExtractorError, HTTPError, TransportError)):
+        return None
+    message = str(error).lower()
+    # DownloadError keeps the exception yt-dlp reported, ExtractorError the one it was raised from
+    while isinstance(error, DownloadError) and error.exc_info and error.exc_info[1] is not None:
+        error = error.exc_info[1]
+    if isinstance(error, UnsupportedError):
+        return "unsupported"
+    if isinstance(error, GeoRestrictedError):
+        return "geo"
+    for cause, patterns in FAILURE_MESSAGES.items():
+        if any(pattern in message for pattern in patterns):
+            return cause
+    if isinstance(error, (HTTPError, TransportError)) or isinstance(getattr(error, "cause", None), (HTTPError, TransportError)):
+        return "error"
+    if isinstance(error, ExtractorError):
+        # Errors yt-dlp expects are about the media, the others are extractor bugs
+        return "unavailable" if error.expected else "error"
+    if isinstance(error, DownloadError):
+        return "error"
+    return None
+
+
+def extractor_domain(url: str) -> str:
+    """Site a URL belongs to, e.g. ``youtube.com`` for ``https://m.youtube.com/watch?v=...``."""
+    host = (urlsplit(url.strip()).hostname or "").lower()
+    for prefix in ("www.", "m.", "mobile."):
+        if host.startswith(prefix):
+            return host[len(prefix):]
+    return host
+
+
+class _Circuit:
+    def __init__(self):
+        self.state = "closed"  # closed, open, half_open
+        self.failures = 0
+        self.cooldown = 0.0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.last_error: Optional[str] = None
+
+
+class CircuitBreaker:
+    """Per-site circuit breaker.
+
+    After ``failures`` site failures in a row the circuit opens and requests
+    to the site fail right away. Once the cooldown is over a single request
+    goes through as a probe: its success closes the circuit, its failure
+    opens it again for twice as long. Failures that are about the media
+    (private, removed...) show the site works and count as successes.
+    """
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN,
+                 max_cooldown: float = BREAKER_MAX_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.circuits: Dict[str, _Circuit] = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, domain: str) -> bool:
+        """Raise ``CircuitOpen`` or let the request through, returns whether it is the probe."""
+        with self._lock:
+            circuit = self.circuits.get(domain)
+            if circuit is None or circuit.state == "closed":
+                return False
+            remaining = circuit.opened_at + circuit.cooldown - time.monotonic()
+            if circuit.state == "open" and remaining <= 0:
+                circuit.state = "half_open"
+                return True
+        CIRCUIT_REJECTED.inc(domain=domain)
+        # Requests arriving while the probe runs wait for the next cooldown at most
+        raise CircuitOpen(domain, max(remaining, 1.0))
+
+    def _record(self, domain: str, failed: Optional[bool], probe: bool, error: Optional[str] = None):
+        with self._lock:
+            circuit = self.circuits.get(domain)
+            if failed is None:
+                # Not about the site, a probe that ends like this just gives its turn back
+                if probe and circuit is not None:
+                    circuit.state = "open"
+                return
+            if not failed:
+                # The site answers, whatever state it was in
+                self.circuits.pop(domain, None)
+                return
+            circuit = self.circuits.setdefault(domain, _Circuit())
+            circuit.failures += 1
+            circuit.last_error = error[:200] if error else None
+            if probe or (circuit.state == "closed" and circuit.failures >= self.failures):
+                circuit.cooldown = min(circuit.cooldown * 2, self.max_cooldown) if probe else self.cooldown
+                circuit.state = "open"
+                circuit.opened_at = time.monotonic()
+                circuit.trips += 1
+                logger.warning("Circuit of %s opened for %.0fs after %d failures: %s", domain, circuit.cooldown,
+                               circuit.failures, circuit.last_error)
+
+    @contextmanager
+    def guard(self, domain: str) -> Iterator[None]:
+        """Fail fast while ``domain`` is failing, and record how the block ends."""
+        probe = self._acquire(domain)
+        try:
+            yield
+        except Exception as e:
+            cause = classify(e)
+            if cause is not None:
+                EXTRACTION_FAILURES.inc(cause=cause)
+            self._record(domain, None if cause is None else cause == "error", probe, str(e))
+            raise
+        except BaseException:
+            self._record(domain, None, probe)
+            raise
+        self._record(domain, False, probe)
+
+    def state(self) -> Dict[str, Dict[str, Any]]:
+        """Sites whose circuit isn't closed or that failed recently."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                domain: {
+                    "state": circuit.state,
+                    "failures": circuit.failures,
+                    "trips": circuit.trips,
+                    "retry_after": round(max(0.0, circuit.opened_at + circuit.cooldown - now), 1)
+                    if circuit.state == "open" else None,
+                    "last_error": circuit.last_error,
+                }
+                for domain, circuit in self.circuits.items()
+            }
+
+
+breaker = CircuitBreaker()
+
+Gauge("circuit_open", "Sites whose circuit is open (1) or probing (0.5)", ("domain",),
+      collect=lambda: {(domain,): 1 if c["state"] == "open" else 0.5
+                       for domain, c in breaker.state().items() if c["state"] != "closed"})
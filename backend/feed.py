@@ -0,0 +1,62 @@
+import base64
+import os
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+from sqlalchemy import and_, or_
+from sqlmodel import Session, select
+from counters import counter_store
+from models import Post, User
+from schemas import FeedPost, PostAuthor
+
+# Posts per page when the client doesn't ask, and the most it may ask for
+POSTS_PAGE_SIZE = int(os.getenv("POSTS_PAGE_SIZE", "20"))
+POSTS_MAX_PAGE_SIZE = int(os.getenv("POSTS_MAX_PAGE_SIZE", "100"))
+
+
+def encode_cursor(created_at: datetime, post_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{post_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Position after which the next page starts, raises ValueError if malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, post_id = raw.split("|")
+        return datetime.fromisoformat(created_at), int(post_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def before(created_at_column: Any, id_column: Any, position: Tuple[datetime, int]) -> Any:
+    """``(created_at, id) < position``, expanded so every backend answers it with an index range scan."""
+    created_at, row_id = position
+    return or_(created_at_column < created_at, and_(created_at_column == created_at, id_column < row_id))
+
+
+def load_posts(db: Session, where: Any, limit: int, cursor: Optional[str] = None) -> List[FeedPost]:
+    """Up to ``limit`` posts matching ``where``, newest first, after ``cursor`` if given.
+
+    Authors come with the posts, and the counts of the page with one more query.
+    """
+    query = select(Post, User.username, User.full_name, User.profile_pic).join(User, User.id == Post.user_id)
+    if where is not None:
+        query = query.where(where)
+    if cursor:
+        query = query.where(before(Post.created_at, Post.id, decode_cursor(cursor)))
+    rows = db.exec(query.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit)).all()
+    counts = counter_store.load(db, [post.id for post, *_ in rows])
+    return [
+        FeedPost(
+            id=post.id,
+            content=post.content,
+            image_url=post.image_url,
+            created_at=post.created_at,
+            user_id=post.user_id,
+            author=PostAuthor(id=post.user_id, username=username, full_name=full_name, profile_pic=profile_pic),
+            comment_count=counts[post.id].comment_count,
+            reaction_count=counts[post.id].reaction_count,
+            reactions=counts[post.id].reactions,
+        )
+        for post, username, full_name, profile_pic in rows
+    ]
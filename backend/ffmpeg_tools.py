@@ -0,0 +1,82 @@
+import os
+import signal
+import subprocess
+from typing import List
+
+# FFmpeg configuration
+# On server (Linux), ffmpeg is usually in the PATH. On Windows, we use the local path.
+ENV_FFMPEG_DIR = os.getenv("FFMPEG_DIR")
+if ENV_FFMPEG_DIR:
+    FFMPEG_DIR = ENV_FFMPEG_DIR
+else:
+    # Local Windows path (Fallback)
+    FFMPEG_DIR = r"C:\Users\AZZEDINE\Downloads\ffmpeg-2026-02-04-git-627da11111c-essentials_build\ffmpeg\bin"
+
+# Add FFmpeg to system PATH to ensure yt-dlp finds it for merging
+if os.path.exists(FFMPEG_DIR) and FFMPEG_DIR not in os.environ["PATH"]:
+    os.environ["PATH"] = FFMPEG_DIR + os.pathsep + os.environ["PATH"]
+elif not ENV_FFMPEG_DIR:
+    # If not on Windows and no ENV set, assume 'ffmpeg' is in system path (like in Docker)
+    FFMPEG_DIR = "" 
+
+
+def ffmpeg_executable() -> str:
+    """Path of the ffmpeg binary we run ourselves (outside yt-dlp)."""
+    return os.path.join(FFMPEG_DIR, "ffmpeg") if FFMPEG_DIR else "ffmpeg"
+
+
+def ffprobe_executable() -> str:
+    return os.path.join(FFMPEG_DIR, "ffprobe") if FFMPEG_DIR else "ffprobe"
+
+
+def exit_status(returncode: int) -> str:
+    """How a process ended, e.g. "exit code 1" or "signal SIGSEGV"."""
+    if returncode < 0:
+        try:
+            return f"signal {signal.Signals(-returncode).name}"
+        except ValueError:
+            return f"signal {-returncode}"
+    return f"exit code {returncode}"
+
+
+def run_ffmpeg(args: List[str]) -> float:
+    """Run ffmpeg with the given arguments, raising with its error output on failure.
+
+    Returns the CPU time ffmpeg used in seconds (0 where the OS doesn't report it).
+    """
+    process = subprocess.Popen([ffmpeg_executable(), "-y", "-loglevel", "error", "-nostdin", *args],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    with process.stderr:
+        stderr = process.stderr.read()
+    cpu_seconds = 0.0
+    if hasattr(os, "wait4"):
+        # Reaped here instead of by Popen to get the resource usage of this child only
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        cpu_seconds = usage.ru_utime + usage.ru_stime
+    else:
+        process.wait()
+    if process.returncode != 0:
+        # Crashes and -loglevel error runs may print nothing, the exit status always says something
+        output = stderr.decode(errors='replace').strip()[-500:]
+        raise RuntimeError(f"ffmpeg failed with {exit_status(process.returncode)}" + (f": {output}" if output else ""))
+    return cpu_seconds
+
+
+def probe_duration(path: str) -> float:
+    """Duration of a media file in seconds."""
+    output = subprocess.check_output([
+        ffprobe_executable(), "-v", "error", "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1", path,
+    ])
+    return float(output.decode().strip())
+
+
+def has_video(path: str) -> bool:
+    """Whether a media file has a video stream; embedded cover art doesn't count."""
+    # "V" leaves out attached pictures, unlike "v"
+    output = subprocess.check_output([
+        ffprobe_executable(), "-v", "error", "-select_streams", "V", "-show_entries", "stream=index",
+        "-of", "csv=p=0", path,
+    ])
+    return bool(output.strip())
@@ -0,0 +1,37 @@
+from typing import Optional
+from sqlmodel import Session, select
+from database import engine
+from models import TelegramFile
+
+
+def get_by_url(url: str, format_type: str) -> Optional[TelegramFile]:
+    """Look up a previous upload by normalized URL, without running the extractor."""
+    with Session(engine) as db:
+        return db.exec(select(TelegramFile).where(TelegramFile.url == url, TelegramFile.format_type == format_type)).first()
+
+
+def get_by_media(media_id: str, format_type: str) -> Optional[TelegramFile]:
+    with Session(engine) as db:
+        return db.exec(select(TelegramFile).where(TelegramFile.media_id == media_id, TelegramFile.format_type == format_type)).first()
+
+
+def store(media_id: str, format_type: str, url: str, file_id: str, title: Optional[str] = None):
+    with Session(engine) as db:
+        entry = db.exec(select(TelegramFile).where(TelegramFile.media_id == media_id, TelegramFile.format_type == format_type)).first()
+        if entry:
+            entry.url = url
+            entry.file_id = file_id
+            entry.title = title
+        else:
+            entry = TelegramFile(media_id=media_id, format_type=format_type, url=url, file_id=file_id, title=title)
+        db.add(entry)
+        db.commit()
+
+
+def invalidate(entry_id: int):
+    """Forget an upload whose file_id Telegram no longer accepts."""
+    with Session(engine) as db:
+        entry = db.get(TelegramFile, entry_id)
+        if entry:
+            db.delete(entry)
+            db.commit()
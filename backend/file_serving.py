@@ -0,0 +1,69 @@
+import mimetypes
+import os
+from typing import Optional
+from urllib.parse import quote
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+
+# Hand the transfer to the reverse proxy (nginx: X-Accel-Redirect, Apache or
+# lighttpd: X-Sendfile) so the kernel sends the file with sendfile(2).
+# MEDIA_SENDFILE_PREFIX is the internal location the proxy maps to the cache dir.
+MEDIA_SENDFILE_HEADER = os.getenv("MEDIA_SENDFILE_HEADER", "")
+MEDIA_SENDFILE_PREFIX = os.getenv("MEDIA_SENDFILE_PREFIX", "/protected-media")
+
+MEDIA_TYPES = {
+    ".mp4": "video/mp4",
+    ".m4a": "audio/mp4",
+    ".mp3": "audio/mpeg",
+    ".webm": "video/webm",
+    ".opus": "audio/ogg",
+    ".ogg": "audio/ogg",
+    ".zip": "application/zip",
+}
+
+
+def media_type_for(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    return MEDIA_TYPES.get(ext) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def content_disposition(filename: str, disposition: str = "attachment") -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"{disposition}; filename*=utf-8''{quoted}"
+    return f'{disposition}; filename="{filename}"'
+
+
+def file_etag(stat: os.stat_result) -> str:
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def serve_file(request: Request, path: str, filename: str, root: Optional[str] = None,
+               cache_control: str = "private, max-age=3600", disposition: str = "attachment") -> Response:
+    """Send a finished file with Range, ETag and conditional request support.
+
+    ``root`` is the directory the proxy's sendfile location points at; when a
+    sendfile header is configured the body is left to the proxy. ``disposition``
+    is "inline" for files the browser should show rather than save.
+    """
+    stat = os.stat(path)
+    etag = file_etag(stat)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    if MEDIA_SENDFILE_HEADER and root:
+        relative = os.path.relpath(path, root).replace(os.sep, "/")
+        headers["Content-Disposition"] = content_disposition(filename, disposition)
+        headers[MEDIA_SENDFILE_HEADER] = f"{MEDIA_SENDFILE_PREFIX.rstrip('/')}/{quote(relative)}"
+        return Response(media_type=media_type_for(path), headers=headers)
+
+    # FileResponse answers Range/If-Range requests with 206 on its own
+    return FileResponse(path, filename=filename, content_disposition_type=disposition, media_type=media_type_for(path),
+                        headers=headers, stat_result=stat)
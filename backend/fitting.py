@@ -0,0 +1,117 @@
+import math
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import List, Optional
+from ffmpeg_tools import has_video, probe_duration, run_ffmpeg
+
+# Processes available for re-encoding and splitting, kept apart from the
+# download threads so CPU-heavy encodes don't slow down network transfers
+FIT_WORKERS = int(os.getenv("FIT_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+
+STRATEGIES = ("transcode", "split")
+
+# Share of the budget actually targeted, encoders overshoot a little
+BITRATE_SAFETY = 0.92
+MIN_VIDEO_KBPS = 150
+MAX_AUDIO_KBPS = 128
+MIN_AUDIO_KBPS = 32
+MAX_SPLIT_ATTEMPTS = 4
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+# Lossy encoder for audio re-encoded in its own container, others (flac, wav...) become AAC in .m4a
+AUDIO_ENCODERS = {".mp3": "libmp3lame", ".opus": "libopus", ".ogg": "libopus",
+                  ".m4a": "aac", ".m4b": "aac", ".aac": "aac", ".mp4": "aac"}
+
+
+def is_audio(path: str) -> bool:
+    # Probed rather than told by the extension, any container may hold audio alone
+    return not has_video(path)
+
+
+def transcode_to_fit(path: str, max_bytes: int, output_dir: str) -> List[str]:
+    """Re-encode with a bitrate computed from the duration so the result fits ``max_bytes``."""
+    duration = probe_duration(path)
+    total_kbps = max_bytes * 8 / 1000 / duration * BITRATE_SAFETY
+    base, ext = os.path.splitext(os.path.basename(path))
+    output = os.path.join(output_dir, f"{base}.fit{ext}")
+
+    if is_audio(path):
+        audio_kbps = int(total_kbps)
+        if audio_kbps < MIN_AUDIO_KBPS:
+            raise ValueError(f"Audio is too long to fit in {max_bytes // (1024 * 1024)}MB")
+        codec = AUDIO_ENCODERS.get(ext.lower())
+        if codec:
+            # Cover art is copied as-is
+            streams = ["-map", "0", "-c:v", "copy"]
+        else:
+            codec, streams = "aac", ["-map", "0:a"]
+            output = os.path.join(output_dir, f"{base}.fit.m4a")
+        run_ffmpeg(["-i", path, *streams, "-c:a", codec, "-b:a", f"{audio_kbps}k", output])
+        return [output]
+
+    audio_kbps = max(MIN_AUDIO_KBPS, min(MAX_AUDIO_KBPS, int(total_kbps / 8)))
+    video_kbps = int(total_kbps - audio_kbps)
+    if video_kbps < MIN_VIDEO_KBPS:
+        raise ValueError(f"Video is too long to fit in {max_bytes // (1024 * 1024)}MB, try splitting it")
+    run_ffmpeg([
+        "-i", path, "-map", "0:v:0", "-map", "0:a:0?",
+        "-c:v", "libx264", "-preset", "veryfast",
+        "-b:v", f"{video_kbps}k", "-maxrate", f"{video_kbps}k", "-bufsize", f"{video_kbps * 2}k",
+        "-c:a", "aac", "-b:a", f"{audio_kbps}k",
+        "-movflags", "+faststart", output,
+    ])
+    return [output]
+
+
+def split_to_fit(path: str, max_bytes: int, output_dir: str) -> List[str]:
+    """Cut into playable parts of at most ``max_bytes`` each, without re-encoding.
+
+    Cuts can only happen on keyframes, so parts vary in size; if one comes out
+    too large the file is split again into more parts.
+    """
+    duration = probe_duration(path)
+    size = os.path.getsize(path)
+    base, ext = os.path.splitext(os.path.basename(path))
+    parts = math.ceil(size / (max_bytes * BITRATE_SAFETY))
+    # Embedded cover art can't be segmented, only the main streams are kept
+    streams = ["-map", "0:a"] if is_audio(path) else ["-map", "0:v:0", "-map", "0:a:0?"]
+
+    for attempt in range(MAX_SPLIT_ATTEMPTS):
+        pattern = os.path.join(output_dir, f"{base}.part{attempt}-%03d{ext}")
+        run_ffmpeg([
+            "-i", path, *streams, "-c", "copy",
+            "-f", "segment", "-segment_time", f"{duration / parts:.3f}", "-reset_timestamps", "1",
+            pattern,
+        ])
+        prefix = f"{base}.part{attempt}-"
+        outputs = sorted(os.path.join(output_dir, n) for n in os.listdir(output_dir) if n.startswith(prefix))
+        if all(os.path.getsize(p) <= max_bytes for p in outputs):
+            return outputs
+        for p in outputs:
+            os.remove(p)
+        parts += max(1, parts // 2)
+    raise ValueError("Could not split the file into small enough parts (keyframes too far apart)")
+
+
+def fit_to_size(path: str, max_bytes: int, strategy: str, output_dir: str) -> List[str]:
+    """Make ``path`` fit ``max_bytes`` using ``strategy``, returns the resulting files."""
+    if os.path.getsize(path) <= max_bytes:
+        return [path]
+    if strategy == "transcode":
+        return transcode_to_fit(path, max_bytes, output_dir)
+    if strategy == "split":
+        return split_to_fit(path, max_bytes, output_dir)
+    raise ValueError(f"Unknown strategy: {strategy}")
+
+
+def submit_fit(path: str, max_bytes: int, strategy: str, output_dir: str) -> Future:
+    """Run ``fit_to_size`` in the fitting process pool."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=FIT_WORKERS)
+    return _executor.submit(fit_to_size, path, max_bytes, strategy, output_dir)
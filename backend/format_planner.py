@@ -0,0 +1,260 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+# Container overhead added when video and audio are muxed together
+MUX_OVERHEAD_RATIO = 1.03
+MUX_OVERHEAD_BYTES = 256 * 1024
+# Bitrate (kbps) of audio the audio mode has to re-encode
+AUDIO_OUTPUT_KBPS = 192
+
+DEFAULT_FORMATS = {
+    "video": "bestvideo+bestaudio/best",
+    "audio": "bestaudio/best",
+}
+
+# Output codecs of the audio mode. "best" keeps whatever the source uses.
+AUDIO_CODECS = ("mp3", "m4a", "opus", "best")
+# Source codec (yt-dlp acodec prefix) that can be stream-copied into each output
+AUDIO_SOURCE_CODECS = {
+    "mp3": "mp3",
+    "m4a": "mp4a",
+    "opus": "opus",
+}
+# File extension of each source codec (yt-dlp acodec prefix) kept as-is by "best"
+AUDIO_EXTS = {"mp3": "mp3", "mp4a": "m4a", "aac": "m4a", "opus": "opus", "vorbis": "ogg", "flac": "flac"}
+
+# Codec family of yt-dlp codec strings (e.g. "avc1.64001F"), by prefix
+CODEC_NAMES = {
+    "avc": "h264", "h264": "h264", "hev": "h265", "hvc": "h265", "h265": "h265", "vp09": "vp9", "vp9": "vp9",
+    "vp8": "vp8", "av01": "av1", "mp4a": "aac", "aac": "aac", "opus": "opus", "vorbis": "vorbis", "mp3": "mp3",
+    "flac": "flac", "ac-3": "ac3", "ec-3": "eac3",
+}
+
+
+def codec_name(codec: Optional[str]) -> str:
+    codec = (codec or "").lower()
+    for prefix, name in CODEC_NAMES.items():
+        if codec.startswith(prefix):
+            return name
+    return codec.split(".")[0] or "unknown"
+
+
+def audio_format_spec(audio_codec: str = "mp3") -> str:
+    """Selector preferring sources that need no re-encode for ``audio_codec``."""
+    source = AUDIO_SOURCE_CODECS.get(audio_codec)
+    if source:
+        return f"bestaudio[acodec^={source}]/{DEFAULT_FORMATS['audio']}"
+    return DEFAULT_FORMATS["audio"]
+
+
+def needs_reencode(fmt: Dict[str, Any], audio_codec: str) -> bool:
+    acodec = fmt.get("acodec") or ""
+    if audio_codec == "best":
+        # Sources of an unknown file type are converted to mp3
+        return not any(acodec.startswith(prefix) for prefix in AUDIO_EXTS)
+    return not acodec.startswith(AUDIO_SOURCE_CODECS[audio_codec])
+
+
+class NoFittingFormat(Exception):
+    """No format combination fits the size budget."""
+
+
+class FormatPlan:
+    """Formats to download and why. ``fits`` is None when the size can't be known before downloading."""
+
+    def __init__(self, format_spec: str, estimated_size: Optional[int], reason: str, fits: Optional[bool] = True):
+        self.format_spec = format_spec
+        self.estimated_size = estimated_size
+        self.reason = reason
+        self.fits = fits
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "format": self.format_spec,
+            "estimated_size": self.estimated_size,
+            "reason": self.reason,
+            "fits": self.fits,
+        }
+
+
+def estimate_size(fmt: Dict[str, Any], duration: Optional[float]) -> Optional[int]:
+    """Best guess of a format's size in bytes, None when nothing is known."""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    bitrate = fmt.get("tbr") or ((fmt.get("vbr") or 0) + (fmt.get("abr") or 0))
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)
+    return None
+
+
+def _is_media(fmt: Dict[str, Any]) -> bool:
+    # Storyboards and other image-only formats have neither codec
+    return not (fmt.get("vcodec") == "none" and fmt.get("acodec") == "none") and fmt.get("ext") != "mhtml"
+
+
+def _video_rank(fmt: Dict[str, Any]) -> Tuple:
+    return (fmt.get("height") or 0, fmt.get("fps") or 0, fmt.get("ext") == "mp4", fmt.get("tbr") or fmt.get("vbr") or 0)
+
+
+def _audio_rank(fmt: Dict[str, Any]) -> Tuple:
+    return (fmt.get("abr") or fmt.get("tbr") or 0, fmt.get("ext") == "m4a")
+
+
+def _mb(size: int) -> str:
+    return f"{size / (1024 * 1024):.1f}MB"
+
+
+def plan_formats(info: Dict[str, Any], format_type: str = "video", max_bytes: Optional[int] = None,
+                 audio_codec: str = "mp3") -> FormatPlan:
+    """Choose the formats to download for ``info`` so the result fits ``max_bytes``.
+
+    Works only from the extracted info dict, nothing is downloaded.
+    """
+    if format_type == "audio":
+        default = audio_format_spec(audio_codec)
+    else:
+        default = DEFAULT_FORMATS["video"]
+    if not max_bytes:
+        return FormatPlan(default, None, "no size limit")
+
+    duration = info.get("duration")
+    formats = [f for f in info.get("formats") or [] if _is_media(f)]
+    if not formats:
+        return FormatPlan(default, None, "extractor returned no format list", fits=None)
+
+    audio_only = [f for f in formats if f.get("vcodec") == "none"]
+    # Codecs left as None are unknown (generic extractor, direct links), such a
+    # format is taken for a single file with both streams
+    progressive = [f for f in formats if f.get("vcodec") != "none" and f.get("acodec") != "none"]
+    video_only = [f for f in formats if f.get("vcodec") != "none" and f.get("acodec") == "none"]
+
+    if format_type == "audio":
+        return _plan_audio(audio_only or progressive, duration, max_bytes, audio_codec)
+    return _plan_video(video_only, audio_only, progressive, duration, max_bytes)
+
+
+def _plan_audio(candidates: List[Dict[str, Any]], duration: Optional[float], max_bytes: int, audio_codec: str) -> FormatPlan:
+    if not candidates:
+        return FormatPlan(DEFAULT_FORMATS["audio"], None, "no audio formats listed", fits=False)
+    # Sources that can be stream-copied are preferred over better re-encoded ones
+    copyable = [f for f in candidates if not needs_reencode(f, audio_codec)]
+
+    fitting = []
+    for f in copyable:
+        size = estimate_size(f, duration)
+        if size is not None and size <= max_bytes:
+            fitting.append((f, size))
+    if fitting:
+        source, size = max(fitting, key=lambda o: _audio_rank(o[0]))
+        return FormatPlan(source["format_id"], size, f"{source.get('abr') or '?'}kbps {source.get('acodec')} audio copied as-is, ~{_mb(size)}")
+
+    reencoded = [f for f in candidates if needs_reencode(f, audio_codec)]
+    if not reencoded:
+        # Every source would be copied as-is, so none of them comes out smaller
+        sized = [(f, estimate_size(f, duration)) for f in copyable]
+        sized = [(f, size) for f, size in sized if size is not None]
+        if sized:
+            source, size = min(sized, key=lambda o: o[1])
+            return FormatPlan(source["format_id"], size, f"smallest audio ({source['format_id']}) is copied as-is, "
+                              f"~{_mb(size)} is over the {_mb(max_bytes)} limit", fits=False)
+        source = max(copyable, key=_audio_rank)
+        return FormatPlan(source["format_id"], None, f"best audio ({source['format_id']}) copied as-is, size unknown",
+                          fits=None)
+
+    source = max(reencoded, key=_audio_rank)
+    # A re-encoded output's size depends on duration, not on the source
+    if duration:
+        size = int(AUDIO_OUTPUT_KBPS * 1000 / 8 * duration)
+        if size > max_bytes:
+            return FormatPlan(source["format_id"], size, f"{AUDIO_OUTPUT_KBPS}kbps audio is ~{_mb(size)}, over the {_mb(max_bytes)} limit", fits=False)
+        return FormatPlan(source["format_id"], size, f"best audio ({source['format_id']}), ~{_mb(size)} after conversion")
+    return FormatPlan(source["format_id"], None, f"best audio ({source['format_id']}), size unknown without a duration",
+                      fits=None)
+
+
+def _plan_video(video_only, audio_only, progressive, duration, max_bytes) -> FormatPlan:
+    options = []  # (rank, size, spec, description)
+    for v in video_only:
+        v_size = estimate_size(v, duration)
+        for a in audio_only:
+            a_size = estimate_size(a, duration)
+            if v_size is None or a_size is None:
+                continue
+            size = int((v_size + a_size) * MUX_OVERHEAD_RATIO) + MUX_OVERHEAD_BYTES
+            options.append(((_video_rank(v), _audio_rank(a)), size, f"{v['format_id']}+{a['format_id']}",
+                            f"{v.get('height') or '?'}p video + {a.get('abr') or '?'}kbps audio"))
+    for f in progressive:
+        size = estimate_size(f, duration)
+        if size is not None:
+            options.append(((_video_rank(f), _audio_rank(f)), size, f["format_id"], f"{f.get('height') or '?'}p single file"))
+
+    if not options:
+        # Nothing to compare against the limit: take the lowest quality, the
+        # likeliest to fit, and leave the final check to the downloaded file
+        if progressive:
+            f = min(progressive, key=_video_rank)
+            return FormatPlan(f["format_id"], None, f"no size known, lowest quality single file "
+                              f"({f.get('height') or '?'}p) chosen", fits=None)
+        if video_only and audio_only:
+            v, a = min(video_only, key=_video_rank), min(audio_only, key=_audio_rank)
+            return FormatPlan(f"{v['format_id']}+{a['format_id']}", None, f"no size known, lowest quality video "
+                              f"({v.get('height') or '?'}p) and audio chosen", fits=None)
+        return FormatPlan(DEFAULT_FORMATS["video"], None, "no video format listed", fits=False)
+
+    fitting = [o for o in options if o[1] <= max_bytes]
+    if not fitting:
+        smallest = min(options, key=lambda o: o[1])
+        return FormatPlan(smallest[2], smallest[1], f"smallest option ({smallest[3]}) is ~{_mb(smallest[1])}, over the {_mb(max_bytes)} limit", fits=False)
+    best = max(fitting, key=lambda o: (o[0], -o[1]))
+    return FormatPlan(best[2], best[1], f"{best[3]}, ~{_mb(best[1])} of {_mb(max_bytes)}")
+
+
+def compact_formats(info: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """Formats of ``info`` grouped by resolution and codec, best first.
+
+    Each group is represented by its best format. A video-only format's size
+    includes the best audio it would be merged with.
+    """
+    duration = info.get("duration")
+    formats = [f for f in info.get("formats") or [] if _is_media(f)]
+    audio_only = [f for f in formats if f.get("vcodec") == "none"]
+    best_audio = max(audio_only, key=_audio_rank, default=None)
+    best_audio_size = estimate_size(best_audio, duration) if best_audio else None
+
+    videos: Dict[Tuple, Dict[str, Any]] = {}
+    audios: Dict[str, Dict[str, Any]] = {}
+    for f in formats:
+        if f.get("vcodec") == "none":
+            key = codec_name(f.get("acodec"))
+            if key not in audios or _audio_rank(f) > _audio_rank(audios[key]):
+                audios[key] = f
+        else:
+            key = (f.get("height") or 0, round(f.get("fps") or 0), codec_name(f.get("vcodec")))
+            if key not in videos or _video_rank(f) > _video_rank(videos[key]):
+                videos[key] = f
+
+    video_list = []
+    for f in sorted(videos.values(), key=_video_rank, reverse=True):
+        size = estimate_size(f, duration)
+        if f.get("acodec") == "none":
+            size = (int((size + best_audio_size) * MUX_OVERHEAD_RATIO) + MUX_OVERHEAD_BYTES
+                    if size is not None and best_audio_size is not None else None)
+        video_list.append({
+            "format_id": f["format_id"],
+            "resolution": f"{f['height']}p" if f.get("height") else f.get("resolution"),
+            "fps": f.get("fps"),
+            "codec": codec_name(f.get("vcodec")),
+            "ext": f.get("ext"),
+            "estimated_size": size,
+        })
+    audio_list = [
+        {
+            "format_id": f["format_id"],
+            "codec": codec_name(f.get("acodec")),
+            "abr": f.get("abr"),
+            "ext": f.get("ext"),
+            "estimated_size": estimate_size(f, duration),
+        }
+        for f in sorted(audios.values(), key=_audio_rank, reverse=True)
+    ]
+    return {"formats": video_list, "audio_formats": audio_list}
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+from downloader import downloader
+from metrics import Gauge, trace
+
+# Number of downloads running at the same time, the rest wait in the queue
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+# Finished jobs are forgotten after this many seconds
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))
+# Minimum delay between two progress notifications of the same job
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "0.5"))
+
+
+class DownloadJob:
+    def __init__(self, url: str, format_type: str, max_filesize_mb: Optional[int] = None,
+                 owner_id: Optional[int] = None):
+        self.id = str(uuid.uuid4())
+        self.owner_id = owner_id  # user who asked for it, the only one who sees it
+        self.url = url
+        self.format_type = format_type
+        self.max_filesize_mb = max_filesize_mb
+        self.status = "queued"  # queued, running, finished, failed
+        self.progress: Dict[str, Any] = {}
+        self.result: Optional[Dict[str, str]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "url": self.url,
+            "format_type": self.format_type,
+            "status": self.status,
+            "progress": self.progress,
+            "title": self.result["title"] if self.result else None,
+            "file_url": f"/downloader/jobs/{self.id}/file" if self.result else None,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    def __init__(self, workers: int = DOWNLOAD_WORKERS, job_ttl: int = JOB_TTL):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        self.job_ttl = job_ttl
+        self.jobs: Dict[str, DownloadJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, url: str, format_type: str = "video", max_filesize_mb: Optional[int] = None,
+               on_update: Optional[Callable[[DownloadJob], None]] = None,
+               owner_id: Optional[int] = None) -> DownloadJob:
+        """Queue a download and return its job right away."""
+        self.prune()
+        job = DownloadJob(url, format_type, max_filesize_mb, owner_id)
+        with self._lock:
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job, on_update)
+        return job
+
+    def get(self, job_id: str, owner_id: Optional[int] = None) -> Optional[DownloadJob]:
+        """The job, or None when it doesn't exist or belongs to someone other than ``owner_id``."""
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None or job.owner_id != owner_id:
+            return None
+        return job
+
+    def prune(self):
+        """Drop expired jobs, their files stay in the media cache."""
+        deadline = time.time() - self.job_ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self.jobs.items() if job.finished_at and job.finished_at < deadline]
+            for job_id in expired:
+                del self.jobs[job_id]
+
+    def counts(self) -> Dict[str, int]:
+        """Number of known jobs in each status."""
+        counts = dict.fromkeys(("queued", "running", "finished", "failed"), 0)
+        with self._lock:
+            for job in self.jobs.values():
+                counts[job.status] += 1
+        return counts
+
+    def _run(self, job: DownloadJob, on_update: Optional[Callable[[DownloadJob], None]]):
+        last_sent = 0.0
+
+        def notify(force: bool = False):
+            nonlocal last_sent
+            now = time.monotonic()
+            if on_update and (force or now - last_sent >= PROGRESS_INTERVAL):
+                last_sent = now
+                try:
+                    on_update(job)
+                except Exception:
+                    pass
+
+        def progress_hook(d: Dict[str, Any]):
+            job.progress = {
+                "downloaded_bytes": d.get("downloaded_bytes"),
+                "total_bytes": d.get("total_bytes") or d.get("total_bytes_estimate"),
+                "speed": d.get("speed"),
+                "eta": d.get("eta"),
+            }
+            notify(force=d.get("status") == "finished")
+
+        job.status = "running"
+        notify(force=True)
+        try:
+            with trace("job", job=job.id, url=job.url, format_type=job.format_type):
+                job.result = downloader.download_cached(job.url, job.format_type, job.max_filesize_mb, progress_hook=progress_hook)
+            job.status = "finished"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        job.finished_at = time.time()
+        notify(force=True)
+
+
+job_manager = JobManager()
+
+Gauge("download_jobs", "Background download jobs by status", ("status",),
+      collect=lambda: {(status,): count for status, count in job_manager.counts().items()})
@@ -1,16 +1,39 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Request, BackgroundTasks, Query
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from sqlmodel import SQLModel, Session, select
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.exc import IntegrityError
 from datetime import timedelta
-from models import User, UserRead, Friendship, Post, Comment, Reaction
-from schemas import PostCreate, PostRead, CommentCreate, CommentRead, ReactionCreate, ReactionRead
-from auth import get_password_hash, verify_password, create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, get_current_user
-from database import engine, get_db
-from typing import List
+from models import User, UserCreate, UserRead, Friendship, Post, Comment, Reaction
+from schemas import PostCreate, PostRead, PostPage, PostCounts, CommentCreate, CommentRead, ReactionCreate, ReactionRead, BatchDownload
+from auth import get_password_hash_async, verify_password_async, create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, get_current_user
+from database import engine, ensure_keys, get_db
+from typing import List, Optional
+from urllib.parse import quote
+import asyncio
+import json
 import os
-from downloader import downloader
+import time
+from downloader import downloader, clean_title, normalize_url
+from failures import CircuitOpen
+from format_planner import AUDIO_CODECS, NoFittingFormat
+from jobs import job_manager
+from media_cache import media_cache
+from scratch import StorageFull, scratch_storage
+from streaming import plan_stream
+from thumbnails import THUMBNAIL_RETENTION_SECONDS, THUMBNAIL_WIDTHS, NoThumbnail, resized_thumbnail
+from file_serving import serve_file, content_disposition
+from fitting import STRATEGIES
+from batch import expand_urls, stream_zip
+from metrics import HTTP_IN_PROGRESS, HTTP_REQUEST_SECONDS, registry, trace
+from feed import POSTS_PAGE_SIZE
+from timeline import add_post, fan_out_post, fetch_timeline_page, friendship_accepted
+from realtime import manager
+from counters import counter_store
 
 # Social Network API & alexDownloader
 # To start the Telegram Bot, run: .\venv\Scripts\python.exe telegram_bot.py
@@ -25,39 +48,81 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Disposition"],
+    expose_headers=["Content-Disposition", "Content-Location", "Content-Range", "Accept-Ranges", "ETag"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = 500
+    HTTP_IN_PROGRESS.inc()
+    try:
+        with trace("request", method=request.method, path=request.url.path):
+            response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        HTTP_IN_PROGRESS.dec()
+        # Route templates keep the number of label values bounded
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method,
+                                     route=route.path if route else "unmatched", status=str(status_code))
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
 # Database Setup
 @app.on_event("startup")
 def on_startup():
     SQLModel.metadata.create_all(engine)
+    ensure_keys(SQLModel.metadata, engine)
+
+@app.on_event("startup")
+async def start_realtime():
+    await manager.start()
+
+@app.on_event("shutdown")
+async def stop_realtime():
+    await manager.stop()
+
+@app.on_event("startup")
+async def start_counters():
+    await counter_store.start()
+
+@app.on_event("shutdown")
+async def stop_counters():
+    await counter_store.stop()
 
 @app.post("/register", response_model=UserRead)
-def register(user_data: UserCreate, db: Session = Depends(get_db)):
-    db_user = db.exec(select(User).where(User.username == user_data.username)).first()
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = (await db.exec(select(User).where(User.username == user_data.username))).first()
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
+    # Give the connection back to the pool while the password is hashed
+    await db.close()
     
     user = User(
         username=user_data.username,
         email=user_data.email,
         full_name=user_data.full_name,
-        hashed_password=get_password_hash(user_data.password),
+        hashed_password=await get_password_hash_async(user_data.password),
         profile_pic=user_data.profile_pic,
         bio=user_data.bio,
         language=user_data.language,
         theme=user_data.theme
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
     return user
 
 @app.post("/token")
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.exec(select(User).where(User.username == form_data.username)).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = (await db.exec(select(User).where(User.username == form_data.username))).first()
+    # Give the connection back to the pool while the password is checked
+    await db.close()
+    if not user or not await verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -75,156 +140,321 @@ async def read_users_me(current_user: User = Depends(get_current_user)):
 
 # Friend Requests
 @app.post("/friends/request/{friend_id}")
-async def send_friend_request(friend_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def send_friend_request(friend_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
     if friend_id == current_user.id:
         raise HTTPException(status_code=400, detail="Cannot add yourself")
     
-    existing = db.exec(select(Friendship).where(
+    existing = (await db.exec(select(Friendship).where(
         ((Friendship.user_id == current_user.id) & (Friendship.friend_id == friend_id)) |
         ((Friendship.user_id == friend_id) & (Friendship.friend_id == current_user.id))
-    )).first()
+    ))).first()
     
     if existing:
         raise HTTPException(status_code=400, detail="Friendship or request already exists")
     
     friendship = Friendship(user_id=current_user.id, friend_id=friend_id, status="pending")
     db.add(friendship)
-    db.commit()
+    await db.commit()
     return {"message": "Friend request sent"}
 
 @app.get("/friends/requests", response_model=List[UserRead])
-async def get_friend_requests(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    friendships = db.exec(select(Friendship).where(Friendship.friend_id == current_user.id, Friendship.status == "pending")).all()
+async def get_friend_requests(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    friendships = (await db.exec(select(Friendship).where(Friendship.friend_id == current_user.id, Friendship.status == "pending"))).all()
     user_ids = [f.user_id for f in friendships]
-    users = db.exec(select(User).where(User.id.in_(user_ids))).all()
+    users = (await db.exec(select(User).where(User.id.in_(user_ids)))).all()
     return users
 
 @app.post("/friends/accept/{sender_id}")
-async def accept_friend_request(sender_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    friendship = db.exec(select(Friendship).where(
+async def accept_friend_request(sender_id: int, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db),
+                                current_user: User = Depends(get_current_user)):
+    friendship = (await db.exec(select(Friendship).where(
         Friendship.user_id == sender_id, 
         Friendship.friend_id == current_user.id, 
         Friendship.status == "pending"
-    )).first()
+    ))).first()
     
     if not friendship:
         raise HTTPException(status_code=404, detail="Request not found")
     
     friendship.status = "accepted"
     db.add(friendship)
-    db.commit()
+    await db.commit()
+    background_tasks.add_task(friendship_accepted, sender_id, current_user.id)
     return {"message": "Friend request accepted"}
 
 # Posts
 @app.post("/posts", response_model=PostRead)
-async def create_post(post_data: PostCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_post(post_data: PostCreate, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db),
+                      current_user: User = Depends(get_current_user)):
     post = Post(content=post_data.content, image_url=post_data.image_url, user_id=current_user.id)
     db.add(post)
-    db.commit()
-    db.refresh(post)
+    await db.commit()
+    await db.refresh(post)
+    await db.run_sync(add_post, post)
+    background_tasks.add_task(fan_out_post, post.id)
     return post
 
-@app.get("/posts", response_model=List[PostRead])
-async def get_posts(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # In a real app, we would only get friends' posts. For now, get all.
-    return db.exec(select(Post).order_by(Post.created_at.desc())).all()
+@app.get("/posts", response_model=PostPage)
+async def get_posts(cursor: Optional[str] = None, limit: int = POSTS_PAGE_SIZE,
+                    db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    """Home feed, the user's and their friends' posts newest first; pass ``next_cursor`` of a page as ``cursor`` to get the next one."""
+    try:
+        return await db.run_sync(fetch_timeline_page, current_user.id, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Most posts whose counts can be asked for at once
+POST_COUNTS_MAX_IDS = int(os.getenv("POST_COUNTS_MAX_IDS", "200"))
+
+@app.get("/posts/counts", response_model=List[PostCounts])
+async def get_post_counts(ids: List[int] = Query(...), db: AsyncSession = Depends(get_db),
+                          current_user: User = Depends(get_current_user)):
+    """Comment and reaction counts of many posts, e.g. ``?ids=1&ids=2``."""
+    if len(ids) > POST_COUNTS_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {POST_COUNTS_MAX_IDS} ids")
+    counts = await db.run_sync(counter_store.load, ids)
+    return list(counts.values())
 
 # Comments
 @app.post("/comments", response_model=CommentRead)
-async def create_comment(comment_data: CommentCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_comment(comment_data: CommentCreate, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
     comment = Comment(content=comment_data.content, post_id=comment_data.post_id, user_id=current_user.id)
     db.add(comment)
-    db.commit()
-    db.refresh(comment)
+    await db.commit()
+    counter_store.comment_added(comment.post_id)
     return comment
 
 # Reactions
 @app.post("/reactions", response_model=ReactionRead)
-async def react_to_post(reaction_data: ReactionCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def react_to_post(reaction_data: ReactionCreate, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
     # Check if existing reaction
-    existing = db.exec(select(Reaction).where(Reaction.post_id == reaction_data.post_id, Reaction.user_id == current_user.id)).first()
+    existing = (await db.exec(select(Reaction).where(Reaction.post_id == reaction_data.post_id, Reaction.user_id == current_user.id))).first()
+    previous = existing.type if existing else None
+    if previous == reaction_data.type:
+        # Tapping the same reaction again changes nothing
+        return existing
     if existing:
         existing.type = reaction_data.type
-        db.add(existing)
     else:
         existing = Reaction(type=reaction_data.type, post_id=reaction_data.post_id, user_id=current_user.id)
+    db.add(existing)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Another request created the reaction meanwhile (unique post/user), update it instead
+        await db.rollback()
+        existing = (await db.exec(select(Reaction).where(Reaction.post_id == reaction_data.post_id, Reaction.user_id == current_user.id))).one()
+        previous = existing.type
+        existing.type = reaction_data.type
         db.add(existing)
-    db.commit()
-    db.refresh(existing)
+        await db.commit()
+    # Counts are written behind, in batches
+    counter_store.reaction_changed(reaction_data.post_id, previous, reaction_data.type)
     return existing
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict[int, WebSocket] = {}
-
-    async def connect(self, user_id: int, websocket: WebSocket, db: Session):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        # Update online status
-        user = db.get(User, user_id)
-        if user:
-            user.is_online = True
-            db.add(user)
-            db.commit()
-
-    def disconnect(self, user_id: int, db: Session):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-        # Update offline status
-        user = db.get(User, user_id)
-        if user:
-            user.is_online = False
-            db.add(user)
-            db.commit()
-
-    async def send_personal_message(self, message: str, user_id: int):
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_text(message)
-
-manager = ConnectionManager()
-
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: int):
-    db_gen = get_db()
-    db = next(db_gen)
-    await manager.connect(user_id, websocket, db)
+    await manager.connect(user_id, websocket)
     try:
         while True:
             data = await websocket.receive_text()
-            # Handle messages
+            # Handle messages, any message also counts as a heartbeat
+            manager.heartbeat(user_id)
     except WebSocketDisconnect:
-        manager.disconnect(user_id, db)
+        pass
     finally:
-        db.close()
+        await manager.disconnect(user_id, websocket)
 
 # Media Downloader Endpoints
-def remove_file(path: str):
-    if os.path.exists(path):
-        os.remove(path)
+def circuit_open(e: CircuitOpen) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after) + 1)})
 
 @app.get("/downloader/info")
-async def get_media_info(url: str):
+async def get_media_info(url: str, compact: bool = False):
+    """Media metadata, ``compact`` groups formats and adds resized thumbnails served by this API."""
     try:
-        return downloader.get_info(url)
+        info = await run_in_threadpool(downloader.get_info, url, None, compact)
+    except CircuitOpen as e:
+        raise circuit_open(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    if compact and info.get("thumbnail"):
+        info["thumbnails"] = [
+            {"width": width, "url": f"/downloader/thumbnail?url={quote(url, safe='')}&width={width}"}
+            for width in THUMBNAIL_WIDTHS
+        ]
+    return info
+
+@app.get("/downloader/thumbnail")
+async def get_thumbnail(request: Request, url: str, width: Optional[int] = None):
+    """Thumbnail of the media at ``url`` as JPEG, resized to the next standard width."""
+    def source_url() -> Optional[str]:
+        return downloader.extract_info(url).get("thumbnail")
+
+    try:
+        path = await run_in_threadpool(resized_thumbnail, normalize_url(url), width, source_url)
+    except NoThumbnail:
+        raise HTTPException(status_code=404, detail="No thumbnail")
+    except CircuitOpen as e:
+        raise circuit_open(e)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    # Resized copies don't change, browsers and shared caches can keep them as long as we do
+    return serve_file(request, path, "thumbnail.jpg", cache_control=f"public, max-age={THUMBNAIL_RETENTION_SECONDS}",
+                      disposition="inline")
 
 @app.post("/downloader/download")
-async def download_media(url: str, format_type: str = "video", background_tasks: BackgroundTasks = None):
+async def download_media(request: Request, url: str, format_type: str = "video", stream: bool = False,
+                         max_filesize_mb: Optional[int] = None, oversize: Optional[str] = None, audio_codec: str = "mp3"):
+    """Download media, ``oversize`` ("transcode" or "split") makes results fit ``max_filesize_mb``.
+
+    ``audio_codec`` other than mp3 (m4a, opus or best) avoids re-encoding
+    when the source already uses that codec. ``stream`` relays the upstream
+    media without a temp file; it can't be combined with ``max_filesize_mb``.
+    """
+    if oversize and oversize not in STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"oversize must be one of {', '.join(STRATEGIES)}")
+    if audio_codec not in AUDIO_CODECS:
+        raise HTTPException(status_code=400, detail=f"audio_codec must be one of {', '.join(AUDIO_CODECS)}")
+    if stream and max_filesize_mb:
+        # A streamed response is sent as it arrives, its size can't be checked first
+        raise HTTPException(status_code=400, detail="stream can't be combined with max_filesize_mb")
+    if stream:
+        # Relay upstream bytes directly, falls back to a regular download when
+        # the selected formats can't be streamed (e.g. DASH fragments)
+        try:
+            info = await run_in_threadpool(downloader.extract_info, url)
+            media = await run_in_threadpool(plan_stream, info, format_type)
+        except CircuitOpen as e:
+            raise circuit_open(e)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        if media:
+            try:
+                await media.open()
+            except Exception as e:
+                raise HTTPException(status_code=502, detail=f"Upstream media failed: {e}")
+            headers = {"Content-Disposition": content_disposition(f"{clean_title(info)}.{media.ext}")}
+            if media.content_length is not None:
+                headers["Content-Length"] = str(media.content_length)
+            # Closes the upstream connection even when the body is never iterated
+            return StreamingResponse(media.body(), media_type=media.media_type, headers=headers,
+                                     background=BackgroundTask(media.close))
     try:
-        data = downloader.download_media(url, format_type)
-        file_path = data["path"]
-        title = data["title"]
-        
-        if background_tasks:
-            background_tasks.add_task(remove_file, file_path)
-        
-        ext = "mp3" if format_type == "audio" else "mp4"
-        filename = f"{title}.{ext}"
-        
-        return FileResponse(
-            path=file_path,
-            filename=filename,
-            media_type='application/octet-stream'
-        )
+        # Files are owned by the media cache, so they are not removed after sending
+        data = await run_in_threadpool(downloader.download_cached, url, format_type, max_filesize_mb,
+                                       oversize=oversize, audio_codec=audio_codec)
+    except NoFittingFormat as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except StorageFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "60"})
+    except CircuitOpen as e:
+        raise circuit_open(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if len(data["parts"]) > 1:
+        # Split results are listed, each part is fetched from the files endpoint
+        return {
+            "title": data["title"],
+            "parts": [
+                {
+                    "url": f"/downloader/files/{part['key']}?name={quote(data['title'])}.part{i + 1}{os.path.splitext(part['path'])[1]}",
+                    "size": os.path.getsize(part["path"]),
+                }
+                for i, part in enumerate(data["parts"])
+            ],
+        }
+    file_path = data["path"]
+    filename = data["title"] + os.path.splitext(file_path)[1]
+    response = serve_file(request, file_path, filename, root=media_cache.root)
+    # Where the client can resume or re-fetch the file with GET + Range
+    response.headers["Content-Location"] = f"/downloader/files/{data['key']}"
+    return response
+
+@app.post("/downloader/batch")
+async def download_batch(batch: BatchDownload):
+    """Download several URLs (or playlists) in parallel, streamed back as one ZIP.
+
+    The archive ends with ``status.json`` listing the result of every entry,
+    entries past the batch limit are listed there as skipped.
+    """
+    if batch.audio_codec not in AUDIO_CODECS:
+        raise HTTPException(status_code=400, detail=f"audio_codec must be one of {', '.join(AUDIO_CODECS)}")
+    try:
+        urls, skipped = await run_in_threadpool(expand_urls, batch.urls)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not urls:
+        raise HTTPException(status_code=400, detail="No media found")
+    headers = {"Content-Disposition": content_disposition("alexDownloader.zip")}
+    return StreamingResponse(stream_zip(urls, batch.format_type, batch.audio_codec, skipped), media_type="application/zip",
+                             headers=headers)
+
+@app.get("/downloader/files/{key}")
+async def get_media_file(request: Request, key: str, name: Optional[str] = None):
+    path = media_cache.get(key)
+    if not path:
+        raise HTTPException(status_code=404, detail="File expired or not found")
+    filename = name or os.path.basename(path)
+    return serve_file(request, path, filename, root=media_cache.root, cache_control="public, max-age=86400")
+
+@app.get("/downloader/plan")
+async def get_download_plan(url: str, format_type: str = "video", max_filesize_mb: Optional[int] = None, audio_codec: str = "mp3"):
+    """Formats that a download with these settings would use, and why."""
+    try:
+        info = await run_in_threadpool(downloader.extract_info, url)
+    except CircuitOpen as e:
+        raise circuit_open(e)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return downloader.plan(info, format_type, max_filesize_mb, audio_codec).to_dict()
+
+@app.get("/downloader/cache")
+async def get_media_cache_stats():
+    return media_cache.stats()
+
+@app.get("/downloader/engine")
+async def get_download_engine_stats():
+    return downloader.engine.stats()
+
+@app.get("/downloader/storage")
+async def get_scratch_storage_stats():
+    return scratch_storage.stats()
+
+@app.get("/downloader/circuits")
+async def get_circuit_breaker_state():
+    """Sites whose extractions or downloads failed recently, and whether requests to them fail fast."""
+    return downloader.breaker.state()
+
+@app.post("/downloader/jobs")
+async def create_download_job(url: str, format_type: str = "video", max_filesize_mb: Optional[int] = None,
+                              current_user: User = Depends(get_current_user)):
+    """Queue a download, progress is pushed to the user's websocket."""
+    loop = asyncio.get_running_loop()
+    user_id = current_user.id
+
+    def notify(job):
+        message = json.dumps({"type": "download_progress", **job.to_dict()})
+        asyncio.run_coroutine_threadsafe(manager.send_personal_message(message, user_id), loop)
+
+    job = job_manager.submit(url, format_type, max_filesize_mb, on_update=notify, owner_id=user_id)
+    return job.to_dict()
+
+@app.get("/downloader/jobs/{job_id}")
+async def get_download_job(job_id: str, current_user: User = Depends(get_current_user)):
+    # Other users' jobs are reported as missing, their ids don't leak either
+    job = job_manager.get(job_id, current_user.id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/downloader/jobs/{job_id}/file")
+async def get_download_job_file(request: Request, job_id: str, current_user: User = Depends(get_current_user)):
+    job = job_manager.get(job_id, current_user.id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != "finished":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    path = media_cache.get(job.result["key"])
+    if not path:
+        raise HTTPException(status_code=410, detail="File expired")
+    return serve_file(request, path, job.result["title"] + os.path.splitext(path)[1], root=media_cache.root)
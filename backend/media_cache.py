@@ -0,0 +1,165 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional
+from metrics import watch_cache
+
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "alexdownloader-cache"))
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_MB", "2048")) * 1024 * 1024
+# Files are kept at least until clients had a chance to fetch or resume them
+MEDIA_RETENTION_SECONDS = int(os.getenv("MEDIA_RETENTION_SECONDS", str(24 * 3600)))
+
+
+class MediaCache:
+    """Persistent LRU cache of downloaded files under a byte budget.
+
+    Entries are published atomically: producers write into ``tmp_dir`` and the
+    finished file is renamed into place. Concurrent requests for a key that is
+    being produced wait for that single producer instead of starting their own.
+    """
+
+    def __init__(self, root: str = MEDIA_CACHE_DIR, max_bytes: int = MEDIA_CACHE_MAX_BYTES,
+                 retention: int = MEDIA_RETENTION_SECONDS):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def make_key(media_id: str, format_type: str, max_filesize_mb: Optional[int] = None) -> str:
+        raw = f"{media_id}|{format_type}|{max_filesize_mb or ''}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _load(self):
+        """Index files left by a previous run, oldest access first."""
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                found.append((stat.st_atime, os.path.splitext(name)[0], path, stat.st_size, stat.st_mtime))
+        for _, key, path, size, created_at in sorted(found):
+            self.entries[key] = {"path": path, "size": size, "created_at": created_at}
+            self.total_bytes += size
+        self._evict()
+
+    def _is_live(self, entry: Optional[Dict[str, Any]]) -> bool:
+        return (entry is not None and time.time() - entry["created_at"] < self.retention
+                and os.path.exists(entry["path"]))
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if not self._is_live(entry):
+                return None
+            self.entries.move_to_end(key)
+            return entry["path"]
+
+    def get_or_create(self, key: str, producer: Callable[[str], str]) -> str:
+        """Return the cached path for ``key``, running ``producer`` on a miss.
+
+        ``producer`` receives the directory to write into and returns the path
+        of the file it created there.
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if self._is_live(entry):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["path"]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+
+        try:
+            path = self.put(key, producer(self.tmp_dir))
+            future.set_result(path)
+            return path
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def put(self, key: str, src: str) -> str:
+        """Move a finished file into the cache and return its new path."""
+        dest = os.path.join(self.root, key + os.path.splitext(src)[1])
+        os.replace(src, dest)
+        size = os.path.getsize(dest)
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.total_bytes -= old["size"]
+            self.entries[key] = {"path": dest, "size": size, "created_at": time.time()}
+            self.total_bytes += size
+            self._evict()
+        return dest
+
+    def _evict(self):
+        deadline = time.time() - self.retention
+        for key in [k for k, e in self.entries.items() if e["created_at"] < deadline]:
+            self._remove(key)
+        # Always keep the most recent entry, even if it alone exceeds the budget
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry["size"]
+        self.evictions += 1
+        try:
+            os.remove(entry["path"])
+        except OSError:
+            pass
+
+    def discard(self, key: str):
+        """Drop an entry that turned out to be unusable."""
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.total_bytes -= entry["size"]
+        if entry:
+            try:
+                os.remove(entry["path"])
+            except OSError:
+                pass
+
+    def purge_expired(self):
+        with self._lock:
+            self._evict()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+
+media_cache = MediaCache()
+watch_cache("media", media_cache)
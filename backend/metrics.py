@@ -0,0 +1,281 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Log the stage timings of every request / bot download as one JSON line
+TRACE_LOG = os.getenv("TRACE_LOG", "0") == "1"
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+trace_logger = logging.getLogger("alexdownloader.trace")
+if TRACE_LOG and not trace_logger.handlers:
+    trace_logger.addHandler(logging.StreamHandler())
+    trace_logger.setLevel(logging.INFO)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List["Metric"] = []
+
+    def register(self, metric: "Metric"):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[Tuple, float]]] = None):
+        """``collect`` computes the samples at scrape time, as ``{label values: value}``."""
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._values: Dict[Tuple, Any] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _samples(self) -> List[str]:
+        if self.collect:
+            try:
+                values = self.collect()
+            except Exception:
+                return []
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, [str(v) for v in key])} {value}" for key, value in values.items()]
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + self._samples()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        names = self.labelnames + ("le",)
+        lines = []
+        for key, counts in values.items():
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(names, key + (str(bound),))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(names, key + ('+Inf',))} {counts[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {counts[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("download_stage_seconds", "Time spent in each stage of a download", ("stage",))
+STAGE_ERRORS = Counter("download_stage_errors_total", "Stages that ended with an error", ("stage",))
+DOWNLOADED_BYTES = Counter("download_bytes_total", "Bytes received from media hosts", ("priority",))
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "API request latency until the response starts",
+                                 ("method", "route", "status"))
+HTTP_IN_PROGRESS = Gauge("http_requests_in_progress", "API requests being handled")
+
+_caches: Dict[str, Any] = {}
+
+
+def _cache_stat(stat: str) -> Callable[[], Dict[Tuple, float]]:
+    def collect():
+        stats = {name: cache.stats() for name, cache in list(_caches.items())}
+        return {(name,): values[stat] for name, values in stats.items() if stat in values}
+    return collect
+
+
+CACHE_HITS = Counter("cache_hits_total", "Lookups answered from a cache", ("cache",), collect=_cache_stat("hits"))
+CACHE_MISSES = Counter("cache_misses_total", "Lookups that missed a cache", ("cache",), collect=_cache_stat("misses"))
+CACHE_ENTRIES = Gauge("cache_entries", "Entries held by a cache", ("cache",), collect=_cache_stat("entries"))
+CACHE_BYTES = Gauge("cache_bytes", "Bytes held by an on-disk cache", ("cache",), collect=_cache_stat("bytes"))
+
+
+def watch_cache(name: str, cache: Any):
+    """Export the ``stats()`` of a cache (hits, misses, entries and bytes when present)."""
+    _caches[name] = cache
+
+
+class Trace:
+    def __init__(self, name: str, **attrs):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float, error: Optional[BaseException] = None):
+        span = {"stage": stage, "seconds": round(seconds, 4)}
+        if error is not None:
+            span["error"] = str(error)[:200]
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace": self.id,
+            "name": self.name,
+            **self.attrs,
+            "seconds": round(time.time() - self.started_at, 4),
+            "spans": self.spans,
+        }
+
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+
+
+@contextmanager
+def trace(name: str, **attrs):
+    """Collect the spans recorded in this context (threads started with a copy of it included)."""
+    current = Trace(name, **attrs)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        if TRACE_LOG:
+            trace_logger.info(json.dumps(current.to_dict()))
+
+
+def record(stage: str, seconds: float, error: Optional[BaseException] = None):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if error is not None:
+        STAGE_ERRORS.inc(stage=stage)
+    current = _current_trace.get()
+    if current is not None:
+        current.add(stage, seconds, error)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a block as ``stage``."""
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        record(stage, time.perf_counter() - start, error)
+
+
+class StageTimer:
+    """Times the transfer stage of one yt-dlp run using its progress hooks.
+
+    Post-processing runs outside yt-dlp and is timed by its own spans.
+    """
+
+    def __init__(self):
+        self.stage: Optional[str] = None
+        self.started = 0.0
+        self._lock = threading.Lock()
+
+    def _switch(self, stage: Optional[str], error: Optional[BaseException] = None):
+        now = time.perf_counter()
+        with self._lock:
+            previous, started = self.stage, self.started
+            self.stage, self.started = stage, now
+        if previous:
+            record(previous, now - started, error)
+
+    def progress_hook(self, d: Dict[str, Any]):
+        if self.stage is None and d.get("status") in ("downloading", "finished"):
+            self._switch("download")
+
+    def attach(self, ydl_opts: Dict[str, Any]):
+        ydl_opts["progress_hooks"] = list(ydl_opts.get("progress_hooks", [])) + [self.progress_hook]
+
+    def finish(self, error: Optional[BaseException] = None):
+        """Close the stage still running when yt-dlp returned or failed."""
+        self._switch(None, error)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve ``/metrics`` from a background thread, for processes without the API (the bot)."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
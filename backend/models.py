@@ -1,6 +1,7 @@
 from datetime import datetime
 from typing import List, Optional
-from sqlmodel import SQLModel, Field, Relationship
+from sqlmodel import SQLModel, Field, Relationship, UniqueConstraint
+from sqlalchemy import Index
 from pydantic import BaseModel
 
 class UserBase(SQLModel):
@@ -29,6 +30,12 @@ class UserRead(UserBase):
 
 # Friendships
 class Friendship(SQLModel, table=True):
+    # Lookups come from either side of the pair
+    __table_args__ = (
+        Index("ix_friendship_user_friend", "user_id", "friend_id"),
+        Index("ix_friendship_friend_user", "friend_id", "user_id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id")
     friend_id: int = Field(foreign_key="user.id")
@@ -37,6 +44,12 @@ class Friendship(SQLModel, table=True):
 
 # Social Media Content
 class Post(SQLModel, table=True):
+    # The feed pages through posts in (created_at, id) order, overall and per author
+    __table_args__ = (
+        Index("ix_post_created_at_id", "created_at", "id"),
+        Index("ix_post_user_created_id", "user_id", "created_at", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     content: str
     image_url: Optional[str] = None
@@ -47,19 +60,62 @@ class Post(SQLModel, table=True):
     comments: List["Comment"] = Relationship(back_populates="post")
     reactions: List["Reaction"] = Relationship(back_populates="post")
 
+# Home feed of each user: posts of their friends and their own, newest kept
+class TimelineEntry(SQLModel, table=True):
+    __table_args__ = (
+        UniqueConstraint("owner_id", "post_id"),
+        Index("ix_timelineentry_owner_created_post", "owner_id", "created_at", "post_id"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    owner_id: int = Field(foreign_key="user.id")
+    post_id: int = Field(foreign_key="post.id")
+    created_at: datetime # copy of the post's, the timeline is ordered like the feed
+
+# Timelines filled by a rebuild at least once, an empty one without this row predates timelines
+class BuiltTimeline(SQLModel, table=True):
+    owner_id: int = Field(foreign_key="user.id", primary_key=True)
+    built_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Users with too many friends to push their posts to, read from their posts instead
+class PulledAuthor(SQLModel, table=True):
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    friend_count: int
+
 class Comment(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     content: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
     user_id: int = Field(foreign_key="user.id")
-    post_id: int = Field(foreign_key="post.id")
+    post_id: int = Field(foreign_key="post.id", index=True)
 
     post: Post = Relationship(back_populates="comments")
 
 class Reaction(SQLModel, table=True):
+    # One reaction per user and post, also serves lookups by post
+    __table_args__ = (UniqueConstraint("post_id", "user_id"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     type: str = Field(default="like") # like, love, haha, etc.
     user_id: int = Field(foreign_key="user.id")
     post_id: int = Field(foreign_key="post.id")
 
     post: Post = Relationship(back_populates="reactions")
+
+# Comment and reaction counts of each post, written in batches by counters.py
+class PostCounter(SQLModel, table=True):
+    post_id: int = Field(foreign_key="post.id", primary_key=True)
+    kind: str = Field(primary_key=True, max_length=40) # "comment" or "reaction:<type>"
+    total: int = Field(default=0)
+
+# Telegram bot uploads, re-sent by file_id instead of downloading and uploading again
+class TelegramFile(SQLModel, table=True):
+    __table_args__ = (UniqueConstraint("media_id", "format_type"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    media_id: str = Field(index=True)
+    format_type: str
+    url: str = Field(index=True) # normalized URL of the last request for this media
+    file_id: str
+    title: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
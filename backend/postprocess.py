@@ -0,0 +1,211 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from download_engine import PRIORITY_WEIGHTS
+from ffmpeg_tools import run_ffmpeg
+from format_planner import AUDIO_EXTS, AUDIO_OUTPUT_KBPS, needs_reencode
+from metrics import Counter, Gauge, record, span
+from thumbnails import COVER_EXTS
+
+# ffmpeg jobs (merge, audio conversion, tagging) run at the same time, one per
+# core by default; downloads have their own limits in the download engine
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", str(os.cpu_count() or 1)))
+
+# Encoder of each audio output codec, used when the source can't be copied
+AUDIO_ENCODERS = {"mp3": "libmp3lame", "m4a": "aac", "opus": "libopus"}
+
+logger = logging.getLogger(__name__)
+
+POSTPROCESS_CPU_SECONDS = Counter("postprocess_cpu_seconds_total", "CPU time of post-processing jobs",
+                                  ("step", "priority"))
+POSTPROCESS_JOBS = Counter("postprocess_jobs_total", "Post-processing jobs run", ("step", "status"))
+
+_local = threading.local()
+
+
+class PostProcessJob:
+    def __init__(self, step: str, priority: str, fn: Callable[..., Any], args: Tuple):
+        self.step = step
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.future: Future = Future()
+        # Spans recorded by the job belong to the trace of the download that submitted it
+        self.context = contextvars.copy_context()
+        self.queued_at = time.monotonic()
+        self.cpu_seconds = 0.0
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        return self.future.result(timeout)
+
+
+def ffmpeg(args: List[str]):
+    """``run_ffmpeg``, its CPU time counted against the job running in this thread."""
+    cpu_seconds = run_ffmpeg(args)
+    job = getattr(_local, "job", None)
+    if job is not None:
+        job.cpu_seconds += cpu_seconds
+
+
+class PostProcessScheduler:
+    """Runs CPU-bound post-processing on a fixed number of worker threads.
+
+    Jobs wait in one queue per priority class. The class that used the least
+    CPU time (relative to its weight) goes next and each class runs its jobs
+    in order, so a burst of bot downloads can't hold API ones back for long.
+    """
+
+    def __init__(self, workers: int = POSTPROCESS_WORKERS, weights: Dict[str, float] = PRIORITY_WEIGHTS):
+        self.workers = max(1, workers)
+        self.weights = weights
+        self.served = {name: 0.0 for name in weights}
+        self.waiting: Dict[str, deque] = {name: deque() for name in weights}
+        self.running = 0
+        self._threads: List[threading.Thread] = []
+        self._cond = threading.Condition()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.waiting.values())
+
+    def submit(self, step: str, fn: Callable[..., Any], *args, priority: str = "api") -> PostProcessJob:
+        """Queue ``fn(*args)``, ``step`` names it in metrics and traces."""
+        if priority not in self.weights:
+            raise ValueError(f"priority must be one of {', '.join(self.weights)}")
+        job = PostProcessJob(step, priority, fn, args)
+        with self._cond:
+            # Started on first use, processes that never post-process don't get the threads
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f"postprocess-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            queue = self.waiting[priority]
+            if not queue:
+                # A class coming back from idle doesn't get credit for the time it was away
+                others = [self.served[name] for name, q in self.waiting.items() if q]
+                if others:
+                    self.served[priority] = max(self.served[priority], min(others))
+            queue.append(job)
+            self._cond.notify()
+        return job
+
+    def run(self, step: str, fn: Callable[..., Any], *args, priority: str = "api") -> Any:
+        """Submit and wait for the result."""
+        return self.submit(step, fn, *args, priority=priority).result()
+
+    def _next(self) -> PostProcessJob:
+        active = [name for name, queue in self.waiting.items() if queue]
+        return self.waiting[min(active, key=lambda name: self.served[name])].popleft()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self.queued:
+                    self._cond.wait()
+                job = self._next()
+                self.running += 1
+            try:
+                job.context.run(self._execute, job)
+            finally:
+                with self._cond:
+                    self.running -= 1
+                    self.served[job.priority] += job.cpu_seconds / self.weights[job.priority]
+
+    @staticmethod
+    def _execute(job: PostProcessJob):
+        record("postprocess_queue", time.monotonic() - job.queued_at)
+        _local.job = job
+        try:
+            with span(job.step):
+                result = job.fn(*job.args)
+        except BaseException as e:
+            POSTPROCESS_JOBS.inc(step=job.step, status="error")
+            job.future.set_exception(e)
+        else:
+            POSTPROCESS_JOBS.inc(step=job.step, status="ok")
+            job.future.set_result(result)
+        finally:
+            _local.job = None
+            POSTPROCESS_CPU_SECONDS.inc(job.cpu_seconds, step=job.step, priority=job.priority)
+            logger.debug("%s job used %.2fs of CPU", job.step, job.cpu_seconds)
+
+
+def metadata_args(info: Dict[str, Any]) -> List[str]:
+    tags = {
+        "title": info.get("title"),
+        "artist": info.get("artist") or info.get("creator") or info.get("uploader"),
+        "date": info.get("upload_date"),
+        "description": info.get("description"),
+        "comment": info.get("webpage_url"),
+    }
+    args = []
+    for name, value in tags.items():
+        if value:
+            args += ["-metadata", f"{name}={value}"]
+    return args
+
+
+def merge_video(inputs: List[Tuple[str, Dict[str, Any]]], output: str, info: Dict[str, Any],
+                cover: Optional[str] = None) -> str:
+    """Mux the downloaded formats into one MP4 with tags and cover, in a single ffmpeg pass.
+
+    ``inputs`` are (path, format) pairs; the first video and first audio
+    stream found are kept and copied as-is.
+    """
+    args, maps = [], []
+    has_video = has_audio = False
+    for i, (path, fmt) in enumerate(inputs):
+        args += ["-i", path]
+        if not has_video and fmt.get("vcodec") != "none":
+            maps += ["-map", f"{i}:v:0?"]
+            has_video = True
+        if not has_audio and fmt.get("acodec") != "none":
+            maps += ["-map", f"{i}:a:0?"]
+            has_audio = True
+    if cover:
+        args += ["-i", cover]
+        maps += ["-map", f"{len(inputs)}:v:0", f"-disposition:v:{int(has_video)}", "attached_pic"]
+    ffmpeg(args + maps + ["-c", "copy"] + metadata_args(info) + [output])
+    return output
+
+
+def extract_audio(path: str, fmt: Dict[str, Any], output_base: str, audio_codec: str, info: Dict[str, Any],
+                  cover: Optional[str] = None) -> str:
+    """Write the audio of ``path`` as ``audio_codec`` with tags and cover, in a single ffmpeg pass.
+
+    The stream is copied when the source already uses the codec; "best" keeps
+    the source codec when it has a known file type and re-encodes to mp3 otherwise.
+    """
+    acodec = fmt.get("acodec") or ""
+    if audio_codec == "best":
+        ext = next((ext for prefix, ext in AUDIO_EXTS.items() if acodec.startswith(prefix)), None)
+        copy = ext is not None
+        if not copy:
+            audio_codec = ext = "mp3"
+    else:
+        ext = audio_codec
+        copy = not needs_reencode(fmt, audio_codec)
+    output = f"{output_base}.{ext}"
+
+    args = ["-i", path]
+    maps = ["-map", "0:a:0"]
+    codecs = ["-c:a", "copy"] if copy else ["-c:a", AUDIO_ENCODERS[audio_codec], "-b:a", f"{AUDIO_OUTPUT_KBPS}k"]
+    if cover and f".{ext}" in COVER_EXTS:
+        args += ["-i", cover]
+        maps += ["-map", "1:v:0"]
+        codecs += ["-c:v", "copy", "-disposition:v:0", "attached_pic"]
+        if ext == "mp3":
+            codecs += ["-id3v2_version", "3"]
+    ffmpeg(args + maps + codecs + metadata_args(info) + [output])
+    return output
+
+
+postprocess_scheduler = PostProcessScheduler()
+
+Gauge("postprocess_jobs", "Post-processing jobs by state", ("state",),
+      collect=lambda: {("running",): postprocess_scheduler.running, ("queued",): postprocess_scheduler.queued})
@@ -0,0 +1,330 @@
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+from urllib.parse import urlparse
+from fastapi import WebSocket
+from sqlalchemy import update
+from sqlmodel import select
+from auth import user_cache
+from database import async_session
+from metrics import Counter, Gauge
+from models import User
+
+# memory:// for a single process, redis://[:password@]host:port for several
+# workers (any server speaking the Redis protocol)
+BROKER_URL = os.getenv("BROKER_URL", "memory://")
+# Seconds between two writes of the online flags to the database
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "5"))
+# Sockets that sent nothing (not even a heartbeat) for this many seconds are closed
+PRESENCE_TIMEOUT = float(os.getenv("PRESENCE_TIMEOUT", "90"))
+# A user stays online this long after their last socket closed, so reconnects don't flap
+PRESENCE_GRACE = float(os.getenv("PRESENCE_GRACE", "10"))
+# Users per UPDATE statement of a flush
+PRESENCE_BATCH_SIZE = int(os.getenv("PRESENCE_BATCH_SIZE", "500"))
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_WRITES = Counter("presence_writes_total", "Users whose online flag was written", ("state",))
+
+Handler = Callable[[str, str], Awaitable[None]]
+
+
+class BrokerError(Exception):
+    pass
+
+
+class Broker(ABC):
+    """Delivers messages published on a channel to the processes subscribed to it.
+
+    Subclasses implement ``publish``, the other methods keep the subscription
+    state they extend.
+    """
+
+    def __init__(self):
+        self.channels: Set[str] = set()
+        self.handler: Optional[Handler] = None
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+
+    async def stop(self):
+        pass
+
+    async def subscribe(self, channel: str):
+        self.channels.add(channel)
+
+    async def unsubscribe(self, channel: str):
+        self.channels.discard(channel)
+
+    @abstractmethod
+    async def publish(self, channel: str, message: str):
+        """Deliver ``message`` to every process subscribed to ``channel``, this one included."""
+
+
+class InMemoryBroker(Broker):
+    async def publish(self, channel: str, message: str):
+        if channel in self.channels and self.handler:
+            await self.handler(channel, message)
+
+
+def _encode(*args: str) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg.encode() if isinstance(arg, str) else arg
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Broker closed the connection")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise BrokerError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        return None if length < 0 else (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(rest)
+        return None if length < 0 else [await _read_reply(reader) for _ in range(length)]
+    raise BrokerError(f"Unexpected reply {line!r}")
+
+
+class RedisBroker(Broker):
+    """Pub/sub over the Redis protocol, one connection publishes and one listens."""
+
+    def __init__(self, url: str):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self._publisher: Optional[tuple] = None
+        self._publish_lock = asyncio.Lock()
+        self._subscriber: Optional[asyncio.StreamWriter] = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def _connect(self) -> tuple:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(_encode("AUTH", self.password))
+            await _read_reply(reader)
+        return reader, writer
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+        for writer in (self._subscriber, self._publisher and self._publisher[1]):
+            if writer:
+                writer.close()
+
+    async def _listen(self):
+        delay = 0.5
+        while True:
+            try:
+                reader, writer = await self._connect()
+                self._subscriber = writer
+                if self.channels:
+                    writer.write(_encode("SUBSCRIBE", *self.channels))
+                delay = 0.5
+                while True:
+                    reply = await _read_reply(reader)
+                    if isinstance(reply, list) and reply and reply[0] == b"message":
+                        await self.handler(reply[1].decode(), reply[2].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._subscriber = None
+                logger.warning(f"Broker subscription lost ({e}), reconnecting in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def subscribe(self, channel: str):
+        await super().subscribe(channel)
+        if self._subscriber:
+            self._subscriber.write(_encode("SUBSCRIBE", channel))
+
+    async def unsubscribe(self, channel: str):
+        await super().unsubscribe(channel)
+        if self._subscriber:
+            self._subscriber.write(_encode("UNSUBSCRIBE", channel))
+
+    async def publish(self, channel: str, message: str):
+        async with self._publish_lock:
+            # One reconnect when the connection went away since the last message
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = await self._connect()
+                    reader, writer = self._publisher
+                    writer.write(_encode("PUBLISH", channel, message))
+                    await _read_reply(reader)
+                    return
+                except (ConnectionError, OSError):
+                    self._publisher = None
+                    if attempt:
+                        raise
+
+
+def create_broker(url: str) -> Broker:
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return InMemoryBroker()
+    if scheme == "redis":
+        return RedisBroker(url)
+    raise ValueError(f"Unsupported broker URL {url}")
+
+
+class Presence:
+    """Who is online in this process, written to ``User.is_online`` in batches.
+
+    Connects, disconnects and heartbeats only touch memory; every flush sets
+    the users connected here online (again, so a concurrent offline write by
+    another worker is corrected) and the ones gone for PRESENCE_GRACE offline.
+    """
+
+    def __init__(self):
+        self.connections: Dict[int, int] = {}
+        self.last_seen: Dict[int, float] = {}
+        self.left_at: Dict[int, float] = {}
+
+    def connected(self, user_id: int):
+        self.connections[user_id] = self.connections.get(user_id, 0) + 1
+        self.left_at.pop(user_id, None)
+        self.heartbeat(user_id)
+
+    def disconnected(self, user_id: int):
+        self.connections[user_id] -= 1
+        if self.connections[user_id] <= 0:
+            del self.connections[user_id]
+            self.last_seen.pop(user_id, None)
+            self.left_at[user_id] = time.monotonic()
+
+    def heartbeat(self, user_id: int):
+        self.last_seen[user_id] = time.monotonic()
+
+    def stale(self) -> List[int]:
+        deadline = time.monotonic() - PRESENCE_TIMEOUT
+        return [user_id for user_id, seen in self.last_seen.items() if seen < deadline]
+
+    async def flush(self):
+        deadline = time.monotonic() - PRESENCE_GRACE
+        gone = [user_id for user_id, left_at in self.left_at.items() if left_at < deadline]
+        await self._write(list(self.connections), True)
+        # Skips the users who came back while the first write ran
+        await self._write([user_id for user_id in gone if user_id not in self.connections], False)
+        for user_id in gone:
+            if self.left_at.get(user_id, 0) < deadline:
+                self.left_at.pop(user_id, None)
+
+    async def _write(self, user_ids: List[int], online: bool):
+        for i in range(0, len(user_ids), PRESENCE_BATCH_SIZE):
+            batch = user_ids[i:i + PRESENCE_BATCH_SIZE]
+            async with async_session() as db:
+                # Only the rows that change, their cached users are dropped
+                changed = (await db.exec(select(User.id, User.username).where(
+                    User.id.in_(batch), User.is_online != online))).all()
+                if not changed:
+                    continue
+                await db.exec(update(User).where(User.id.in_([user_id for user_id, _ in changed])).values(is_online=online))
+                await db.commit()
+            PRESENCE_WRITES.inc(len(changed), state="online" if online else "offline")
+            for _, username in changed:
+                user_cache.pop(username)
+
+
+class ConnectionManager:
+    def __init__(self, broker: Broker):
+        self.broker = broker
+        self.presence = Presence()
+        self.active_connections: Dict[int, Set[WebSocket]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.broker.start(self._deliver)
+        self._flusher = asyncio.create_task(self._run_flusher())
+
+    async def stop(self):
+        if self._flusher:
+            self._flusher.cancel()
+        await self.broker.stop()
+        # Users still connected here are marked offline right away
+        for user_id in list(self.presence.connections):
+            self.presence.left_at[user_id] = 0
+        self.presence.connections.clear()
+        await self.presence.flush()
+
+    async def connect(self, user_id: int, websocket: WebSocket):
+        await websocket.accept()
+        sockets = self.active_connections.setdefault(user_id, set())
+        if not sockets:
+            await self.broker.subscribe(self._channel(user_id))
+        sockets.add(websocket)
+        self.presence.connected(user_id)
+
+    async def disconnect(self, user_id: int, websocket: WebSocket):
+        sockets = self.active_connections.get(user_id)
+        if not sockets or websocket not in sockets:
+            return
+        sockets.discard(websocket)
+        if not sockets:
+            del self.active_connections[user_id]
+            await self.broker.unsubscribe(self._channel(user_id))
+        self.presence.disconnected(user_id)
+
+    def heartbeat(self, user_id: int):
+        self.presence.heartbeat(user_id)
+
+    async def send_personal_message(self, message: str, user_id: int):
+        """Reach the user's sockets whichever worker holds them."""
+        await self.broker.publish(self._channel(user_id), message)
+
+    @staticmethod
+    def _channel(user_id: int) -> str:
+        return f"user:{user_id}"
+
+    async def _deliver(self, channel: str, message: str):
+        user_id = int(channel.split(":", 1)[1])
+        for websocket in list(self.active_connections.get(user_id, ())):
+            try:
+                await websocket.send_text(message)
+            except Exception:
+                await self.disconnect(user_id, websocket)
+
+    async def _close_stale(self, user_ids: Iterable[int]):
+        for user_id in user_ids:
+            for websocket in list(self.active_connections.get(user_id, ())):
+                await self.disconnect(user_id, websocket)
+                try:
+                    await websocket.close(code=1001)
+                except Exception:
+                    pass
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+            try:
+                await self._close_stale(self.presence.stale())
+                await self.presence.flush()
+            except Exception as e:
+                logger.error(f"Presence flush failed: {e}")
+
+
+manager = ConnectionManager(create_broker(BROKER_URL))
+
+Gauge("websocket_connections", "WebSockets open in this process",
+      collect=lambda: {(): sum(len(sockets) for sockets in manager.active_connections.values())})
+Gauge("online_users", "Users with a WebSocket open in this process",
+      collect=lambda: {(): len(manager.presence.connections)})
@@ -40,8 +40,8 @@ CREATE TABLE `friendship` (
   `status` varchar(20) DEFAULT 'pending',
   `created_at` datetime DEFAULT CURRENT_TIMESTAMP,
   PRIMARY KEY (`id`),
-  KEY `user_id` (`user_id`),
-  KEY `friend_id` (`friend_id`),
+  KEY `ix_friendship_user_friend` (`user_id`, `friend_id`),
+  KEY `ix_friendship_friend_user` (`friend_id`, `user_id`),
   CONSTRAINT `friendship_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `user` (`id`) ON DELETE CASCADE,
   CONSTRAINT `friendship_ibfk_2` FOREIGN KEY (`friend_id`) REFERENCES `user` (`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -59,12 +59,58 @@ CREATE TABLE `post` (
   `created_at` datetime DEFAULT CURRENT_TIMESTAMP,
   `user_id` int(11) NOT NULL,
   PRIMARY KEY (`id`),
-  KEY `user_id` (`user_id`),
+  KEY `ix_post_created_at_id` (`created_at`, `id`),
+  KEY `ix_post_user_created_id` (`user_id`, `created_at`, `id`),
   CONSTRAINT `post_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `user` (`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `timelineentry`
+--
+
+CREATE TABLE `timelineentry` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `owner_id` int(11) NOT NULL,
+  `post_id` int(11) NOT NULL,
+  `created_at` datetime NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `owner_id_post_id` (`owner_id`, `post_id`),
+  KEY `ix_timelineentry_owner_created_post` (`owner_id`, `created_at`, `post_id`),
+  KEY `post_id` (`post_id`),
+  CONSTRAINT `timelineentry_ibfk_1` FOREIGN KEY (`owner_id`) REFERENCES `user` (`id`) ON DELETE CASCADE,
+  CONSTRAINT `timelineentry_ibfk_2` FOREIGN KEY (`post_id`) REFERENCES `post` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `builttimeline`
+--
+
+CREATE TABLE `builttimeline` (
+  `owner_id` int(11) NOT NULL,
+  `built_at` datetime NOT NULL,
+  PRIMARY KEY (`owner_id`),
+  CONSTRAINT `builttimeline_ibfk_1` FOREIGN KEY (`owner_id`) REFERENCES `user` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `pulledauthor`
+--
+
+CREATE TABLE `pulledauthor` (
+  `user_id` int(11) NOT NULL,
+  `friend_count` int(11) NOT NULL,
+  PRIMARY KEY (`user_id`),
+  CONSTRAINT `pulledauthor_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `user` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- --------------------------------------------------------
+
 --
 -- Table structure for table `comment`
 --
@@ -74,7 +120,7 @@ CREATE TABLE `comment` (
   `content` text NOT NULL,
   `created_at` datetime DEFAULT CURRENT_TIMESTAMP,
   `user_id` int(11) NOT NULL,
-  `post_id" int(11) NOT NULL,
+  `post_id` int(11) NOT NULL,
   PRIMARY KEY (`id`),
   KEY `user_id` (`user_id`),
   KEY `post_id` (`post_id`),
@@ -94,10 +140,43 @@ CREATE TABLE `reaction` (
   `user_id` int(11) NOT NULL,
   `post_id` int(11) NOT NULL,
   PRIMARY KEY (`id`),
+  UNIQUE KEY `post_id_user_id` (`post_id`, `user_id`),
   KEY `user_id` (`user_id`),
-  KEY `post_id` (`post_id`),
   CONSTRAINT `reaction_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `user` (`id`) ON DELETE CASCADE,
   CONSTRAINT `reaction_ibfk_2` FOREIGN KEY (`post_id`) REFERENCES `post` (`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `postcounter`
+--
+
+CREATE TABLE `postcounter` (
+  `post_id` int(11) NOT NULL,
+  `kind` varchar(40) NOT NULL,
+  `total` int(11) NOT NULL DEFAULT 0,
+  PRIMARY KEY (`post_id`, `kind`),
+  CONSTRAINT `postcounter_ibfk_1` FOREIGN KEY (`post_id`) REFERENCES `post` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `telegramfile`
+--
+
+CREATE TABLE `telegramfile` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `media_id` varchar(255) NOT NULL,
+  `format_type` varchar(20) NOT NULL,
+  `url` varchar(768) NOT NULL,
+  `file_id` varchar(255) NOT NULL,
+  `title` varchar(255) DEFAULT NULL,
+  `created_at` datetime DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `media_id_format_type` (`media_id`, `format_type`),
+  KEY `url` (`url`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
 COMMIT;
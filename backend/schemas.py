@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Dict, Optional, List
 from datetime import datetime
 
 class PostBase(BaseModel):
@@ -14,6 +14,28 @@ class PostRead(PostBase):
     created_at: datetime
     user_id: int
 
+class PostAuthor(BaseModel):
+    id: int
+    username: str
+    full_name: str
+    profile_pic: Optional[str] = None
+
+class PostCounts(BaseModel):
+    post_id: int
+    comment_count: int = 0
+    reaction_count: int = 0
+    reactions: Dict[str, int] = {} # per reaction type
+
+class FeedPost(PostRead):
+    author: PostAuthor
+    comment_count: int
+    reaction_count: int
+    reactions: Dict[str, int] = {}
+
+class PostPage(BaseModel):
+    items: List[FeedPost]
+    next_cursor: Optional[str] = None
+
 class CommentBase(BaseModel):
     content: str
 
@@ -36,3 +58,8 @@ class ReactionRead(ReactionBase):
     id: int
     user_id: int
     post_id: int
+
+class BatchDownload(BaseModel):
+    urls: List[str]
+    format_type: str = "video"
+    audio_codec: str = "mp3"
@@ -0,0 +1,240 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+from metrics import Counter, Gauge, record
+
+# Per-job working directories of downloads (formats before they are merged or
+# converted, .part files, fragments)
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", os.path.join(tempfile.gettempdir(), "alexdownloader-scratch"))
+# Bytes all running jobs may reserve on disk together
+SCRATCH_QUOTA_BYTES = int(os.getenv("SCRATCH_QUOTA_MB", "4096")) * 1024 * 1024
+# Space left free on the scratch filesystem whatever the quota says
+SCRATCH_MIN_FREE_BYTES = int(os.getenv("SCRATCH_MIN_FREE_MB", "512")) * 1024 * 1024
+# How long a job waits for room before it is refused, 0 refuses right away
+SCRATCH_WAIT_SECONDS = float(os.getenv("SCRATCH_WAIT_SECONDS", "300"))
+# Reserved for jobs whose size can't be estimated
+SCRATCH_UNKNOWN_JOB_BYTES = int(os.getenv("SCRATCH_UNKNOWN_JOB_MB", "512")) * 1024 * 1024
+# RAM-backed directory (tmpfs, e.g. /dev/shm/alexdownloader) for small jobs, empty disables it
+SCRATCH_RAM_DIR = os.getenv("SCRATCH_RAM_DIR", "")
+SCRATCH_RAM_JOB_BYTES = int(os.getenv("SCRATCH_RAM_JOB_MB", "64")) * 1024 * 1024
+SCRATCH_RAM_QUOTA_BYTES = int(os.getenv("SCRATCH_RAM_QUOTA_MB", "256")) * 1024 * 1024
+# Files and job directories untouched for this long, and not used by a job of
+# this process, are left over from failed jobs or a previous run
+SCRATCH_ORPHAN_SECONDS = int(os.getenv("SCRATCH_ORPHAN_SECONDS", "3600"))
+SCRATCH_JANITOR_INTERVAL = int(os.getenv("SCRATCH_JANITOR_INTERVAL", "300"))
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_ADMISSIONS = Counter("scratch_admissions_total", "Jobs given scratch space or refused", ("result",))
+SCRATCH_RECLAIMED_BYTES = Counter("scratch_reclaimed_bytes_total", "Bytes of orphaned files removed by the janitor")
+
+
+class StorageFull(Exception):
+    """No room for a job's files within the scratch quota."""
+
+
+class Workspace:
+    def __init__(self, job_id: str, path: str, size: int, tier: str):
+        self.job_id = job_id
+        self.path = path
+        self.size = size
+        self.tier = tier  # "disk" or "ram"
+
+
+def _last_modified(path: str) -> float:
+    if not os.path.isdir(path):
+        return os.lstat(path).st_mtime
+    latest = os.lstat(path).st_mtime
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                latest = max(latest, os.lstat(os.path.join(dirpath, name)).st_mtime)
+            except OSError:
+                pass
+    return latest
+
+
+def _disk_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class ScratchStorage:
+    """Working directories of running jobs under a byte quota.
+
+    Each job reserves its estimated size before it starts and gets its own
+    directory, removed with everything in it when the job ends. Jobs that
+    don't fit wait for others to finish, up to ``wait`` seconds. A janitor
+    thread removes what crashed jobs left behind, here and in the watched
+    directories, by job id and age.
+    """
+
+    def __init__(self, root: str = SCRATCH_DIR, quota: int = SCRATCH_QUOTA_BYTES,
+                 min_free: int = SCRATCH_MIN_FREE_BYTES, wait: float = SCRATCH_WAIT_SECONDS,
+                 ram_root: str = SCRATCH_RAM_DIR, ram_job_max: int = SCRATCH_RAM_JOB_BYTES,
+                 ram_quota: int = SCRATCH_RAM_QUOTA_BYTES, orphan_age: int = SCRATCH_ORPHAN_SECONDS,
+                 janitor_interval: int = SCRATCH_JANITOR_INTERVAL):
+        self.root = root
+        self.quota = quota
+        self.min_free = min_free
+        self.wait = wait
+        self.ram_root = ram_root
+        self.ram_job_max = ram_job_max
+        self.ram_quota = ram_quota
+        self.orphan_age = orphan_age
+        self.janitor_interval = janitor_interval
+        self.reserved = {"disk": 0, "ram": 0}
+        self.active: Dict[str, Workspace] = {}
+        self.waiting = 0
+        self.rejected = 0
+        self.reclaimed_bytes = 0
+        self.watched: List[str] = []
+        self._janitor: Optional[threading.Thread] = None
+        self._cond = threading.Condition()
+        os.makedirs(self.root, exist_ok=True)
+
+    def watch(self, directory: str):
+        """Also sweep ``directory``, whose files are named after the job that wrote them."""
+        if directory not in self.watched:
+            self.watched.append(directory)
+
+    def _fits(self, tier: str, size: int) -> bool:
+        if tier == "ram":
+            return size <= self.ram_job_max and self.reserved["ram"] + size <= self.ram_quota
+        if self.reserved["disk"] + size > self.quota:
+            return False
+        # Other programs share the filesystem, the quota alone doesn't keep it from filling up
+        return shutil.disk_usage(self.root).free - size >= self.min_free
+
+    def _admit(self, size: int) -> str:
+        if self.ram_root and self._fits("ram", size):
+            return "ram"
+        if size > self.quota:
+            raise StorageFull(f"Job needs {size // (1024 * 1024)}MB of scratch space, "
+                              f"the quota is {self.quota // (1024 * 1024)}MB")
+        deadline = time.monotonic() + self.wait
+        self.waiting += 1
+        try:
+            while not self._fits("disk", size):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise StorageFull("Not enough scratch space, try again later")
+                # Polled as well, space freed by other processes isn't notified
+                self._cond.wait(min(remaining, 1.0))
+        finally:
+            self.waiting -= 1
+        return "disk"
+
+    @contextmanager
+    def workspace(self, job_id: str, size: Optional[int] = None) -> Iterator[Workspace]:
+        """Reserve ``size`` bytes and a directory for ``job_id``, for the duration of the block.
+
+        Raises ``StorageFull`` when there is no room after waiting.
+        """
+        self._start_janitor()
+        size = size or SCRATCH_UNKNOWN_JOB_BYTES
+        start = time.perf_counter()
+        with self._cond:
+            try:
+                tier = self._admit(size)
+            except StorageFull:
+                self.rejected += 1
+                SCRATCH_ADMISSIONS.inc(result="rejected")
+                raise
+            self.reserved[tier] += size
+            work = Workspace(job_id, os.path.join(self.ram_root if tier == "ram" else self.root, job_id), size, tier)
+            self.active[job_id] = work
+        SCRATCH_ADMISSIONS.inc(result=tier)
+        record("scratch_wait", time.perf_counter() - start)
+        try:
+            os.makedirs(work.path, exist_ok=True)
+            yield work
+        finally:
+            shutil.rmtree(work.path, ignore_errors=True)
+            with self._cond:
+                del self.active[job_id]
+                self.reserved[tier] -= size
+                self._cond.notify_all()
+
+    def is_active(self, name: str) -> bool:
+        # Job files are named "<job id>.<anything>"
+        with self._cond:
+            return name.split(".", 1)[0] in self.active
+
+    def sweep(self) -> int:
+        """Remove orphaned job directories and files, returns the bytes reclaimed."""
+        deadline = time.time() - self.orphan_age
+        reclaimed = 0
+        for directory in [self.root, self.ram_root] + self.watched:
+            if not directory or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    if self.is_active(name) or _last_modified(path) >= deadline:
+                        continue
+                    size = _disk_size(path)
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                except OSError as e:
+                    # Taken by another process or removed in the meantime
+                    logger.debug("Skipped %s: %s", path, e)
+                    continue
+                reclaimed += size
+        if reclaimed:
+            logger.info("Reclaimed %.1fMB of orphaned job files", reclaimed / (1024 * 1024))
+            SCRATCH_RECLAIMED_BYTES.inc(reclaimed)
+            with self._cond:
+                self.reclaimed_bytes += reclaimed
+                self._cond.notify_all()
+        return reclaimed
+
+    def _start_janitor(self):
+        with self._cond:
+            if self._janitor is not None:
+                return
+            # Started on first use, processes that never download don't get the thread
+            self._janitor = threading.Thread(target=self._run_janitor, name="scratch-janitor", daemon=True)
+        self._janitor.start()
+
+    def _run_janitor(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning("Scratch janitor failed: %s", e)
+            time.sleep(self.janitor_interval)
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "jobs": len(self.active),
+                "disk_bytes": self.reserved["disk"],
+                "quota_bytes": self.quota,
+                "ram_bytes": self.reserved["ram"],
+                "waiting": self.waiting,
+                "rejected": self.rejected,
+                "reclaimed_bytes": self.reclaimed_bytes,
+            }
+
+
+scratch_storage = ScratchStorage()
+
+Gauge("scratch_reserved_bytes", "Scratch space reserved by running jobs", ("tier",),
+      collect=lambda: {(tier,): size for tier, size in dict(scratch_storage.reserved).items()})
+Gauge("scratch_waiting_jobs", "Jobs waiting for scratch space", collect=lambda: {(): scratch_storage.waiting})
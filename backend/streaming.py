@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import mimetypes
+from typing import Any, AsyncIterator, Dict, List, Optional
+import httpx
+from ffmpeg_tools import FFMPEG_DIR, exit_status, ffmpeg_executable
+from ydl_pool import YdlPool, resolve_formats
+
+CHUNK_SIZE = 64 * 1024
+
+# Protocols we can read with a plain HTTP client / with ffmpeg
+DIRECT_PROTOCOLS = ("http", "https")
+FFMPEG_PROTOCOLS = ("http", "https", "m3u8", "m3u8_native")
+
+STREAM_FORMATS = {
+    # Prefer progressive files, they are sent as-is without ffmpeg
+    "video": "best[vcodec!=none][acodec!=none][protocol^=http][protocol!*=dash][ext=mp4]/bestvideo+bestaudio/best",
+    "audio": "bestaudio/best",
+}
+
+logger = logging.getLogger(__name__)
+
+# Only selects formats, the format is set per stream
+stream_pool = YdlPool("streaming", {"select": {'quiet': True, 'no_warnings': True, 'ffmpeg_location': FFMPEG_DIR}})
+
+
+class MediaStream:
+    """Selected upstream formats and how to turn them into one response body.
+
+    ``open`` must be awaited before ``body`` is sent.
+    """
+
+    def __init__(self, formats: List[Dict[str, Any]], remux: bool, ext: str):
+        self.formats = formats
+        self.remux = remux
+        self.ext = ext
+        # Only known for direct streams whose upstream sends an exact length,
+        # other responses are sent chunked
+        self.content_length: Optional[int] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._upstream: Optional[httpx.Response] = None
+
+    @property
+    def media_type(self) -> str:
+        if self.ext == "m4a":
+            return "audio/mp4"
+        return mimetypes.guess_type(f"file.{self.ext}")[0] or "application/octet-stream"
+
+    async def open(self):
+        """Connect to the upstream of a direct stream, so its errors are raised before the response starts."""
+        if self.remux:
+            return
+        fmt = self.formats[0]
+        self._client = httpx.AsyncClient(follow_redirects=True, timeout=httpx.Timeout(30, read=60))
+        try:
+            request = self._client.build_request("GET", fmt["url"], headers=fmt.get("http_headers"))
+            self._upstream = await self._client.send(request, stream=True)
+            self._upstream.raise_for_status()
+        except BaseException:
+            await self.close()
+            raise
+        length = self._upstream.headers.get("content-length")
+        # Encoded bodies are relayed decoded, their length differs
+        if length and length.isdigit() and "content-encoding" not in self._upstream.headers:
+            self.content_length = int(length)
+
+    async def close(self):
+        upstream, client, self._upstream, self._client = self._upstream, self._client, None, None
+        if upstream is not None:
+            await upstream.aclose()
+        if client is not None:
+            await client.aclose()
+
+    def body(self) -> AsyncIterator[bytes]:
+        return remux_stream(self.formats, self.ext) if self.remux else self._relay()
+
+    async def _relay(self) -> AsyncIterator[bytes]:
+        """Relay the upstream file chunk by chunk.
+
+        Each chunk is only fetched once the previous one was sent, and leaving the
+        generator early (client disconnect) closes the upstream connection. An
+        upstream that ends short of its length raises, aborting the response.
+        """
+        try:
+            async for chunk in self._upstream.aiter_bytes(CHUNK_SIZE):
+                yield chunk
+        finally:
+            await self.close()
+
+
+def plan_stream(info: Dict[str, Any], format_type: str = "video") -> Optional[MediaStream]:
+    """Pick formats that can be streamed without a temp file, or None."""
+    with stream_pool.checkout("select", format=STREAM_FORMATS.get(format_type, STREAM_FORMATS["video"])) as ydl:
+        formats = resolve_formats(ydl, info)
+    protocols = [f.get("protocol") or "https" for f in formats]
+
+    if len(formats) == 1 and protocols[0] in DIRECT_PROTOCOLS:
+        return MediaStream(formats, remux=False, ext=formats[0].get("ext") or "mp4")
+    if all(p in FFMPEG_PROTOCOLS for p in protocols):
+        # Merged or segmented media is remuxed into fragmented MP4 on the fly
+        return MediaStream(formats, remux=True, ext="m4a" if format_type == "audio" else "mp4")
+    return None
+
+
+async def remux_stream(formats: List[Dict[str, Any]], ext: str = "mp4") -> AsyncIterator[bytes]:
+    """Copy the given streams into fragmented MP4 and relay ffmpeg's stdout."""
+    args = [ffmpeg_executable(), "-loglevel", "error", "-nostdin"]
+    for fmt in formats:
+        headers = "".join(f"{k}: {v}\r\n" for k, v in (fmt.get("http_headers") or {}).items())
+        if headers:
+            args += ["-headers", headers]
+        args += ["-i", fmt["url"]]
+    for i, fmt in enumerate(formats):
+        if fmt.get("vcodec") != "none" and ext != "m4a":
+            args += ["-map", f"{i}:v:0?"]
+        if fmt.get("acodec") != "none":
+            args += ["-map", f"{i}:a:0?"]
+    args += ["-c", "copy", "-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof", "pipe:1"]
+
+    process = await asyncio.create_subprocess_exec(
+        *args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    # Read alongside stdout, ffmpeg would stall on a full stderr pipe
+    errors = asyncio.create_task(process.stderr.read())
+    try:
+        # ffmpeg blocks on a full pipe, so a slow client throttles it
+        while True:
+            chunk = await process.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        await process.wait()
+        stderr = (await errors).decode(errors="replace").strip()[-500:]
+        if process.returncode != 0:
+            logger.error("Remux of %s failed with %s: %s", formats[0].get("format_id"),
+                         exit_status(process.returncode), stderr or "no error output")
+            # Raised rather than returned, so the server aborts the response
+            # instead of ending it as if the media were complete
+            raise RuntimeError(f"ffmpeg failed with {exit_status(process.returncode)}: {stderr}")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        errors.cancel()
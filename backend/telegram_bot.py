@@ -1,9 +1,20 @@
 import logging
 import os
 import asyncio
+import time
 from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
-from downloader import downloader
+from sqlmodel import SQLModel
+from database import engine, ensure_keys
+from downloader import downloader, media_id, normalize_url
+from failures import CircuitOpen
+from format_planner import NoFittingFormat
+from scratch import StorageFull
+from fitting import STRATEGIES
+from bot_scheduler import scheduler, QueueFull, ShuttingDown
+import file_id_cache
+from metrics import record, span, start_http_server, trace
 
 # Configure logging
 logging.basicConfig(
@@ -13,6 +24,18 @@ logging.basicConfig(
 
 TOKEN = os.getenv("BOT_TOKEN", "8282348584:AAEu9K_-rwSI3Sh1obae64iqE9MtaicnbcQ")
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB limit for Telegram bots
+# Point the bot at another Bot API server (self-hosted or a local stand-in)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "https://api.telegram.org/bot")
+BOT_API_BASE_FILE_URL = os.getenv("BOT_API_BASE_FILE_URL", "https://api.telegram.org/file/bot")
+# What to do with files over the upload limit: "transcode" (lower bitrate) or "split"
+BOT_OVERSIZE_STRATEGY = os.getenv("BOT_OVERSIZE_STRATEGY", "transcode")
+# Audio format sent by /audio. Telegram plays m4a natively and most sources
+# already are AAC, so the audio is usually copied without re-encoding.
+BOT_AUDIO_CODEC = os.getenv("BOT_AUDIO_CODEC", "m4a")
+# Seconds to wait for running downloads when the bot is stopped
+BOT_DRAIN_TIMEOUT = int(os.getenv("BOT_DRAIN_TIMEOUT", "300"))
+# Port of the bot's Prometheus /metrics endpoint, 0 disables it
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "0"))
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -21,7 +44,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Send me any URL from YouTube, Instagram, or TikTok and I'll send you the file with full picture and audio! 🎮✨\n\n"
         "Commands:\n"
         "/download [url] - Download as video\n"
-        "/audio [url] - Download as mp3"
+        "/audio [url] - Download as audio\n\n"
+        "Files over 50MB are re-encoded to fit. Add `split` after the URL to get them in parts instead."
     )
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -35,72 +59,165 @@ async def download_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("Please provide a URL. Example: /download https://...")
         return
-    await process_download(update, context, context.args[0], "video")
+    await process_download(update, context, context.args[0], "video", oversize_strategy(context))
 
 async def audio_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("Please provide a URL. Example: /audio https://...")
         return
-    await process_download(update, context, context.args[0], "audio")
+    await process_download(update, context, context.args[0], "audio", oversize_strategy(context))
 
-async def process_download(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, format_type: str):
-    status_msg = await update.message.reply_text(f"🚀 Processing your {format_type}... Please wait.")
-    
+def oversize_strategy(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Strategy given after the URL, e.g. /download https://... split"""
+    if len(context.args) > 1 and context.args[1].lower() in STRATEGIES:
+        return context.args[1].lower()
+    return BOT_OVERSIZE_STRATEGY
+
+async def send_cached(update: Update, entry) -> bool:
+    """Re-send a previous upload by file_id, returns False if there is none or it is no longer valid."""
+    if entry is None:
+        return False
+    caption = f"✅ {entry.title} downloaded successfully!"
     try:
-        # Get info first
-        info = downloader.get_info(url)
-        await status_msg.edit_text(f"📦 Found: **{info['title']}**\nDownloading now...")
-        
-        # Download with 50MB limit (Telegram's restriction)
-        result = downloader.download_media(url, format_type, max_filesize_mb=50)
-        file_path = result['path']
-        title = result['title']
-        
-        await status_msg.edit_text("📤 Sending file to you...")
-        
-        # Check file size before sending
-        file_size = os.path.getsize(file_path)
-        if file_size > MAX_FILE_SIZE:
-            size_mb = round(file_size / (1024 * 1024), 2)
-            await status_msg.edit_text(
-                f"⚠️ **File is too large ({size_mb}MB)**\n\n"
-                f"Telegram bots are limited to **50MB** for uploads. "
-                f"Please try a shorter video or a lower quality format."
-            )
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            return
-
-        if format_type == "audio":
-            await update.message.reply_audio(
-                audio=open(file_path, 'rb'),
-                title=title,
-                performer=info.get('uploader', 'alexDownloader'),
-                caption=f"✅ {title} downloaded successfully!",
-                read_timeout=120,
-                write_timeout=120
-            )
+        if entry.format_type == "audio":
+            await update.message.reply_audio(audio=entry.file_id, caption=caption)
         else:
-            await update.message.reply_video(
-                video=open(file_path, 'rb'),
-                caption=f"✅ {title} downloaded successfully!",
-                supports_streaming=True,
-                read_timeout=120,
-                write_timeout=120
-            )
-
-            
-        # Cleanup
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        await status_msg.delete()
-        
+            await update.message.reply_video(video=entry.file_id, caption=caption, supports_streaming=True)
+        return True
+    except BadRequest as e:
+        logging.warning(f"Cached file_id rejected, uploading again: {e}")
+        await asyncio.to_thread(file_id_cache.invalidate, entry.id)
+        return False
+
+async def process_download(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, format_type: str,
+                           oversize: str = BOT_OVERSIZE_STRATEGY):
+    with trace("bot", chat=update.effective_chat.id, url=url, format_type=format_type):
+        await _process_download(update, url, format_type, oversize)
+
+async def _process_download(update: Update, url: str, format_type: str, oversize: str):
+    # Links sent before are answered from Telegram's copy, without queueing
+    cached = await asyncio.to_thread(file_id_cache.get_by_url, normalize_url(url), format_type)
+    if await send_cached(update, cached):
+        return
+
+    status_msg = await update.message.reply_text(f"🚀 Processing your {format_type}... Please wait.")
+
+    async def report_position(position: int):
+        await status_msg.edit_text(f"⏳ You are #{position} in the queue. Your {format_type} will start soon...")
+
+    try:
+        queued_at = time.perf_counter()
+        async with scheduler.slot(update.effective_chat.id, on_position=report_position):
+            record("queue_wait", time.perf_counter() - queued_at)
+            await download_and_send(update, status_msg, url, format_type, oversize)
+    except QueueFull:
+        await status_msg.edit_text(
+            f"✋ You already have {scheduler.max_queued_per_chat} downloads in progress. "
+            f"Please wait for them to finish before sending more links."
+        )
+    except ShuttingDown:
+        await status_msg.edit_text("🔧 The bot is restarting. Please send your link again in a minute.")
+    except NoFittingFormat as e:
+        await status_msg.edit_text(
+            f"⚠️ **This {format_type} is too large**\n\n"
+            f"Telegram bots are limited to **50MB** for uploads: {e}."
+        )
+    except CircuitOpen as e:
+        await status_msg.edit_text(
+            f"🛠 Downloads from {e.domain} are failing at the moment. "
+            f"Please try again in {int(e.retry_after // 60) + 1} min."
+        )
+    except StorageFull:
+        await status_msg.edit_text("💾 The server is busy with other downloads. Please send your link again in a few minutes.")
     except Exception as e:
         logging.error(f"Bot error: {e}")
         await status_msg.edit_text(f"❌ Error: {str(e)[:100]}... Please check the URL or try again later.")
 
+async def download_and_send(update: Update, status_msg, url: str, format_type: str, oversize: str):
+    # Get info first, the download reuses this extraction
+    info = await scheduler.run(downloader.extract_info, url)
+
+    # Same media may have been sent before under another URL
+    cached = await asyncio.to_thread(file_id_cache.get_by_media, media_id(info), format_type)
+    if await send_cached(update, cached):
+        await status_msg.delete()
+        return
+
+    await status_msg.edit_text(f"📦 Found: **{info.get('title')}**\nDownloading now...")
+    
+    # Download with 50MB limit (Telegram's restriction), larger results are
+    # re-encoded or split depending on the requested strategy
+    result = await scheduler.run(downloader.download_cached, url, format_type, max_filesize_mb=50, info=info,
+                                 oversize=oversize, audio_codec=BOT_AUDIO_CODEC, priority="bot")
+    parts = [part['path'] for part in result['parts']]
+    title = result['title']
+    
+    await status_msg.edit_text("📤 Sending file to you...")
+    
+    # Check file size before sending
+    file_size = max(os.path.getsize(path) for path in parts)
+    if file_size > MAX_FILE_SIZE:
+        size_mb = round(file_size / (1024 * 1024), 2)
+        await status_msg.edit_text(
+            f"⚠️ **File is too large ({size_mb}MB)**\n\n"
+            f"Telegram bots are limited to **50MB** for uploads. "
+            f"Please try a shorter video or a lower quality format."
+        )
+        return
+
+    for i, file_path in enumerate(parts):
+        caption = f"✅ {title} downloaded successfully!"
+        if len(parts) > 1:
+            caption = f"✅ {title} (part {i + 1}/{len(parts)})"
+        with open(file_path, 'rb') as media_file, span("upload"):
+            if format_type == "audio":
+                message = await update.message.reply_audio(
+                    audio=media_file,
+                    title=title,
+                    performer=info.get('uploader', 'alexDownloader'),
+                    caption=caption,
+                    read_timeout=120,
+                    write_timeout=120
+                )
+            else:
+                message = await update.message.reply_video(
+                    video=media_file,
+                    caption=caption,
+                    supports_streaming=True,
+                    read_timeout=120,
+                    write_timeout=120
+                )
+
+    # Remember Telegram's copy so the next request skips download and upload
+    sent = message.audio if format_type == "audio" else (message.video or message.document)
+    if sent and len(parts) == 1:
+        await asyncio.to_thread(file_id_cache.store, media_id(info), format_type, normalize_url(url), sent.file_id, title)
+
+    # The file stays in the media cache for the next request
+    await status_msg.delete()
+
+async def drain_downloads(application):
+    """Let queued and running downloads finish before the bot shuts down."""
+    logging.info(f"Waiting for {scheduler.active} running and {scheduler.queued} queued downloads...")
+    await scheduler.shutdown(timeout=BOT_DRAIN_TIMEOUT)
+
 if __name__ == '__main__':
-    application = ApplicationBuilder().token(TOKEN).connect_timeout(60).read_timeout(60).write_timeout(60).build()
+    SQLModel.metadata.create_all(engine)
+    ensure_keys(SQLModel.metadata, engine)
+    # Every update resolves a link, so the first one shouldn't wait for yt-dlp to load
+    downloader.ydl_pool.warm(["info"])
+
+    application = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .base_url(BOT_API_BASE_URL)
+        .base_file_url(BOT_API_BASE_FILE_URL)
+        .connect_timeout(60).read_timeout(60).write_timeout(60)
+        # Handle updates concurrently, downloads are limited by the scheduler
+        .concurrent_updates(True)
+        .post_stop(drain_downloads)
+        .build()
+    )
 
     
     start_handler = CommandHandler('start', start)
@@ -113,5 +230,7 @@ if __name__ == '__main__':
     application.add_handler(audio_handler)
     application.add_handler(message_handler)
     
+    if BOT_METRICS_PORT:
+        start_http_server(BOT_METRICS_PORT)
     print("alexDownloader Bot is running...")
     application.run_polling()
@@ -0,0 +1,92 @@
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs
+
+# Form fields of multipart uploads (sendVideo, sendAudio), the file itself is ignored
+MULTIPART_FIELD = re.compile(r'name="([^"]+)"\r\n\r\n([^\r]*)\r\n')
+
+
+class BotApiStandIn:
+    """Local stand-in for the Bot API, answering the calls the bot makes and recording them.
+
+    ``base_url`` is given to the bot in place of ``https://api.telegram.org/bot``.
+    """
+
+    def __init__(self):
+        self.calls: List[Tuple[str, Dict[str, Any]]] = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                params = stand_in._params(self.headers.get("Content-Type") or "", body)
+                with stand_in._lock:
+                    stand_in.calls.append((method, params))
+                payload = json.dumps({"ok": True, "result": stand_in._result(method, params)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}/bot"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self) -> "BotApiStandIn":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @staticmethod
+    def _params(content_type: str, body: bytes) -> Dict[str, Any]:
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("multipart/form-data"):
+            return dict(MULTIPART_FIELD.findall(body.decode("latin-1")))
+        return {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+    def _result(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "alexDownloader", "username": "alexdownloader_bot"}
+        if method == "deleteMessage":
+            return True
+        message = {
+            "message_id": int(params.get("message_id") or next(self._ids)),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if method == "sendVideo":
+            message["video"] = {"file_id": f"video-{message['message_id']}", "file_unique_id": str(message["message_id"]),
+                                "width": 640, "height": 360, "duration": 1}
+        if method == "sendAudio":
+            message["audio"] = {"file_id": f"audio-{message['message_id']}", "file_unique_id": str(message["message_id"]),
+                                "duration": 1}
+        return message
+
+    def texts(self, chat_id: int) -> List[str]:
+        """Texts sent or edited in a chat, in order."""
+        with self._lock:
+            return [params["text"] for method, params in self.calls
+                    if method in ("sendMessage", "editMessageText") and int(params.get("chat_id") or 0) == chat_id]
+
+    def uploads(self) -> List[int]:
+        """Chats that received a file, in order."""
+        with self._lock:
+            return [int(params["chat_id"]) for method, params in self.calls if method in ("sendVideo", "sendAudio")]
@@ -0,0 +1,28 @@
+import json
+import os
+import sys
+import tempfile
+
+# Backend modules import each other by their flat names
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Modules read their settings on import, keep the database and caches of the
+# tests away from the ones of a local install
+_TMP_DIR = tempfile.mkdtemp(prefix="alexdownloader-tests-")
+for name, value in {
+    "DATABASE_URL": f"sqlite:///{os.path.join(_TMP_DIR, 'test.db')}",
+    "MEDIA_CACHE_DIR": os.path.join(_TMP_DIR, "cache"),
+    "THUMBNAIL_CACHE_DIR": os.path.join(_TMP_DIR, "thumbnails"),
+    "SCRATCH_DIR": os.path.join(_TMP_DIR, "scratch"),
+}.items():
+    os.environ.setdefault(name, value)
+
+
+def load_info(name: str):
+    """Recorded extractor output from ``fixtures/<name>.json``."""
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json")) as f:
+        return json.load(f)
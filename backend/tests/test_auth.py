@@ -0,0 +1,25 @@
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+import main
+from auth import user_cache
+from database import engine
+from models import User
+
+
+def test_renamed_user_is_no_longer_cached_under_the_old_name():
+    with TestClient(main.app) as client:
+        client.post("/register", json={"username": "auth-before", "email": "auth@example.com",
+                                       "full_name": "Auth", "password": "secret"})
+        token = client.post("/token", data={"username": "auth-before", "password": "secret"}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        assert client.get("/users/me", headers=headers).json()["username"] == "auth-before"
+        assert user_cache.get("auth-before") is not None
+
+        with Session(engine) as db:
+            user = db.exec(select(User).where(User.username == "auth-before")).one()
+            user.username = "auth-after"
+            db.add(user)
+            db.commit()
+        assert user_cache.get("auth-before") is None
+        # The token names a user that no longer exists
+        assert client.get("/users/me", headers=headers).status_code == 401
@@ -0,0 +1,95 @@
+import asyncio
+import io
+import json
+import threading
+import zipfile
+import batch
+from batch import expand_urls, stream_zip
+
+
+def test_playlists_are_expanded_in_parallel_and_in_order(monkeypatch):
+    # Every expansion waits for the others, a sequential expand_urls would time out
+    barrier = threading.Barrier(3, timeout=5)
+
+    def list_entries(url):
+        barrier.wait()
+        if url.endswith("broken"):
+            raise RuntimeError("unsupported URL")
+        return [f"{url}/{i}" for i in range(2)]
+
+    monkeypatch.setattr(batch.downloader, "list_entries", list_entries)
+    monkeypatch.setattr(batch, "BATCH_WORKERS", 3)
+    urls, skipped = expand_urls(["https://a.example/list", "https://b.example/broken", "https://c.example/list"])
+    assert urls == ["https://a.example/list/0", "https://a.example/list/1", "https://b.example/broken",
+                    "https://c.example/list/0", "https://c.example/list/1"]
+    assert skipped == []
+
+
+def test_entries_past_the_limit_are_returned_as_skipped(monkeypatch):
+    expanded = []
+
+    def list_entries(url):
+        expanded.append(url)
+        return [f"{url}/{i}" for i in range(3)]
+
+    monkeypatch.setattr(batch.downloader, "list_entries", list_entries)
+    monkeypatch.setattr(batch, "BATCH_MAX_ITEMS", 4)
+    inputs = [f"https://example.com/{i}" for i in range(6)]
+    urls, skipped = expand_urls(inputs)
+    assert urls == ["https://example.com/0/0", "https://example.com/0/1", "https://example.com/0/2",
+                    "https://example.com/1/0"]
+    assert skipped == ["https://example.com/1/1", "https://example.com/1/2", "https://example.com/2/0",
+                       "https://example.com/2/1", "https://example.com/2/2", "https://example.com/3/0",
+                       "https://example.com/3/1", "https://example.com/3/2", "https://example.com/4",
+                       "https://example.com/5"]
+    # Inputs past the limit can't contribute an entry, they aren't fetched
+    assert sorted(expanded) == inputs[:4]
+
+
+def test_status_lists_skipped_entries(monkeypatch, tmp_path):
+    media = tmp_path / "media.mp4"
+    media.write_bytes(b"media")
+
+    def download_cached(url, format_type, audio_codec="mp3"):
+        if url.endswith("bad"):
+            raise RuntimeError("Video unavailable")
+        return {"path": str(media), "title": url.rsplit("/", 1)[-1]}
+
+    monkeypatch.setattr(batch.downloader, "download_cached", download_cached)
+
+    async def collect():
+        return b"".join([chunk async for chunk in stream_zip(
+            ["https://example.com/good", "https://example.com/bad"], skipped=["https://example.com/late"])])
+
+    archive = zipfile.ZipFile(io.BytesIO(asyncio.run(collect())))
+    assert archive.read("001 - good.mp4") == b"media"
+    statuses = json.loads(archive.read("status.json"))
+    assert [(s["index"], s["url"], s["status"]) for s in statuses] == [
+        (1, "https://example.com/good", "ok"),
+        (2, "https://example.com/bad", "failed"),
+        (3, "https://example.com/late", "skipped"),
+    ]
+    assert "limit" in statuses[2]["error"]
+
+
+def test_disconnect_while_the_queue_is_full_ends_the_producer(monkeypatch):
+    finished = threading.Event()
+
+    def write_archive(writer, urls, format_type, audio_codec, cancelled, skipped):
+        # One chunk more than the queue holds, the end marker waits for room after them
+        for _ in range(batch.ZIP_QUEUE_CHUNKS + 1):
+            writer.write(b"chunk")
+        finished.set()
+
+    monkeypatch.setattr(batch, "_write_archive", write_archive)
+
+    async def disconnect():
+        chunks = stream_zip(["https://example.com/a"])
+        assert await chunks.__anext__() == b"chunk"
+        while not finished.is_set():
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        # The client goes away without reading the rest
+        await asyncio.wait_for(chunks.aclose(), 5)
+
+    asyncio.run(disconnect())
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import pytest
+from bot_scheduler import DownloadScheduler, QueueFull, ShuttingDown
+
+
+async def until(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("condition not reached")
+        await asyncio.sleep(0.01)
+
+
+class Jobs:
+    """Downloads that hold their slot until released, recording the order they start in."""
+
+    def __init__(self, scheduler: DownloadScheduler):
+        self.scheduler = scheduler
+        self.started = []
+        self.positions = {}
+        self.release = {}
+
+    def submit(self, chat_id, name: str) -> asyncio.Task:
+        self.release[name] = asyncio.Event()
+        self.positions[name] = []
+
+        async def report(position: int):
+            self.positions[name].append(position)
+
+        async def job():
+            async with self.scheduler.slot(chat_id, on_position=report):
+                self.started.append(name)
+                await self.release[name].wait()
+
+        return asyncio.create_task(job())
+
+
+def test_busy_chat_does_not_hold_up_others():
+    async def scenario():
+        jobs = Jobs(DownloadScheduler(max_concurrent=2, max_per_chat=1, max_queued_per_chat=3))
+        tasks = [jobs.submit("a", "a1"), jobs.submit("a", "a2"), jobs.submit("a", "a3")]
+        await until(lambda: jobs.started == ["a1"])
+        # Chat b arrives after a's queued links but takes the free slot right away
+        tasks.append(jobs.submit("b", "b1"))
+        await until(lambda: jobs.started == ["a1", "b1"])
+        jobs.release["a1"].set()
+        await until(lambda: jobs.started == ["a1", "b1", "a2"])
+        for event in jobs.release.values():
+            event.set()
+        await asyncio.gather(*tasks)
+        assert jobs.started == ["a1", "b1", "a2", "a3"]
+
+    asyncio.run(scenario())
+
+
+def test_queue_position_is_reported_as_it_changes():
+    async def scenario():
+        jobs = Jobs(DownloadScheduler(max_concurrent=1, max_per_chat=1, max_queued_per_chat=3))
+        tasks = [jobs.submit("a", "a1")]
+        await until(lambda: jobs.started == ["a1"])
+        tasks += [jobs.submit("b", "b1"), jobs.submit("c", "c1")]
+        await until(lambda: jobs.positions["c1"] == [2])
+        assert jobs.positions["b1"] == [1]
+        jobs.release["a1"].set()
+        await until(lambda: jobs.started == ["a1", "b1"])
+        await until(lambda: jobs.positions["c1"] == [2, 1])
+        for event in jobs.release.values():
+            event.set()
+        await asyncio.gather(*tasks)
+        # Running jobs have no position, the first one never waited
+        assert jobs.positions == {"a1": [], "b1": [1], "c1": [2, 1]}
+
+    asyncio.run(scenario())
+
+
+def test_queue_full_per_chat():
+    async def scenario():
+        scheduler = DownloadScheduler(max_concurrent=1, max_per_chat=1, max_queued_per_chat=2)
+        jobs = Jobs(scheduler)
+        tasks = [jobs.submit("a", "a1"), jobs.submit("a", "a2")]
+        await until(lambda: scheduler.active == 1 and scheduler.queued == 1)
+        with pytest.raises(QueueFull):
+            async with scheduler.slot("a"):
+                pass
+        # Other chats are still admitted
+        tasks.append(jobs.submit("b", "b1"))
+        await until(lambda: scheduler.queued == 2)
+        for event in jobs.release.values():
+            event.set()
+        await asyncio.gather(*tasks)
+        # Finished requests free the chat's share again
+        async with scheduler.slot("a"):
+            pass
+
+    asyncio.run(scenario())
+
+
+def test_shutdown_drains_running_and_queued_jobs():
+    async def scenario():
+        scheduler = DownloadScheduler(max_concurrent=1, max_per_chat=1, max_queued_per_chat=3)
+        jobs = Jobs(scheduler)
+        tasks = [jobs.submit("a", "a1"), jobs.submit("b", "b1")]
+        await until(lambda: scheduler.active == 1 and scheduler.queued == 1)
+        shutdown = asyncio.create_task(scheduler.shutdown(timeout=5))
+        await asyncio.sleep(0.05)
+        with pytest.raises(ShuttingDown):
+            async with scheduler.slot("c"):
+                pass
+        assert not shutdown.done()
+        jobs.release["a1"].set()
+        await until(lambda: jobs.started == ["a1", "b1"])
+        assert not shutdown.done()
+        jobs.release["b1"].set()
+        await asyncio.wait_for(shutdown, 5)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_shutdown_gives_up_after_timeout():
+    async def scenario():
+        scheduler = DownloadScheduler(max_concurrent=1)
+        jobs = Jobs(scheduler)
+        task = jobs.submit("a", "a1")
+        await until(lambda: scheduler.active == 1)
+        await asyncio.wait_for(scheduler.shutdown(timeout=0.1), 5)
+        jobs.release["a1"].set()
+        await task
+
+    asyncio.run(scenario())
+
+
+def test_run_keeps_the_loop_free():
+    async def scenario():
+        scheduler = DownloadScheduler(max_concurrent=1)
+        release = threading.Event()
+        call = asyncio.create_task(scheduler.run(release.wait, 5))
+        # The loop keeps serving other work while the blocking call runs
+        await asyncio.sleep(0.05)
+        assert not call.done()
+        release.set()
+        assert await call is True
+        await scheduler.shutdown(timeout=1)
+
+    asyncio.run(scenario())
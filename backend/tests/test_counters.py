@@ -0,0 +1,133 @@
+import asyncio
+import itertools
+import threading
+import pytest
+from sqlmodel import Session, SQLModel, select
+import counters
+from counters import CounterStore
+from database import engine
+from models import Comment, Post, PostCounter, Reaction, User
+
+_ids = itertools.count(1)
+
+
+@pytest.fixture
+def posts():
+    """Two posts of a new user, ids only."""
+    SQLModel.metadata.create_all(engine)
+    n = next(_ids)
+    with Session(engine) as db:
+        user = User(username=f"counters{n}", email=f"counters{n}@example.com", full_name="Counters", hashed_password="x")
+        db.add(user)
+        db.commit()
+        created = [Post(content=f"post {i}", user_id=user.id) for i in range(2)]
+        db.add_all(created)
+        db.commit()
+        return user.id, [post.id for post in created]
+
+
+def counts(store: CounterStore, post_ids):
+    with Session(engine) as db:
+        return {post_id: (c.comment_count, c.reactions) for post_id, c in store.load(db, post_ids).items()}
+
+
+def stored(post_ids):
+    with Session(engine) as db:
+        rows = db.exec(select(PostCounter).where(PostCounter.post_id.in_(post_ids))).all()
+        return {(row.post_id, row.kind): row.total for row in rows}
+
+
+def test_reads_include_changes_not_flushed_yet(posts):
+    _, (a, b) = posts
+    store = CounterStore()
+    store.comment_added(a)
+    store.comment_added(a)
+    store.reaction_changed(a, None, "like")
+    store.reaction_changed(b, None, "love")
+    # The same reaction again changes nothing, a changed one moves between types
+    store.reaction_changed(b, "love", "love")
+    store.reaction_changed(b, "love", "haha")
+    expected = {a: (2, {"like": 1}), b: (0, {"haha": 1})}
+    assert counts(store, [a, b]) == expected
+    assert stored([a, b]) == {}
+
+    asyncio.run(store.flush())
+    assert not store.pending
+    assert stored([a, b]) == {(a, "comment"): 2, (a, "reaction:like"): 1, (b, "reaction:haha"): 1}
+    assert counts(store, [a, b]) == expected
+
+    # Later flushes add to the stored rows
+    store.comment_added(a)
+    store.reaction_changed(a, "like", None)
+    asyncio.run(store.flush())
+    assert stored([a, b])[(a, "comment")] == 3
+    assert counts(store, [a, b])[a] == (3, {})
+
+
+def test_failed_flush_keeps_the_changes(posts, monkeypatch):
+    _, (a, _) = posts
+    store = CounterStore()
+    store.comment_added(a)
+
+    def unavailable():
+        # Changes keep coming in while the write fails
+        store.comment_added(a)
+        raise ConnectionError("database is gone")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(counters, "async_session", unavailable)
+        with pytest.raises(ConnectionError):
+            asyncio.run(store.flush())
+    assert dict(store.pending) == {(a, "comment"): 2}
+    asyncio.run(store.flush())
+    assert stored([a]) == {(a, "comment"): 2}
+
+
+def test_concurrent_changes_and_flushes_add_up(posts):
+    _, (a, b) = posts
+    store = CounterStore()
+    done = threading.Event()
+
+    def tap(post_id):
+        for _ in range(500):
+            store.comment_added(post_id)
+
+    async def flush_until_done():
+        while not done.is_set():
+            await store.flush()
+            await asyncio.sleep(0)
+        await store.flush()
+
+    threads = [threading.Thread(target=tap, args=(post_id,)) for post_id in (a, b, a, b)]
+
+    async def scenario():
+        flusher = asyncio.create_task(flush_until_done())
+        for thread in threads:
+            thread.start()
+        await asyncio.to_thread(lambda: [thread.join() for thread in threads])
+        done.set()
+        await flusher
+
+    asyncio.run(scenario())
+    assert stored([a, b]) == {(a, "comment"): 1000, (b, "comment"): 1000}
+
+
+def test_reconcile_repairs_drifted_rows(posts, monkeypatch):
+    user_id, (a, b) = posts
+    with Session(engine) as db:
+        db.add_all([Comment(content="c", user_id=user_id, post_id=a) for _ in range(3)])
+        db.add(Reaction(type="like", user_id=user_id, post_id=b))
+        # Wrong total, a row for a reaction type nobody uses any more, and b's like missing
+        db.add_all([PostCounter(post_id=a, kind="comment", total=7),
+                    PostCounter(post_id=a, kind="reaction:love", total=2)])
+        db.commit()
+    store = CounterStore()
+    # Buffered by this worker but already in the tables, the recount covers it
+    store.reaction_changed(b, None, "like")
+    # One post per batch, so the walk over the posts is exercised
+    monkeypatch.setattr(counters, "COUNTER_RECONCILE_BATCH", 1)
+    asyncio.run(store.reconcile())
+
+    assert stored([a, b]) == {(a, "comment"): 3, (b, "reaction:like"): 1}
+    assert not store.pending
+    assert counts(store, [a, b]) == {a: (3, {}), b: (0, {"like": 1})}
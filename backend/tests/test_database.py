@@ -0,0 +1,65 @@
+from sqlalchemy import inspect, text
+from sqlmodel import SQLModel, create_engine
+import models  # noqa: F401, registers the tables
+from database import async_url, ensure_keys, split_url, sync_url
+
+# post, comment and reaction as created before they had their keys
+OLD_TABLES = [
+    "CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR NOT NULL, email VARCHAR NOT NULL UNIQUE, "
+    "full_name VARCHAR NOT NULL, profile_pic VARCHAR, bio VARCHAR, language VARCHAR NOT NULL, theme VARCHAR NOT NULL, "
+    "hashed_password VARCHAR NOT NULL, is_online BOOLEAN NOT NULL, created_at DATETIME NOT NULL)",
+    "CREATE UNIQUE INDEX ix_user_username ON user (username)",
+    "CREATE TABLE post (id INTEGER PRIMARY KEY, content VARCHAR NOT NULL, image_url VARCHAR, "
+    "created_at DATETIME NOT NULL, user_id INTEGER NOT NULL)",
+    "CREATE TABLE comment (id INTEGER PRIMARY KEY, content VARCHAR NOT NULL, created_at DATETIME NOT NULL, "
+    "user_id INTEGER NOT NULL, post_id INTEGER NOT NULL)",
+    "CREATE TABLE reaction (id INTEGER PRIMARY KEY, type VARCHAR NOT NULL, user_id INTEGER NOT NULL, post_id INTEGER NOT NULL)",
+]
+
+
+def test_keys_added_to_existing_tables(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        for statement in OLD_TABLES:
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO reaction (id, type, user_id, post_id) VALUES "
+                          "(1, 'like', 1, 1), (2, 'love', 1, 1), (3, 'like', 2, 1)"))
+    SQLModel.metadata.create_all(engine)
+    ensure_keys(SQLModel.metadata, engine)
+    # Running again finds everything in place
+    ensure_keys(SQLModel.metadata, engine)
+
+    inspector = inspect(engine)
+    assert {i["name"] for i in inspector.get_indexes("post")} == {"ix_post_created_at_id", "ix_post_user_created_id"}
+    assert {i["name"] for i in inspector.get_indexes("comment")} == {"ix_comment_post_id"}
+    assert [(i["name"], bool(i["unique"])) for i in inspector.get_indexes("reaction")] == [("uq_reaction_post_id_user_id", True)]
+    with engine.connect() as conn:
+        # The newest reaction of each user is kept
+        assert conn.execute(text("SELECT id, type FROM reaction ORDER BY id")).all() == [(2, "love"), (3, "like")]
+
+
+def test_new_database_gets_no_extra_keys(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'new.db'}")
+    SQLModel.metadata.create_all(engine)
+    ensure_keys(SQLModel.metadata, engine)
+    # create_all made the unique constraint, no index doubles it
+    inspector = inspect(engine)
+    assert not [i["name"] for table in inspector.get_table_names() for i in inspector.get_indexes(table)
+                if i["name"].startswith("uq_")]
+
+
+def test_engines_get_a_driver_of_their_kind():
+    drivers = {}
+    for raw in ("sqlite:///app.db", "mysql+mysqlconnector://u:p@db/app?pool_size=5", "mysql+aiomysql://u:p@db/app",
+                "postgresql://u@db/app", "postgresql+asyncpg://u@db/app", "postgresql+psycopg://u@db/app"):
+        url, _ = split_url(raw)
+        drivers[raw.split(":")[0]] = (sync_url(url).drivername, async_url(url).drivername)
+    assert drivers == {
+        "sqlite": ("sqlite", "sqlite+aiosqlite"),
+        "mysql+mysqlconnector": ("mysql+mysqlconnector", "mysql+aiomysql"),
+        # An async driver the URL names is kept, the sync engine gets the sync one
+        "mysql+aiomysql": ("mysql+pymysql", "mysql+aiomysql"),
+        "postgresql": ("postgresql", "postgresql+asyncpg"),
+        "postgresql+asyncpg": ("postgresql+psycopg2", "postgresql+asyncpg"),
+        "postgresql+psycopg": ("postgresql+psycopg", "postgresql+psycopg"),
+    }
@@ -0,0 +1,164 @@
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+import download_engine
+from download_engine import DownloadEngine, HostLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    # Only the bucket's notion of time, condition waits still use the real clock
+    monkeypatch.setattr(download_engine, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def advance(bucket: TokenBucket, clock: Clock, seconds: float):
+    clock.now += seconds
+    with bucket._cond:
+        bucket._cond.notify_all()
+
+
+def wait_until(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def start(target, *args) -> threading.Thread:
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_bucket_refills_at_rate_up_to_burst(clock):
+    bucket = TokenBucket(1000)
+    assert bucket.tokens == 1000
+    bucket.consume(800)
+    assert bucket.tokens == 200
+    clock.now += 0.5
+    bucket._refill()
+    assert bucket.tokens == 700
+    clock.now += 10
+    bucket._refill()
+    # Idle time only builds up one burst
+    assert bucket.tokens == bucket.capacity == 1000
+
+
+def test_consume_waits_for_refill(clock):
+    bucket = TokenBucket(1000)
+    bucket.consume(1000)
+    consumer = start(bucket.consume, 500)
+    consumer.join(0.05)
+    assert consumer.is_alive()
+    advance(bucket, clock, 0.25)
+    consumer.join(0.05)
+    assert consumer.is_alive()
+    advance(bucket, clock, 0.25)
+    consumer.join(5)
+    assert not consumer.is_alive()
+    assert bucket.tokens == 0
+
+
+def test_oversized_block_empties_bucket(clock):
+    bucket = TokenBucket(1000)
+    # Larger than the burst, it would never fit otherwise
+    bucket.consume(5000)
+    assert bucket.tokens == 0
+
+
+def test_unlimited_bucket_never_blocks(clock):
+    bucket = TokenBucket(0)
+    bucket.consume(10 ** 12)
+    assert not any(bucket.waiting.values())
+
+
+def test_class_behind_its_share_goes_first(clock):
+    bucket = TokenBucket(1000)
+    bucket.consume(1000)
+    bucket.served = {"bot": 0.0, "api": 5000.0}
+    bucket.last_seen = {"bot": clock.now, "api": clock.now}
+    done = []
+    api = start(lambda: (bucket.consume(500, "api"), done.append("api")))
+    wait_until(lambda: bucket.waiting["api"])
+    bot = start(lambda: (bucket.consume(500, "bot"), done.append("bot")))
+    wait_until(lambda: bucket.waiting["bot"])
+
+    # Room for one block, the api request arrived first but bot is behind
+    advance(bucket, clock, 0.5)
+    wait_until(lambda: done == ["bot"])
+    advance(bucket, clock, 0.5)
+    wait_until(lambda: done == ["bot", "api"])
+    api.join(5)
+    bot.join(5)
+
+
+def test_host_limiter_grants_up_to_the_cap():
+    limiter = HostLimiter(4)
+    assert limiter.acquire("cdn.example", 3) == 3
+    # Only what is left, other hosts are counted apart
+    assert limiter.acquire("cdn.example", 3) == 1
+    assert limiter.acquire("other.example", 4) == 4
+    assert limiter.active == {"cdn.example": 4, "other.example": 4}
+
+    granted = []
+    waiter = start(lambda: granted.append(limiter.acquire("cdn.example", 2)))
+    waiter.join(0.05)
+    assert waiter.is_alive()
+    limiter.release("cdn.example", 3)
+    waiter.join(5)
+    assert granted == [2]
+    limiter.release("cdn.example", 3)
+    limiter.release("other.example", 4)
+    assert limiter.active == {}
+
+
+def test_transfer_reserves_fragments_per_host(clock):
+    engine = DownloadEngine(bandwidth_mbps=0, per_host=6, fragments=4)
+    info = {"formats": [
+        {"format_id": "v", "protocol": "m3u8_native", "url": "https://video.example/v.m3u8"},
+        {"format_id": "a", "protocol": "https", "url": "https://audio.example/a.m4a"},
+    ]}
+    with engine.transfer(info, "v+a") as first:
+        assert engine.hosts.active == {"audio.example": 4, "video.example": 4}
+        assert first.ydl_opts()["concurrent_fragment_downloads"] == 4
+        with engine.transfer(info, "v+a") as second:
+            # The hosts only had two connections left
+            assert second.fragments == 2
+            assert engine.hosts.active == {"audio.example": 6, "video.example": 6}
+    assert engine.hosts.active == {}
+
+
+def test_transfer_releases_connections_on_error(clock):
+    engine = DownloadEngine(bandwidth_mbps=0, per_host=1)
+    info = {"formats": [{"format_id": "mp4", "protocol": "https", "url": "https://cdn.example/v.mp4"}]}
+    with pytest.raises(RuntimeError):
+        with engine.transfer(info, "mp4"):
+            assert engine.hosts.active == {"cdn.example": 1}
+            raise RuntimeError("download failed")
+    assert engine.hosts.active == {}
+    # The host can be used again right away
+    with engine.transfer(info, "mp4"):
+        pass
+
+
+def test_progress_hook_charges_new_bytes_once(clock):
+    engine = DownloadEngine(bandwidth_mbps=8)  # 1MB/s
+    info = {"formats": [{"format_id": "mp4", "protocol": "https", "url": "https://cdn.example/v.mp4"}]}
+    with engine.transfer(info, "mp4", priority="bot") as transfer:
+        for downloaded in (100_000, 300_000, 300_000):
+            transfer.progress_hook({"status": "downloading", "tmpfilename": "v.mp4.part",
+                                    "downloaded_bytes": downloaded})
+        transfer.progress_hook({"status": "finished", "filename": "v.mp4", "downloaded_bytes": 300_000})
+    assert engine.bucket.tokens == 1_000_000 - 300_000
+    assert engine.bucket.served["bot"] == 300_000 / engine.bucket.weights["bot"]
@@ -0,0 +1,49 @@
+import time
+from fastapi.testclient import TestClient
+import jobs
+import main
+from media_cache import media_cache
+
+
+def login(client: TestClient, username: str) -> dict:
+    client.post("/register", json={"username": username, "email": f"{username}@example.com",
+                                   "full_name": username, "password": "secret"})
+    token = client.post("/token", data={"username": username, "password": "secret"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_jobs_belong_to_the_user_who_created_them(monkeypatch, tmp_path):
+    def download_cached(url, format_type, max_filesize_mb, progress_hook=None):
+        source = tmp_path / "clip.mp4"
+        source.write_bytes(b"media")
+        media_cache.put("jobs-test-clip", str(source))
+        return {"key": "jobs-test-clip", "title": "clip", "path": media_cache.get("jobs-test-clip")}
+
+    sent = []
+
+    async def send_personal_message(message, user_id):
+        sent.append(user_id)
+
+    monkeypatch.setattr(jobs.downloader, "download_cached", download_cached)
+    monkeypatch.setattr(main.manager, "send_personal_message", send_personal_message)
+    with TestClient(main.app) as client:
+        params = {"url": "https://example.com/v/1"}
+        assert client.post("/downloader/jobs", params=params).status_code == 401
+        # Naming someone else's id no longer routes their progress anywhere
+        assert client.post("/downloader/jobs", params={**params, "user_id": 999}).status_code == 401
+
+        owner, other = login(client, "jobs-owner"), login(client, "jobs-other")
+        owner_id = client.get("/users/me", headers=owner).json()["id"]
+        job = client.post("/downloader/jobs", params={**params, "user_id": 999}, headers=owner).json()
+        deadline = time.monotonic() + 5
+        while client.get(f"/downloader/jobs/{job['id']}", headers=owner).json()["status"] != "finished":
+            assert time.monotonic() < deadline, "job didn't finish"
+            time.sleep(0.01)
+
+        response = client.get(f"/downloader/jobs/{job['id']}/file", headers=owner)
+        assert (response.status_code, response.content) == (200, b"media")
+        # Anyone else is told the job doesn't exist
+        for path in (f"/downloader/jobs/{job['id']}", f"/downloader/jobs/{job['id']}/file"):
+            assert client.get(path, headers=other).status_code == 404
+            assert client.get(path).status_code == 401
+    assert set(sent) == {owner_id}
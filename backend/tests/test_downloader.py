@@ -0,0 +1,31 @@
+import os
+from downloader import MediaDownloader
+from media_cache import MediaCache
+
+INFO = {"id": "abc", "extractor_key": "Test", "title": "clip"}
+MB = 1024 * 1024
+
+
+def test_oversize_results_are_cached_apart(tmp_path, monkeypatch):
+    downloader = MediaDownloader(cache=MediaCache(root=str(tmp_path / "cache")))
+    calls = []
+
+    def download_media(url, format_type, max_filesize_mb, info, progress_hook, output_dir, allow_oversize, **kwargs):
+        calls.append(allow_oversize)
+        path = os.path.join(output_dir, f"clip-{len(calls)}.mp4")
+        with open(path, "wb") as f:
+            f.write(b"\0" * (2 * MB if allow_oversize else MB // 2))
+        return {"path": path}
+
+    monkeypatch.setattr(downloader, "download_media", download_media)
+    monkeypatch.setattr(downloader, "fit_cached", lambda key, path, max_bytes, strategy: [{"key": "fit", "path": path}])
+
+    downloader.download_cached("https://example.com/clip", max_filesize_mb=1, info=INFO, oversize="transcode")
+    # Without a strategy the over-limit file isn't served, it is downloaded within the limit
+    result = downloader.download_cached("https://example.com/clip", max_filesize_mb=1, info=INFO)
+    assert calls == [True, False]
+    assert os.path.getsize(result["path"]) <= MB
+    # Each kind is a cache hit from then on
+    downloader.download_cached("https://example.com/clip", max_filesize_mb=1, info=INFO, oversize="split")
+    downloader.download_cached("https://example.com/clip", max_filesize_mb=1, info=INFO)
+    assert calls == [True, False]
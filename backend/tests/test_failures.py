@@ -0,0 +1,173 @@
+import sys
+from types import SimpleNamespace
+import pytest
+from yt_dlp.networking.exceptions import TransportError
+from yt_dlp.utils import DownloadError, ExtractorError, GeoRestrictedError, UnsupportedError
+import cache
+import failures
+from downloader import MediaDownloader
+from failures import FAILURE_TTLS, CircuitBreaker, CircuitOpen, ExtractionFailed, classify, extractor_domain
+from media_cache import MediaCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(failures, "time", SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(cache, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def reported(error: Exception) -> DownloadError:
+    """``error`` as YoutubeDL reports it, wrapped in a DownloadError."""
+    try:
+        raise error
+    except Exception:
+        return DownloadError(f"ERROR: {error}", sys.exc_info())
+
+
+SITE_ERROR = reported(ExtractorError("HTTP Error 429: Too Many Requests"))
+PRIVATE = reported(ExtractorError("Private video. Sign in if you've been granted access", expected=True))
+
+
+def test_classify():
+    assert classify(reported(UnsupportedError("https://nothing.example/x"))) == "unsupported"
+    assert classify(reported(GeoRestrictedError("This video is not available from your location"))) == "geo"
+    assert classify(PRIVATE) == "unavailable"
+    assert classify(ExtractorError("Sign in to confirm your age", expected=True)) == "login"
+    # Rate limits are about the site, even when yt-dlp expects them
+    assert classify(SITE_ERROR) == "error"
+    assert classify(ExtractorError("Sign in to confirm you're not a bot", expected=True)) == "error"
+    assert classify(TransportError("Connection reset by peer")) == "error"
+    # An unexpected extractor error is a bug of the extractor, the media may be fine
+    assert classify(reported(ExtractorError("Unable to extract player response"))) == "error"
+    assert classify(ExtractionFailed("geo", "cached")) == "geo"
+    assert classify(ValueError("ours")) is None
+
+
+def test_extractor_domain():
+    assert extractor_domain("https://m.youtube.com/watch?v=1") == "youtube.com"
+    assert extractor_domain(" https://WWW.Example.com/a ") == "example.com"
+
+
+def fail(breaker: CircuitBreaker, domain: str, error: BaseException = SITE_ERROR):
+    with pytest.raises(type(error)):
+        with breaker.guard(domain):
+            raise error
+
+
+def succeed(breaker: CircuitBreaker, domain: str):
+    with breaker.guard(domain):
+        pass
+
+
+def test_circuit_opens_after_consecutive_site_failures(clock):
+    breaker = CircuitBreaker(failures=3, cooldown=10, max_cooldown=25)
+    fail(breaker, "example.com")
+    fail(breaker, "example.com")
+    # A success in between starts the count again
+    succeed(breaker, "example.com")
+    assert breaker.state() == {}
+    for _ in range(3):
+        fail(breaker, "example.com")
+    assert breaker.state()["example.com"]["state"] == "open"
+    with pytest.raises(CircuitOpen) as excinfo:
+        succeed(breaker, "example.com")
+    assert excinfo.value.retry_after == 10
+    # Other sites aren't affected
+    succeed(breaker, "other.example")
+
+
+def test_media_failures_show_the_site_works(clock):
+    breaker = CircuitBreaker(failures=2, cooldown=10)
+    fail(breaker, "example.com")
+    fail(breaker, "example.com", PRIVATE)
+    fail(breaker, "example.com")
+    assert breaker.state()["example.com"]["state"] == "closed"
+
+
+def test_probe_failures_double_the_cooldown_up_to_the_cap(clock):
+    breaker = CircuitBreaker(failures=1, cooldown=10, max_cooldown=25)
+    fail(breaker, "example.com")
+    for cooldown in (20, 25, 25):
+        clock.now += breaker.circuits["example.com"].cooldown
+        # The probe's failure opens the circuit again for longer
+        fail(breaker, "example.com")
+        circuit = breaker.state()["example.com"]
+        assert (circuit["state"], circuit["retry_after"]) == ("open", cooldown)
+    assert breaker.state()["example.com"]["trips"] == 4
+
+
+def test_one_probe_at_a_time_and_its_success_closes(clock):
+    breaker = CircuitBreaker(failures=1, cooldown=10)
+    fail(breaker, "example.com")
+    clock.now += 10
+    with breaker.guard("example.com"):
+        assert breaker.state()["example.com"]["state"] == "half_open"
+        # Requests arriving while the probe runs still fail fast
+        with pytest.raises(CircuitOpen):
+            succeed(breaker, "example.com")
+    assert breaker.state() == {}
+
+
+def test_probe_ending_with_our_own_error_hands_its_turn_back(clock):
+    breaker = CircuitBreaker(failures=1, cooldown=10)
+    fail(breaker, "example.com")
+    clock.now += 10
+    fail(breaker, "example.com", ValueError("disk full"))
+    circuit = breaker.state()["example.com"]
+    # Still open, but with the cooldown over the next request is the probe
+    assert (circuit["state"], circuit["retry_after"], circuit["trips"]) == ("open", 0, 1)
+    succeed(breaker, "example.com")
+    assert breaker.state() == {}
+
+
+@pytest.fixture
+def downloader(tmp_path, clock):
+    return MediaDownloader(cache=MediaCache(root=str(tmp_path / "cache")),
+                           circuit_breaker=CircuitBreaker(failures=100))
+
+
+def guarded(downloader: MediaDownloader, url: str, error: BaseException = None) -> bool:
+    """Run a guarded block raising ``error``, returns whether the block ran."""
+    ran = []
+    with downloader._guard(url):
+        ran.append(True)
+        if error is not None:
+            raise error
+    return bool(ran)
+
+
+@pytest.mark.parametrize("error, cause", [
+    (reported(UnsupportedError("https://example.com/v/1")), "unsupported"),
+    (PRIVATE, "unavailable"),
+    (ExtractorError("This video is members-only content", expected=True), "login"),
+    (reported(GeoRestrictedError("This video is not available from your location")), "geo"),
+])
+def test_failures_are_remembered_for_their_cause_ttl(downloader, clock, error, cause):
+    url = "https://example.com/v/1"
+    with pytest.raises(type(error)):
+        guarded(downloader, url, error)
+    # The same URL, tracking parameters aside, fails without running the extractor
+    clock.now += FAILURE_TTLS[cause] - 1
+    with pytest.raises(ExtractionFailed) as excinfo:
+        guarded(downloader, url + "?utm_source=feed")
+    assert excinfo.value.cause == cause
+    clock.now += 2
+    assert guarded(downloader, url)
+
+
+def test_site_failures_are_retried(downloader):
+    with pytest.raises(DownloadError):
+        guarded(downloader, "https://example.com/v/2", SITE_ERROR)
+    with pytest.raises(ValueError):
+        guarded(downloader, "https://example.com/v/2", ValueError("ours"))
+    assert guarded(downloader, "https://example.com/v/2")
@@ -0,0 +1,17 @@
+import os
+import shutil
+import pytest
+from ffmpeg_tools import exit_status, ffmpeg_executable, run_ffmpeg
+
+
+def test_exit_status():
+    assert exit_status(1) == "exit code 1"
+    assert exit_status(-11) == "signal SIGSEGV"
+    assert exit_status(-200) == "signal 200"
+
+
+@pytest.mark.skipif(not (os.path.exists(ffmpeg_executable()) or shutil.which(ffmpeg_executable())),
+                    reason="ffmpeg not installed")
+def test_failure_names_exit_status(tmp_path):
+    with pytest.raises(RuntimeError, match=r"ffmpeg failed with exit code \d+: .*No such file"):
+        run_ffmpeg(["-i", str(tmp_path / "missing.mp4"), str(tmp_path / "out.mp4")])
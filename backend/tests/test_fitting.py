@@ -0,0 +1,38 @@
+import os
+import shutil
+import pytest
+from ffmpeg_tools import ffmpeg_executable, has_video, run_ffmpeg
+from fitting import is_audio, transcode_to_fit
+
+pytestmark = pytest.mark.skipif(not (os.path.exists(ffmpeg_executable()) or shutil.which(ffmpeg_executable())),
+                                reason="ffmpeg not installed")
+
+
+def tone(path, *args):
+    run_ffmpeg(["-f", "lavfi", "-i", "sine=duration=5", *args, str(path)])
+    return str(path)
+
+
+def test_audio_is_found_by_its_streams(tmp_path):
+    assert is_audio(tone(tmp_path / "tone.flac"))
+    assert is_audio(tone(tmp_path / "tone.wav"))
+    assert is_audio(tone(tmp_path / "book.m4b", "-c:a", "aac"))
+    video = str(tmp_path / "clip.mp4")
+    run_ffmpeg(["-f", "lavfi", "-i", "testsrc=duration=1:size=64x64", "-f", "lavfi", "-i", "sine=duration=1",
+                "-c:v", "libx264", "-c:a", "aac", "-shortest", video])
+    assert has_video(video) and not is_audio(video)
+
+
+def test_cover_art_is_not_video(tmp_path):
+    cover = str(tmp_path / "cover.png")
+    run_ffmpeg(["-f", "lavfi", "-i", "color=red:size=32x32", "-frames:v", "1", cover])
+    song = tone(tmp_path / "song.mp3", "-i", cover, "-map", "0", "-map", "1", "-c:v", "copy", "-disposition:v", "attached_pic")
+    assert is_audio(song)
+
+
+def test_lossless_audio_is_reencoded_to_aac(tmp_path):
+    source = tone(tmp_path / "tone.flac")
+    [output] = transcode_to_fit(source, 64 * 1024, str(tmp_path))
+    assert output.endswith(".fit.m4a")
+    assert is_audio(output)
+    assert os.path.getsize(output) <= 64 * 1024
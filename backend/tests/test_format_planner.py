@@ -0,0 +1,131 @@
+from conftest import load_info
+from format_planner import (AUDIO_OUTPUT_KBPS, DEFAULT_FORMATS, MUX_OVERHEAD_BYTES, MUX_OVERHEAD_RATIO,
+                            compact_formats, estimate_size, plan_formats)
+
+MB = 1024 * 1024
+
+
+def test_estimate_size_sources():
+    assert estimate_size({"filesize": 1000, "filesize_approx": 2000}, 10) == 1000
+    assert estimate_size({"filesize_approx": 2000}, 10) == 2000
+    assert estimate_size({"tbr": 800}, 10) == 1_000_000
+    assert estimate_size({"vbr": 600, "abr": 200}, 10) == 1_000_000
+    assert estimate_size({"tbr": 800}, None) is None
+    assert estimate_size({}, 10) is None
+
+
+def test_no_limit_keeps_default_selector():
+    plan = plan_formats(load_info("youtube"), "video")
+    assert plan.format_spec == DEFAULT_FORMATS["video"]
+    assert plan.fits is True
+
+
+def test_best_pair_within_budget():
+    plan = plan_formats(load_info("youtube"), "video", 50 * MB)
+    # 360p60 beats the 360p24 progressive file, opus is the best audio that still fits
+    assert plan.format_spec == "134+251"
+    assert plan.fits is True
+    assert plan.estimated_size == int((38811544 + 10733470) * MUX_OVERHEAD_RATIO) + MUX_OVERHEAD_BYTES
+    assert plan.estimated_size <= 50 * MB
+
+
+def test_bitrate_estimate_used_without_filesize():
+    # 136 has no filesize, its tbr x duration puts 720p over 150MB but under 250MB
+    assert plan_formats(load_info("youtube"), "video", 150 * MB).format_spec == "134+251"
+    assert plan_formats(load_info("youtube"), "video", 250 * MB).format_spec == "136+251"
+
+
+def test_large_budget_takes_highest_resolution():
+    assert plan_formats(load_info("youtube"), "video", 500 * MB).format_spec == "299+251"
+
+
+def test_nothing_fits_reports_smallest():
+    plan = plan_formats(load_info("youtube"), "video", 10 * MB)
+    assert plan.fits is False
+    assert plan.format_spec == "18"
+    assert plan.estimated_size == 37900000
+
+
+def test_unknown_codecs_are_single_files():
+    plan = plan_formats(load_info("generic"), "video", 50 * MB)
+    assert plan.format_spec == "mp4"
+    assert plan.estimated_size is None
+    # Unknown, not a silent fall-through to the default selector
+    assert plan.fits is None
+    assert plan.to_dict()["fits"] is None
+
+
+def test_unknown_codec_with_size_fits():
+    info = load_info("generic")
+    info["formats"][0]["filesize"] = 20 * MB
+    plan = plan_formats(info, "video", 50 * MB)
+    assert (plan.format_spec, plan.fits) == ("mp4", True)
+
+
+def test_no_format_list_is_unknown():
+    plan = plan_formats({"duration": 60, "formats": []}, "video", 50 * MB)
+    assert plan.fits is None
+
+
+def test_audio_copies_matching_codec():
+    plan = plan_formats(load_info("soundcloud"), "audio", 10 * MB, "mp3")
+    assert plan.format_spec in ("hls_mp3_128", "http_mp3_128")
+    assert plan.fits is True
+    assert plan.estimated_size == int(128 * 1000 / 8 * 214.3)
+
+    plan = plan_formats(load_info("soundcloud"), "audio", 10 * MB, "opus")
+    assert plan.format_spec == "hls_opus_64"
+
+
+def test_audio_reencode_sized_by_output_bitrate():
+    plan = plan_formats(load_info("soundcloud"), "audio", 10 * MB, "m4a")
+    assert plan.fits is True
+    assert plan.estimated_size == int(AUDIO_OUTPUT_KBPS * 1000 / 8 * 214.3)
+
+    plan = plan_formats(load_info("soundcloud"), "audio", 1 * MB, "m4a")
+    assert plan.fits is False
+
+
+def long_m4a_info(*extra):
+    # 25 minutes at 256kbps, ~48MB
+    return {"duration": 1500, "formats": [
+        {"format_id": "m4a_256", "acodec": "mp4a.40.2", "vcodec": "none", "abr": 256, "ext": "m4a"}, *extra]}
+
+
+def test_oversized_copied_audio_does_not_fit():
+    # The source would be copied, not re-encoded to AUDIO_OUTPUT_KBPS
+    for audio_codec in ("m4a", "best"):
+        plan = plan_formats(long_m4a_info(), "audio", 40 * MB, audio_codec)
+        assert (plan.format_spec, plan.fits) == ("m4a_256", False)
+        assert plan.estimated_size == int(256 * 1000 / 8 * 1500)
+
+
+def test_oversized_copy_gives_way_to_a_reencode():
+    opus = {"format_id": "opus_160", "acodec": "opus", "vcodec": "none", "abr": 160, "ext": "webm"}
+    plan = plan_formats(long_m4a_info(opus), "audio", 40 * MB, "m4a")
+    assert (plan.format_spec, plan.fits) == ("opus_160", True)
+    assert plan.estimated_size == int(AUDIO_OUTPUT_KBPS * 1000 / 8 * 1500)
+
+
+def test_best_converts_unknown_codecs():
+    info = long_m4a_info()
+    info["formats"][0]["acodec"] = "alac"
+    plan = plan_formats(info, "audio", 40 * MB, "best")
+    assert plan.fits is True
+    assert plan.estimated_size == int(AUDIO_OUTPUT_KBPS * 1000 / 8 * 1500)
+
+
+def test_audio_without_duration_is_unknown():
+    info = load_info("soundcloud")
+    info["duration"] = None
+    plan = plan_formats(info, "audio", 10 * MB, "m4a")
+    assert plan.fits is None
+
+
+def test_compact_formats_groups_by_resolution_and_codec():
+    compact = compact_formats(load_info("youtube"))
+    groups = [(f["resolution"], f["codec"]) for f in compact["formats"]]
+    assert groups == [("1080p", "h264"), ("720p", "h264"), ("720p", "vp9"), ("360p", "h264"), ("360p", "h264")]
+    assert [a["codec"] for a in compact["audio_formats"]] == ["opus", "aac"]
+    # Video-only sizes include the best audio
+    assert compact["formats"][0]["estimated_size"] == int((436393522 + 10733470) * MUX_OVERHEAD_RATIO) + MUX_OVERHEAD_BYTES
@@ -0,0 +1,31 @@
+import asyncio
+import pytest
+from realtime import Broker, InMemoryBroker
+
+
+def test_incomplete_broker_fails_when_created():
+    class NoPublish(Broker):
+        pass
+
+    with pytest.raises(TypeError, match="publish"):
+        NoPublish()
+
+
+def test_in_memory_broker_delivers_subscribed_channels():
+    async def scenario():
+        received = []
+
+        async def handler(channel, message):
+            received.append((channel, message))
+
+        broker = InMemoryBroker()
+        await broker.start(handler)
+        await broker.subscribe("user:1")
+        await broker.publish("user:1", "hello")
+        await broker.publish("user:2", "not subscribed")
+        await broker.unsubscribe("user:1")
+        await broker.publish("user:1", "after unsubscribe")
+        await broker.stop()
+        return received
+
+    assert asyncio.run(scenario()) == [("user:1", "hello")]
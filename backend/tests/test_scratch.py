@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+import scratch
+from scratch import ScratchStorage, StorageFull
+
+
+def storage(tmp_path, **options) -> ScratchStorage:
+    options = {"quota": 100, "min_free": 0, "wait": 5, **options}
+    return ScratchStorage(root=str(tmp_path / "scratch"), **options)
+
+
+def wait_until(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def test_workspace_is_reserved_and_removed(tmp_path):
+    store = storage(tmp_path)
+    with store.workspace("job1", 40) as work:
+        assert os.path.isdir(work.path)
+        open(os.path.join(work.path, "video.part"), "wb").close()
+        assert store.stats()["disk_bytes"] == 40
+    assert not os.path.exists(work.path)
+    assert store.stats()["disk_bytes"] == 0 and store.stats()["jobs"] == 0
+
+
+def test_job_waits_for_room_then_starts(tmp_path):
+    store = storage(tmp_path)
+    release = threading.Event()
+    order = []
+
+    def job(job_id, size):
+        with store.workspace(job_id, size):
+            order.append(job_id)
+            release.wait(5)
+
+    first = threading.Thread(target=job, args=("first", 60))
+    first.start()
+    wait_until(lambda: order == ["first"])
+    second = threading.Thread(target=job, args=("second", 60))
+    second.start()
+    # Both together would be over the quota
+    wait_until(lambda: store.waiting == 1)
+    assert order == ["first"]
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert order == ["first", "second"]
+    assert store.stats()["disk_bytes"] == 0
+
+
+def test_job_is_refused(tmp_path):
+    store = storage(tmp_path, wait=0.1)
+    # Larger than the quota, waiting wouldn't help
+    with pytest.raises(StorageFull, match="quota"):
+        with store.workspace("huge", 101):
+            pass
+    with store.workspace("running", 80):
+        with pytest.raises(StorageFull, match="try again"):
+            with store.workspace("late", 30):
+                pass
+    assert store.stats()["rejected"] == 2
+    assert store.waiting == 0
+
+
+def test_free_space_is_kept_whatever_the_quota(tmp_path, monkeypatch):
+    store = storage(tmp_path, quota=10 ** 12, min_free=1000, wait=0.1)
+    monkeypatch.setattr(scratch.shutil, "disk_usage", lambda path: SimpleNamespace(free=1500))
+    with store.workspace("small", 500):
+        pass
+    with pytest.raises(StorageFull):
+        with store.workspace("large", 501):
+            pass
+
+
+def test_small_jobs_go_to_ram(tmp_path):
+    store = storage(tmp_path, ram_root=str(tmp_path / "ram"), ram_job_max=30, ram_quota=50)
+    with store.workspace("a", 30) as a, store.workspace("b", 30) as b, store.workspace("c", 40) as c:
+        # b would overflow the RAM quota, c is over the per-job limit
+        assert (a.tier, b.tier, c.tier) == ("ram", "disk", "disk")
+        assert a.path == str(tmp_path / "ram" / "a")
+        assert store.stats()["ram_bytes"] == 30 and store.stats()["disk_bytes"] == 70
+
+
+def age(path, seconds: float):
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def test_sweep_removes_orphans_only(tmp_path, monkeypatch):
+    store = storage(tmp_path, orphan_age=60)
+    # Swept by hand here, the janitor thread would race the checks
+    monkeypatch.setattr(store, "_start_janitor", lambda: None)
+    watched = tmp_path / "cache-tmp"
+    watched.mkdir()
+    store.watch(str(watched))
+    root = tmp_path / "scratch"
+
+    # Left by crashed jobs
+    orphan = root / "crashed"
+    orphan.mkdir()
+    (orphan / "video.part").write_bytes(b"x" * 100)
+    age(orphan / "video.part", 120)
+    age(orphan, 120)
+    (watched / "crashed.mp4").write_bytes(b"x" * 50)
+    age(watched / "crashed.mp4", 120)
+    # Recently written, a job of another process may still be using it
+    (watched / "recent.mp4").write_bytes(b"x" * 10)
+    # Directory old, but a file in it was written recently
+    busy = root / "busy"
+    busy.mkdir()
+    (busy / "fragment").write_bytes(b"x")
+    age(busy, 120)
+
+    with store.workspace("running", 10) as work:
+        (watched / "running.mp4").write_bytes(b"x" * 20)
+        age(watched / "running.mp4", 120)
+        age(work.path, 120)
+        assert store.sweep() == 150
+        # Files of running jobs are kept however old
+        assert sorted(os.listdir(watched)) == ["recent.mp4", "running.mp4"]
+        assert sorted(os.listdir(root)) == ["busy", "running"]
+    # Once the job is over, what it left in the watched directory is an orphan too
+    assert store.sweep() == 20
+    assert os.listdir(watched) == ["recent.mp4"]
+    assert store.stats()["reclaimed_bytes"] == 170
+
+
+def test_janitor_starts_with_the_first_job(tmp_path):
+    store = storage(tmp_path, orphan_age=60)
+    orphan = tmp_path / "scratch" / "crashed.mp4"
+    orphan.write_bytes(b"x" * 100)
+    age(orphan, 120)
+    with store.workspace("job", 10):
+        wait_until(lambda: store.stats()["reclaimed_bytes"] == 100)
+    assert not orphan.exists()
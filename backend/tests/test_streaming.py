@@ -0,0 +1,95 @@
+import asyncio
+import os
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from ffmpeg_tools import ffmpeg_executable
+from streaming import MediaStream, remux_stream
+
+BODY = os.urandom(200_000)
+
+
+class Upstream(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/missing":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        # /short promises the whole body but the connection drops half-way
+        self.wfile.write(BODY[:len(BODY) // 2] if self.path == "/short" else BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def upstream():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def direct(url: str) -> MediaStream:
+    # filesize is only the extractor's figure, the response length comes from upstream
+    return MediaStream([{"format_id": "18", "url": url, "filesize": 123}], remux=False, ext="mp4")
+
+
+async def read(media: MediaStream) -> bytes:
+    return b"".join([chunk async for chunk in media.body()])
+
+
+def test_direct_stream_sends_upstream_length(upstream):
+    async def scenario():
+        media = direct(f"{upstream}/media.mp4")
+        await media.open()
+        assert media.content_length == len(BODY)
+        assert await read(media) == BODY
+
+    asyncio.run(scenario())
+
+
+def test_direct_stream_upstream_error_is_raised_before_the_response(upstream):
+    async def scenario():
+        media = direct(f"{upstream}/missing")
+        with pytest.raises(httpx.HTTPStatusError):
+            await media.open()
+
+    asyncio.run(scenario())
+
+
+def test_direct_stream_cut_short_raises(upstream):
+    async def scenario():
+        media = direct(f"{upstream}/short")
+        await media.open()
+        with pytest.raises(httpx.HTTPError):
+            await read(media)
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.skipif(not (os.path.exists(ffmpeg_executable()) or shutil.which(ffmpeg_executable())),
+                    reason="ffmpeg not installed")
+def test_failed_remux_raises(upstream, caplog):
+    async def scenario():
+        formats = [{"format_id": "v", "url": f"{upstream}/missing", "vcodec": "avc1", "acodec": "none"}]
+        with pytest.raises(RuntimeError, match="failed with exit code"):
+            async for _ in remux_stream(formats):
+                pass
+
+    asyncio.run(scenario())
+    assert "Remux of v failed" in caplog.text
+
+
+def test_stream_with_size_limit_is_refused():
+    import main
+    response = TestClient(main.app).post("/downloader/download",
+                                         params={"url": "https://example.com/v", "stream": "true", "max_filesize_mb": 50})
+    assert response.status_code == 400
@@ -0,0 +1,127 @@
+import asyncio
+import itertools
+import threading
+import pytest
+from sqlmodel import SQLModel
+from telegram import Bot, Update
+from bot_api import BotApiStandIn
+from bot_scheduler import DownloadScheduler
+from database import engine
+import telegram_bot
+
+_update_ids = itertools.count(1)
+
+
+def message_update(bot: Bot, chat_id: int, text: str) -> Update:
+    update_id = next(_update_ids)
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "text": text,
+        },
+    }, bot)
+
+
+class FakeDownloader:
+    """Downloads that block in the download pool until released."""
+
+    def __init__(self, media_file: str):
+        self.media_file = media_file
+        self.started = []
+        self.release = {}
+        self._lock = threading.Lock()
+
+    def extract_info(self, url: str):
+        return {"id": url.rsplit("/", 1)[-1], "extractor_key": "Test", "title": url.rsplit("/", 1)[-1]}
+
+    def download_cached(self, url: str, format_type: str, **kwargs):
+        name = url.rsplit("/", 1)[-1]
+        with self._lock:
+            self.started.append(name)
+            release = self.release.setdefault(name, threading.Event())
+        assert release.wait(10)
+        return {"path": self.media_file, "title": name, "key": name, "parts": [{"key": name, "path": self.media_file}]}
+
+    def finish(self, name: str):
+        with self._lock:
+            self.release.setdefault(name, threading.Event()).set()
+
+
+@pytest.fixture
+def bot_env(monkeypatch, tmp_path):
+    SQLModel.metadata.create_all(engine)
+    media_file = tmp_path / "media.mp4"
+    media_file.write_bytes(b"\0" * 1024)
+    downloader = FakeDownloader(str(media_file))
+    scheduler = DownloadScheduler(max_concurrent=2, max_per_chat=1, max_queued_per_chat=2)
+    monkeypatch.setattr(telegram_bot, "downloader", downloader)
+    monkeypatch.setattr(telegram_bot, "scheduler", scheduler)
+    with BotApiStandIn() as api:
+        yield api, downloader, scheduler
+
+
+async def until(condition, timeout: float = 10):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("condition not reached")
+        await asyncio.sleep(0.01)
+
+
+def send(bot: Bot, chat_id: int, url: str) -> asyncio.Task:
+    return asyncio.create_task(telegram_bot.process_download(message_update(bot, chat_id, url), None, url, "video"))
+
+
+def test_links_are_queued_per_chat(bot_env):
+    api, downloader, scheduler = bot_env
+
+    async def scenario():
+        async with Bot("123:test", base_url=api.base_url) as bot:
+            # Links are looked up in the file_id cache before queueing, one at a time keeps the order
+            tasks = [send(bot, 1, "https://example.com/v/queued-a1")]
+            await until(lambda: downloader.started == ["queued-a1"])
+            tasks.append(send(bot, 1, "https://example.com/v/queued-a2"))
+            await until(lambda: scheduler.queued == 1)
+            # The second link of chat 1 waits for the first, chat 2 isn't held up by it
+            tasks.append(send(bot, 2, "https://example.com/v/queued-b1"))
+            await until(lambda: downloader.started == ["queued-a1", "queued-b1"])
+            await until(lambda: any("#1 in the queue" in text for text in api.texts(1)))
+            # A third link while two are pending is refused
+            await send(bot, 1, "https://example.com/v/queued-a3")
+            assert any("already have 2 downloads" in text for text in api.texts(1))
+
+            downloader.finish("queued-a1")
+            await until(lambda: downloader.started == ["queued-a1", "queued-b1", "queued-a2"])
+            downloader.finish("queued-b1")
+            downloader.finish("queued-a2")
+            await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert sorted(api.uploads()) == [1, 1, 2]
+    assert not any(text.startswith("❌") for chat in (1, 2) for text in api.texts(chat))
+
+
+def test_shutdown_finishes_downloads_and_refuses_new_links(bot_env):
+    api, downloader, scheduler = bot_env
+
+    async def scenario():
+        async with Bot("123:test", base_url=api.base_url) as bot:
+            running = send(bot, 1, "https://example.com/v/drain-a1")
+            await until(lambda: downloader.started == ["drain-a1"])
+            drain = asyncio.create_task(telegram_bot.drain_downloads(None))
+            await asyncio.sleep(0.05)
+            await send(bot, 2, "https://example.com/v/drain-b1")
+            assert any("restarting" in text for text in api.texts(2))
+            assert not drain.done()
+
+            downloader.finish("drain-a1")
+            await asyncio.wait_for(drain, 10)
+            await running
+
+    asyncio.run(scenario())
+    assert api.uploads() == [1]
+    assert downloader.started == ["drain-a1"]
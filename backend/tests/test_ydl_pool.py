@@ -0,0 +1,33 @@
+import pytest
+import ydl_pool
+from ydl_pool import YdlPool
+
+
+def test_checkout_changes_are_undone():
+    pool = YdlPool("test", {"info": {'quiet': True, 'no_warnings': True}}, size=1)
+    hook = lambda d: None
+    with pool.checkout("info", format="worst", outtmpl="%(id)s.%(ext)s", progress_hooks=[hook]) as ydl:
+        assert ydl.params["format"] == "worst"
+        assert hook in ydl._progress_hooks
+        first = ydl
+    with pool.checkout("info") as ydl:
+        # Same handle, back to how the profile built it
+        assert ydl is first
+        assert "format" not in ydl.params
+        assert hook not in ydl._progress_hooks
+        assert ydl.params["outtmpl"].get("default") != "%(id)s.%(ext)s"
+
+
+def test_fixed_params_are_refused():
+    pool = YdlPool("test", {"info": {'quiet': True}})
+    with pytest.raises(ValueError, match="quiet"):
+        with pool.checkout("info", quiet=False):
+            pass
+
+
+def test_missing_internals_fail_loudly(monkeypatch):
+    monkeypatch.setattr(ydl_pool, "HANDLE_ATTRS", ydl_pool.HANDLE_ATTRS + ("_renamed_in_a_later_release",))
+    pool = YdlPool("test", {"info": {'quiet': True}})
+    with pytest.raises(RuntimeError, match="_renamed_in_a_later_release"):
+        with pool.checkout("info"):
+            pass
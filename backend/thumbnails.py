@@ -0,0 +1,98 @@
+import logging
+import os
+import tempfile
+from typing import Callable, Optional
+import httpx
+from ffmpeg_tools import run_ffmpeg
+from media_cache import MediaCache
+from metrics import watch_cache
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_CACHE_DIR = os.getenv("THUMBNAIL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "alexdownloader-thumbnails"))
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv("THUMBNAIL_CACHE_MAX_MB", "200")) * 1024 * 1024
+THUMBNAIL_RETENTION_SECONDS = int(os.getenv("THUMBNAIL_RETENTION_SECONDS", str(7 * 24 * 3600)))
+# Widths the thumbnail proxy serves, a request is rounded up to the next one
+THUMBNAIL_WIDTHS = tuple(sorted(int(w) for w in os.getenv("THUMBNAIL_WIDTHS", "160,320,480,720").split(",")))
+
+# Containers ffmpeg can write cover art into
+COVER_EXTS = (".mp3", ".m4a")
+
+thumbnail_cache = MediaCache(THUMBNAIL_CACHE_DIR, THUMBNAIL_CACHE_MAX_BYTES, THUMBNAIL_RETENTION_SECONDS)
+watch_cache("thumbnail", thumbnail_cache)
+
+
+class NoThumbnail(Exception):
+    """The media has no thumbnail."""
+
+
+def fetch_thumbnail(url: str, output_dir: str) -> str:
+    """Download a thumbnail into ``output_dir``, returns the local path."""
+    response = httpx.get(url, follow_redirects=True, timeout=20)
+    response.raise_for_status()
+    fd, path = tempfile.mkstemp(dir=output_dir, suffix=".img")
+    with os.fdopen(fd, "wb") as f:
+        f.write(response.content)
+    return path
+
+
+def cover_jpeg(media_key: str, url: Optional[str]) -> Optional[str]:
+    """JPEG cover for a media item, fetched and converted once then reused."""
+    if not url:
+        return None
+
+    def produce(output_dir: str) -> str:
+        source = fetch_thumbnail(url, output_dir)
+        output = os.path.splitext(source)[0] + ".jpg"
+        try:
+            # Covers are shown small, no need to embed full size images
+            run_ffmpeg(["-i", source, "-frames:v", "1", "-vf", "scale='min(720,iw)':-2", output])
+        finally:
+            os.remove(source)
+        return output
+
+    try:
+        return thumbnail_cache.get_or_create(MediaCache.make_key(media_key, "cover"), produce)
+    except Exception as e:
+        # Cover art is optional, the media is still delivered without it
+        logger.warning("Thumbnail error: %s", e)
+        return None
+
+
+def thumbnail_width(width: Optional[int]) -> int:
+    """Smallest standard width at least ``width`` wide, the largest one by default."""
+    return next((w for w in THUMBNAIL_WIDTHS if width and w >= width), THUMBNAIL_WIDTHS[-1])
+
+
+def resized_thumbnail(media_key: str, width: int, source_url: Callable[[], Optional[str]]) -> str:
+    """JPEG thumbnail of a media item ``width`` pixels wide at most, from the cache.
+
+    On a miss the original is fetched once (``source_url`` is only called
+    then) and every standard width is made from it in a single ffmpeg pass.
+    Raises ``NoThumbnail`` when the media has none.
+    """
+    width = thumbnail_width(width)
+
+    def produce(output_dir: str) -> str:
+        url = source_url()
+        if not url:
+            raise NoThumbnail(media_key)
+        source = fetch_thumbnail(url, output_dir)
+        base = os.path.splitext(source)[0]
+        outputs = {w: f"{base}-{w}.jpg" for w in THUMBNAIL_WIDTHS}
+        labels = "".join(f"[s{w}]" for w in THUMBNAIL_WIDTHS)
+        graph = ";".join([f"[0:v]split={len(THUMBNAIL_WIDTHS)}{labels}"] +
+                         [f"[s{w}]scale='min({w},iw)':-2[o{w}]" for w in THUMBNAIL_WIDTHS])
+        args = ["-i", source, "-filter_complex", graph]
+        for w, output in outputs.items():
+            args += ["-map", f"[o{w}]", "-frames:v", "1", output]
+        try:
+            run_ffmpeg(args)
+        finally:
+            os.remove(source)
+        for w, output in outputs.items():
+            if w != width:
+                thumbnail_cache.put(MediaCache.make_key(media_key, f"thumbnail-{w}"), output)
+        return outputs[width]
+
+    return thumbnail_cache.get_or_create(MediaCache.make_key(media_key, f"thumbnail-{width}"), produce)
@@ -0,0 +1,209 @@
+import logging
+import os
+import random
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy import and_, delete, exists, func, insert, literal, or_
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+from database import engine
+from feed import POSTS_MAX_PAGE_SIZE, POSTS_PAGE_SIZE, before, decode_cursor, encode_cursor, load_posts
+from models import BuiltTimeline, Friendship, Post, PulledAuthor, TimelineEntry
+from schemas import PostPage
+
+# Posts kept in each home timeline, the feed ends after the oldest one
+TIMELINE_LENGTH = int(os.getenv("TIMELINE_LENGTH", "1000"))
+# Posts of users with more friends than this aren't pushed to every friend,
+# their friends read them from the author's posts instead
+FANOUT_MAX_FRIENDS = int(os.getenv("FANOUT_MAX_FRIENDS", "5000"))
+# A timeline is trimmed back to TIMELINE_LENGTH about once per this many pushed posts
+TIMELINE_TRIM_INTERVAL = int(os.getenv("TIMELINE_TRIM_INTERVAL", "50"))
+
+logger = logging.getLogger(__name__)
+
+
+def _accepted(user_id: int, other_id) -> object:
+    """Condition for an accepted friendship between ``user_id`` and ``other_id`` (either side sent it)."""
+    return and_(
+        Friendship.status == "accepted",
+        or_(
+            and_(Friendship.user_id == user_id, Friendship.friend_id == other_id),
+            and_(Friendship.user_id == other_id, Friendship.friend_id == user_id),
+        ),
+    )
+
+
+def _friends(user_id: int):
+    """Selects of the ids of ``user_id``'s friends, one per side of the friendship."""
+    accepted = Friendship.status == "accepted"
+    return (
+        select(Friendship.friend_id).where(Friendship.user_id == user_id, accepted),
+        select(Friendship.user_id).where(Friendship.friend_id == user_id, accepted),
+    )
+
+
+def friend_count(db: Session, user_id: int) -> int:
+    return sum(db.exec(select(func.count()).select_from(query.subquery())).one() for query in _friends(user_id))
+
+
+def _missing(owner_id, post_id) -> object:
+    return ~exists().where(TimelineEntry.owner_id == owner_id, TimelineEntry.post_id == post_id)
+
+
+def trim(db: Session, owner_id: int):
+    """Drop the entries of a timeline past its TIMELINE_LENGTH newest."""
+    oldest_kept = db.exec(
+        select(TimelineEntry.created_at, TimelineEntry.post_id)
+        .where(TimelineEntry.owner_id == owner_id)
+        .order_by(TimelineEntry.created_at.desc(), TimelineEntry.post_id.desc())
+        .offset(TIMELINE_LENGTH - 1).limit(1)
+    ).first()
+    if oldest_kept:
+        db.exec(delete(TimelineEntry).where(
+            TimelineEntry.owner_id == owner_id,
+            before(TimelineEntry.created_at, TimelineEntry.post_id, tuple(oldest_kept)),
+        ))
+
+
+def _commit(db: Session, *statements) -> bool:
+    """Run insert statements in one transaction, False if a concurrent write got there first."""
+    try:
+        for statement in statements:
+            db.exec(statement)
+        db.commit()
+        return True
+    except IntegrityError:
+        db.rollback()
+        return False
+
+
+def add_post(db: Session, post: Post):
+    """Put a new post in its author's own timeline, its friends get it from ``fan_out_post``."""
+    db.add(TimelineEntry(owner_id=post.user_id, post_id=post.id, created_at=post.created_at))
+    db.commit()
+
+
+def fan_out_post(post_id: int):
+    """Push a post to the timelines of its author's friends, unless the author is pulled at read time.
+
+    Runs after the response, with its own session.
+    """
+    with Session(engine) as db:
+        post = db.get(Post, post_id)
+        if post is None or db.get(PulledAuthor, post.user_id) is not None:
+            return
+        statements = [
+            insert(TimelineEntry).from_select(
+                ["owner_id", "post_id", "created_at"],
+                friends.add_columns(literal(post.id), literal(post.created_at))
+                .where(_missing(friends.selected_columns[0], post.id)),
+            )
+            for friends in _friends(post.user_id)
+        ]
+        # Retried once: the guard skips the entries a concurrent rebuild just added
+        if not _commit(db, *statements) and not _commit(db, *statements):
+            logger.error(f"Could not fan out post {post_id}")
+            return
+
+        # Trimming every timeline on every post would double the writes
+        owners = [owner for query in _friends(post.user_id) for owner in db.exec(query).all()]
+        for owner_id in owners:
+            if random.random() < 1 / TIMELINE_TRIM_INTERVAL:
+                trim(db, owner_id)
+        db.commit()
+
+
+def rebuild(db: Session, user_id: int):
+    """Refill a timeline with the newest posts of the user and their pushed friends."""
+    sent, received = _friends(user_id)
+    authors = or_(Post.user_id == user_id, Post.user_id.in_(sent), Post.user_id.in_(received))
+    pushed = or_(Post.user_id == user_id, Post.user_id.not_in(select(PulledAuthor.user_id)))
+    newest = (
+        select(literal(user_id), Post.id, Post.created_at)
+        .where(authors, pushed)
+        .order_by(Post.created_at.desc(), Post.id.desc())
+        .limit(TIMELINE_LENGTH)
+    )
+    db.exec(delete(TimelineEntry).where(TimelineEntry.owner_id == user_id))
+    db.exec(insert(TimelineEntry).from_select(["owner_id", "post_id", "created_at"], newest))
+    built = db.get(BuiltTimeline, user_id) or BuiltTimeline(owner_id=user_id)
+    built.built_at = datetime.utcnow()
+    db.add(built)
+    db.commit()
+
+
+def update_pulled(db: Session, user_id: int):
+    """Switch a user between pushed and pulled posts according to their friend count."""
+    count = friend_count(db, user_id)
+    pulled = db.get(PulledAuthor, user_id)
+    if count > FANOUT_MAX_FRIENDS:
+        pulled = pulled or PulledAuthor(user_id=user_id, friend_count=count)
+        pulled.friend_count = count
+        db.add(pulled)
+    elif pulled:
+        db.delete(pulled)
+    db.commit()
+
+
+def friendship_accepted(user_id: int, friend_id: int):
+    """Rebuild both timelines so each side sees the other's recent posts.
+
+    Runs after the response, with its own session.
+    """
+    with Session(engine) as db:
+        for uid in (user_id, friend_id):
+            update_pulled(db, uid)
+        for uid in (user_id, friend_id):
+            for _ in range(2):
+                try:
+                    rebuild(db, uid)
+                    break
+                except IntegrityError:
+                    # A post was pushed to the timeline between the delete and the insert
+                    db.rollback()
+
+
+def fetch_timeline_page(db: Session, user_id: int, cursor: Optional[str] = None,
+                        limit: int = POSTS_PAGE_SIZE) -> PostPage:
+    """Home feed of a user: their posts and their friends', newest first.
+
+    Reads one page of the materialized timeline and of each pulled friend's
+    posts, so the cost follows the page size and not the number of friends.
+    """
+    limit = max(1, min(limit, POSTS_MAX_PAGE_SIZE))
+    position = decode_cursor(cursor) if cursor else None
+
+    def page(created_at_column, id_column, query) -> List[tuple]:
+        if position:
+            query = query.where(before(created_at_column, id_column, position))
+        query = query.order_by(created_at_column.desc(), id_column.desc()).limit(limit + 1)
+        return [tuple(row) for row in db.exec(query).all()]
+
+    def timeline() -> List[tuple]:
+        return page(TimelineEntry.created_at, TimelineEntry.post_id,
+                    select(TimelineEntry.created_at, TimelineEntry.post_id).where(TimelineEntry.owner_id == user_id))
+
+    keys = timeline()
+    if not keys and position is None and db.get(BuiltTimeline, user_id) is None:
+        # Users from before timelines existed get theirs on first read, an
+        # empty timeline that was built stays empty until something is pushed
+        try:
+            rebuild(db, user_id)
+        except IntegrityError:
+            # Built by a concurrent request or push in the meantime
+            db.rollback()
+        keys = timeline()
+
+    # Few users are pulled, so this checks each of them rather than every friend
+    pulled = db.exec(select(PulledAuthor.user_id).where(
+        PulledAuthor.user_id != user_id, exists().where(_accepted(user_id, PulledAuthor.user_id))
+    )).all()
+    if pulled:
+        keys += page(Post.created_at, Post.id, select(Post.created_at, Post.id).where(Post.user_id.in_(pulled)))
+        # Posts from before an author was pulled can be in both
+        keys = sorted(set(keys), reverse=True)[:limit + 1]
+
+    page_keys = keys[:limit]
+    items = load_posts(db, Post.id.in_([post_id for _, post_id in page_keys]), limit) if page_keys else []
+    next_cursor = encode_cursor(*page_keys[-1]) if len(keys) > limit else None
+    return PostPage(items=items, next_cursor=next_cursor)
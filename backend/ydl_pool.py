@@ -0,0 +1,193 @@
+import copy
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional
+from metrics import Counter, Gauge
+
+if TYPE_CHECKING:
+    import yt_dlp
+
+# Idle handles kept per profile, extra ones are closed when given back
+YDL_POOL_SIZE = int(os.getenv("YDL_POOL_SIZE", "4"))
+# A handle is replaced after this many checkouts, so cookies and extractor
+# state picked up along the way don't grow forever
+YDL_POOL_MAX_USES = int(os.getenv("YDL_POOL_MAX_USES", "200"))
+
+logger = logging.getLogger(__name__)
+
+pools: List["YdlPool"] = []
+
+YDL_CREATED = Counter("ydl_handles_created_total", "YoutubeDL handles built", ("pool", "profile"))
+
+# Set up once by YoutubeDL.__init__ from the params, fixed for a profile
+FIXED_PARAMS = {"postprocessors", "postprocessor_hooks", "post_hooks", "paths", "restrictfilenames", "cookiefile",
+                "cookiesfrombrowser", "http_headers", "impersonate", "logger", "quiet", "verbose"}
+
+# YoutubeDL internals that checkouts change and reset() puts back; they are not
+# public API, so a yt-dlp upgrade that renames one must fail when the handle is built
+# rather than leak state between downloads
+HANDLE_ATTRS = ("format_selector", "build_format_selector", "add_progress_hook", "_parse_outtmpl",
+                "_progress_hooks", "_download_retcode", "_num_downloads", "_num_videos", "_playlist_level",
+                "_playlist_urls", "_printed_messages")
+
+Factory = Callable[[Dict[str, Any]], "yt_dlp.YoutubeDL"]
+
+
+def new_ydl(params: Dict[str, Any]) -> "yt_dlp.YoutubeDL":
+    # yt-dlp and its extractors take a while to import, only workers that use it pay for it
+    import yt_dlp
+    return yt_dlp.YoutubeDL(params)
+
+
+def unselected(info: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of an extracted ``info`` that ``process_ie_result`` can select formats on again."""
+    # process_ie_result mutates the dict, keep the cached copy intact
+    info = copy.deepcopy(info)
+    # Left over from the selection made during extraction, yt-dlp would take it
+    # for this one (and merge those formats) when a single format is picked
+    info.pop('requested_formats', None)
+    return info
+
+
+def resolve_formats(ydl: "yt_dlp.YoutubeDL", info: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Formats the handle's format selector picks for ``info``, nothing is downloaded."""
+    selected = ydl.process_ie_result(unselected(info), download=False)
+    return selected.get('requested_formats') or [selected]
+
+
+class _Handle:
+    def __init__(self, ydl: "yt_dlp.YoutubeDL"):
+        missing = [name for name in HANDLE_ATTRS if not hasattr(ydl, name)]
+        if missing:
+            raise RuntimeError(f"This yt-dlp version can't be pooled, YoutubeDL lacks: {', '.join(missing)}")
+        self.ydl = ydl
+        self.uses = 0
+        # What checkouts change, as YoutubeDL.__init__ left it
+        self.params = dict(ydl.params)
+        self.outtmpl = dict(ydl.params["outtmpl"])
+        self.format_selector = ydl.format_selector
+        self.progress_hooks = list(ydl._progress_hooks)
+
+    def apply(self, params: Dict[str, Any]):
+        ydl = self.ydl
+        for name, value in params.items():
+            if name == "outtmpl":
+                ydl.params["outtmpl"] = value if isinstance(value, dict) else {"default": value}
+                ydl._parse_outtmpl()
+            elif name == "format":
+                ydl.params["format"] = value
+                ydl.format_selector = value if value in (None, "-") or callable(value) else ydl.build_format_selector(value)
+            elif name == "progress_hooks":
+                for hook in value:
+                    ydl.add_progress_hook(hook)
+            else:
+                ydl.params[name] = value
+
+    def reset(self):
+        ydl = self.ydl
+        ydl.params.clear()
+        ydl.params.update(self.params)
+        ydl.params["outtmpl"] = dict(self.outtmpl)
+        ydl.format_selector = self.format_selector
+        ydl._progress_hooks = list(self.progress_hooks)
+        ydl._download_retcode = 0
+        ydl._num_downloads = 0
+        ydl._num_videos = 0
+        ydl._playlist_level = 0
+        ydl._playlist_urls = set()
+        ydl._printed_messages = set()
+
+    def close(self):
+        try:
+            self.ydl.close()
+        except Exception as e:
+            logger.warning(f"Closing a YoutubeDL handle failed: {e}")
+
+
+class YdlPool:
+    """Reusable ``YoutubeDL`` handles, one stack per option profile.
+
+    Building a handle loads the extractor list, post-processors and format
+    selector, which costs far more than most info requests. A checked out
+    handle is used by one thread at a time; the per-request options given to
+    ``checkout`` are undone when it is given back.
+    """
+
+    def __init__(self, name: str, profiles: Dict[str, Dict[str, Any]], factory: Factory = new_ydl,
+                 size: int = YDL_POOL_SIZE, max_uses: int = YDL_POOL_MAX_USES):
+        self.name = name
+        self.profiles = profiles
+        self.factory = factory
+        self.size = size
+        self.max_uses = max_uses
+        self._idle: Dict[str, List[_Handle]] = {profile: [] for profile in profiles}
+        self._lock = threading.Lock()
+        pools.append(self)
+
+    def _create(self, profile: str) -> _Handle:
+        # Profiles are copied, YoutubeDL.__init__ normalizes its params in place
+        handle = _Handle(self.factory(dict(self.profiles[profile])))
+        YDL_CREATED.inc(pool=self.name, profile=profile)
+        return handle
+
+    @contextmanager
+    def checkout(self, profile: str, **params) -> Iterator["yt_dlp.YoutubeDL"]:
+        """A handle of ``profile`` with ``params`` applied on top, for the duration of the block."""
+        if profile not in self.profiles:
+            raise ValueError(f"Unknown YoutubeDL profile {profile}")
+        fixed = FIXED_PARAMS.intersection(params)
+        if fixed:
+            raise ValueError(f"{', '.join(sorted(fixed))} can't be changed per checkout")
+        with self._lock:
+            handle = self._idle[profile].pop() if self._idle[profile] else None
+        if handle is None:
+            handle = self._create(profile)
+        handle.uses += 1
+        reusable = False
+        try:
+            handle.apply(params)
+            yield handle.ydl
+            reusable = True
+        except Exception as e:
+            # yt-dlp cleans up after its own errors, anything else may have left the handle half-way
+            from yt_dlp.utils import DownloadError, ExtractorError
+            reusable = isinstance(e, (DownloadError, ExtractorError))
+            raise
+        finally:
+            self._checkin(profile, handle, reusable)
+
+    def _checkin(self, profile: str, handle: _Handle, reusable: bool):
+        if reusable and handle.uses < self.max_uses:
+            handle.reset()
+            with self._lock:
+                if len(self._idle[profile]) < self.size:
+                    self._idle[profile].append(handle)
+                    return
+        handle.close()
+
+    def warm(self, profiles: Optional[Iterable[str]] = None):
+        """Build one idle handle per profile ahead of the first request."""
+        for profile in profiles or self.profiles:
+            with self._lock:
+                if self._idle[profile]:
+                    continue
+            handle = self._create(profile)
+            self._checkin(profile, handle, True)
+
+    def clear(self):
+        with self._lock:
+            handles = [handle for idle in self._idle.values() for handle in idle]
+            for idle in self._idle.values():
+                idle.clear()
+        for handle in handles:
+            handle.close()
+
+    def idle(self) -> Dict[str, int]:
+        with self._lock:
+            return {profile: len(idle) for profile, idle in self._idle.items()}
+
+
+Gauge("ydl_pool_idle", "Idle YoutubeDL handles", ("pool", "profile"),
+      collect=lambda: {(pool.name, profile): count for pool in pools for profile, count in pool.idle().items()})
@@ -14,6 +14,9 @@ api.interceptors.request.use((config) => {
     return config;
 });
 
+// Absolute URL of an API path, for links and images the browser loads itself
+export const apiUrl = (path) => `${API_BASE_URL}${path}`;
+
 export const authAPI = {
     register: (data) => api.post('/register', data),
     login: (formData) => api.post('/token', formData, {
@@ -23,17 +26,21 @@ export const authAPI = {
 };
 
 export const socialAPI = {
-    getPosts: () => api.get('/posts'),
+    // Pages of posts, pass the previous page's next_cursor to continue
+    getPosts: (cursor, limit) => api.get('/posts', { params: { cursor, limit } }),
     createPost: (data) => api.post('/posts', data),
     sendFriendRequest: (userId) => api.post(`/friends/request/${userId}`),
     getFriendRequests: () => api.get('/friends/requests'),
     acceptFriendRequest: (userId) => api.post(`/friends/accept/${userId}`),
     reactToPost: (data) => api.post('/reactions', data),
+    // Comment and reaction counts of many posts in one request
+    getPostCounts: (postIds) => api.get('/posts/counts', { params: new URLSearchParams(postIds.map((id) => ['ids', id])) }),
     commentOnPost: (data) => api.post('/comments', data),
 };
 
 export const downloaderAPI = {
-    fetchInfo: (url) => api.get(`/downloader/info?url=${encodeURIComponent(url)}`),
+    // Grouped formats and thumbnails resized and cached by the API
+    fetchInfo: (url) => api.get(`/downloader/info?url=${encodeURIComponent(url)}&compact=true`),
     download: (url, formatType) => api.post(`/downloader/download?url=${encodeURIComponent(url)}&format_type=${formatType}`, {}, {
         responseType: 'blob'
     }),
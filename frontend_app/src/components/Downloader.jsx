@@ -1,5 +1,5 @@
 import React, { useState } from 'react';
-import { downloaderAPI } from '../api';
+import { apiUrl, downloaderAPI } from '../api';
 
 const Downloader = () => {
     const [url, setUrl] = useState('');
@@ -106,7 +106,9 @@ const Downloader = () => {
                 <div className="glass-card" style={{ marginTop: '20px', border: '1px solid var(--secondary-neon)', padding: '2rem' }}>
                     <div style={{ display: 'flex', gap: '30px', alignItems: 'flex-start', flexWrap: 'wrap', justifyContent: 'center' }}>
                         <img
-                            src={info.thumbnail}
+                            src={info.thumbnails?.length ? apiUrl(info.thumbnails[info.thumbnails.length - 1].url) : info.thumbnail}
+                            srcSet={info.thumbnails?.map((t) => `${apiUrl(t.url)} ${t.width}w`).join(', ')}
+                            sizes="300px"
                             alt={info.title}
                             style={{ width: '100%', maxWidth: '300px', borderRadius: '12px', boxShadow: '0 0 20px rgba(0,255,255,0.3)' }}
                         />
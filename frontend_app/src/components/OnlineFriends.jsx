@@ -12,8 +12,15 @@ const OnlineFriends = ({ userId }) => {
         socket.onmessage = (event) => {
             // Handle updates if backend sends them
         };
+        // Keeps the connection counted as online (the server closes silent ones)
+        const heartbeat = setInterval(() => {
+            if (socket.readyState === WebSocket.OPEN) socket.send('ping');
+        }, 30000);
 
-        return () => socket.close();
+        return () => {
+            clearInterval(heartbeat);
+            socket.close();
+        };
     }, [userId]);
 
     return (